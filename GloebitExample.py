@@ -3,10 +3,9 @@
 
 from flask import Flask, request, redirect, session, url_for
 
-from oauth2client.client import OAuth2Credentials
-
 from cgi import escape
 
+import os
 import urllib
 
 ### IMPORTANT ###
@@ -14,6 +13,11 @@ import urllib
 # Flask session.  Never do that in a real app!  Store it someplace secure.
 
 import gloebit
+import gloebit_flask
+
+# Modules needed only by opt-in features, and by logged-in pages, are
+# imported where they are used, keeping the app's import (and each
+# server process's startup) fast.
 
 APP = Flask(__name__)
 
@@ -31,10 +35,88 @@ APP.secret_key = \
 CLIENT_KEY = 'test-consumer'
 CLIENT_SECRET = 's3cr3t'
 
-# For single-user simplicity, use a global merchant object.
+ALL_PRODUCTS = ['hat', 'shirt', 'pants', 'shoe', 'backpack', 'knife', 'torch']
+
+# Opt-in hold flow: set GLOEBIT_HOLDS_URL to this app's absolute URL
+# plus '/gloebit/hold', and purchases are queued and return at once;
+# Gloebit settles them by calling the hold endpoints.  Holds are kept in
+# the GLOEBIT_HOLDS_DB database, so that every server process can answer
+# the callbacks and holds survive restarts.
+HOLDS = None
+if os.environ.get('GLOEBIT_HOLDS_URL'):
+    import gloebit_holds
+    HOLDS = gloebit_holds.SharedHoldTable(
+        os.environ['GLOEBIT_HOLDS_URL'], APP.secret_key,
+        os.environ.get('GLOEBIT_HOLDS_DB', 'gloebit-holds.db'))
+
+# Opt-in hedged reads: set GLOEBIT_HEDGE_MAX_EXTRA to the fraction of
+# extra read requests allowed (e.g. 0.05), and reads slower than the 95th
+# percentile get a duplicate request, cutting /main's slow tail.
+HEDGER = None
+if os.environ.get('GLOEBIT_HEDGE_MAX_EXTRA'):
+    import gloebit_hedge
+    HEDGER = gloebit_hedge.Hedger(
+        max_extra=float(os.environ['GLOEBIT_HEDGE_MAX_EXTRA']))
+
+# Opt-in inventory snapshot: set GLOEBIT_SNAPSHOT to a file (e.g. under
+# /dev/shm), and inventories read and product counts changed here are
+# shared with other processes on the host through gloebit_snapshot,
+# keyed by the Gloebit user id that user_info() returns at login.
+SNAPSHOT = None
+if os.environ.get('GLOEBIT_SNAPSHOT'):
+    import gloebit_snapshot
+    SNAPSHOT = gloebit_snapshot.SnapshotStore(os.environ['GLOEBIT_SNAPSHOT'])
+
+# For single-user simplicity, use a global merchant object.  The catalog
+# lets it reject unknown product names without asking Gloebit.  Under a
+# gevent or eventlet server (e.g. gunicorn -k gevent), the merchant runs
+# in cooperative mode, which checks that the objects passed here were
+# created after monkey-patching.
 GLOEBIT = gloebit.Gloebit(
     gloebit.ClientSecrets(CLIENT_KEY, CLIENT_SECRET, _sandbox=True),
-    secret_key=APP.secret_key)
+    secret_key=APP.secret_key,
+    catalog=gloebit.ProductCatalog.from_list(ALL_PRODUCTS),
+    holds=HOLDS, hedger=HEDGER, snapshot=SNAPSHOT,
+    cooperative_mode=gloebit.cooperative())
+
+if HOLDS is not None:
+    APP.register_blueprint(gloebit_flask.hold_blueprint(HOLDS),
+                           url_prefix='/gloebit/hold')
+
+# Report each page's Gloebit calls in a Server-Timing header, and log
+# pages that make more Gloebit calls than expected.
+gloebit_flask.GloebitCallTrace(APP, merchants=[GLOEBIT], max_calls=4,
+                               mode='log')
+
+# Opt-in profiling: set GLOEBIT_PROFILE_DIR to save collapsed stacks of
+# requests slower than GLOEBIT_PROFILE_THRESHOLD seconds, plus a
+# GLOEBIT_PROFILE_SAMPLE_RATE fraction of all others.
+if os.environ.get('GLOEBIT_PROFILE_DIR'):
+    gloebit_flask.SlowRequestProfiler(
+        APP, merchants=[GLOEBIT],
+        directory=os.environ['GLOEBIT_PROFILE_DIR'],
+        threshold=float(os.environ.get('GLOEBIT_PROFILE_THRESHOLD', '0.5')),
+        sample_rate=float(os.environ.get('GLOEBIT_PROFILE_SAMPLE_RATE', '0')))
+
+# Opt-in durable purchases: set GLOEBIT_OUTBOX to a database file, and
+# purchases are committed there and sent to Gloebit in the background,
+# so the purchase page returns without waiting for Gloebit.
+OUTBOX = None
+if os.environ.get('GLOEBIT_OUTBOX'):
+    import gloebit_outbox
+    OUTBOX = gloebit_outbox.TransactionOutbox(GLOEBIT,
+                                              os.environ['GLOEBIT_OUTBOX'])
+
+
+def session_credential():
+    """ return the user's Gloebit credential kept in the session """
+    # OAuth2Credentials.from_json() uses datetime.strptime(), whose first
+    # call is not thread-safe in Python 2.  Importing its module here
+    # first, under the import lock, makes concurrent first calls safe.
+    __import__('_strptime')
+    from oauth2client.client import OAuth2Credentials
+    return OAuth2Credentials.from_json(session['credential'])
+
 
 @APP.route('/')
 def index():
@@ -79,7 +161,7 @@ def character_select():
     else:
         message = ""
 
-    credentials = OAuth2Credentials.from_json(session['credential'])
+    credentials = session_credential()
     characters = GLOEBIT.user_characters (credentials)
     page = '''
     <h1>Gloebit Flask Example</h1>
@@ -117,7 +199,7 @@ def character_select():
 @APP.route('/character-post', methods=['POST'])
 def character_post():
     """ accept a post from the character page """
-    credentials = OAuth2Credentials.from_json(session['credential'])
+    credentials = session_credential()
     try:
         if request.form.get ('new', False):
             new_name = request.form.get ('new-name').strip ()
@@ -131,12 +213,18 @@ def character_post():
             session['character-name'] = character['name']
             session['character-id'] = character['id']
         else:
-            characters = GLOEBIT.user_characters (credentials)
-            for character in characters:
-                if request.form.get ('select-'+character['id'], False):
+            characters = GLOEBIT.user_characters (credentials, indexed=True)
+            for key in request.form:
+                action, _, c_id = key.partition ('-')
+                if action not in ('select', 'delete'):
+                    continue
+                character = characters.by_id (c_id)
+                if character is None:
+                    continue
+                if action == 'select':
                     session['character-name'] = character['name']
                     session['character-id'] = character['id']
-                if request.form.get ('delete-'+character['id'], False):
+                else:
                     GLOEBIT.delete_character (credentials, character['id'])
                     return redirect(url_for('character_select'))
 
@@ -147,9 +235,6 @@ def character_post():
     return redirect(url_for('main'))
 
 
-ALL_PRODUCTS = ['hat', 'shirt', 'pants', 'shoe', 'backpack', 'knife', 'torch']
-
-
 
 @APP.route('/main')
 def main():
@@ -160,10 +245,14 @@ def main():
         message = "No activity yet"
 
 
-    credential = OAuth2Credentials.from_json(session['credential'])
-    user_products = GLOEBIT.user_products (credential)
+    credential = session_credential()
+    # Fetch both inventories at once rather than one after the other.
+    user_products = GLOEBIT.call_async \
+        (gloebit_flask.copy_request_context(GLOEBIT.user_products),
+         credential)
     character_products = GLOEBIT.character_products \
                          (credential, session['character-id'])
+    user_products = user_products.result()
 
     page = '''
         <h1>Gloebit Flask Example</h1>
@@ -226,10 +315,22 @@ def main():
     return page
 
 
+def purchase_methods():
+    """ return the user and character purchase methods, and their message """
+    if GLOEBIT.holds is not None:
+        return (GLOEBIT.submit_purchase_user_product,
+                GLOEBIT.submit_purchase_character_product, "buy pending ")
+    if OUTBOX is not None:
+        return (OUTBOX.purchase_user_product,
+                OUTBOX.purchase_character_product, "buy queued ")
+    return (GLOEBIT.purchase_user_product,
+            GLOEBIT.purchase_character_product, "buy ")
+
+
 @APP.route('/purchase', methods=['POST'])
 def purchase():
     """ user submitted form from main page """
-    credential = OAuth2Credentials.from_json(session['credential'])
+    credential = session_credential()
 
     if request.form.get ('visit', False):
         return redirect(GLOEBIT.visit_uri +
@@ -238,6 +339,7 @@ def purchase():
                         '&r=' + urllib.quote(CLIENT_KEY))
 
     character_id = session[ 'character-id' ]
+    buy_user, buy_character, bought = purchase_methods()
 
     for name in ALL_PRODUCTS:
         try:
@@ -257,13 +359,14 @@ def purchase():
                         (credential, character_id, name)
                 return redirect(url_for('main', **{'msg': "consume " + name}))
 
+            # Passing the username saves a user_info() call per purchase.
             if request.form.get ('user-buy-%s' % name, False):
-                GLOEBIT.purchase_user_product (credential, name)
-                return redirect(url_for('main', **{'msg': "buy " + name}))
+                buy_user (credential, name, username=session['username'])
+                return redirect(url_for('main', **{'msg': bought + name}))
             if request.form.get ('character-buy-%s' % name, False):
-                GLOEBIT.purchase_character_product \
-                        (credential, character_id, name)
-                return redirect(url_for('main', **{'msg': "buy " + name}))
+                buy_character (credential, character_id, name,
+                               username=session['username'])
+                return redirect(url_for('main', **{'msg': bought + name}))
 
         except gloebit.TransactFailureError as exn:
             kwargs = {'msg': name + ': ' + str (exn)}
@@ -41,19 +41,32 @@ Typical flow for single-merchant service:
 ###   * Params passed backed when getting user info, what are they?
 ###   * Improve XSRF checking when exchanging code for credential.
 
-import httplib2
 import urllib
+import copy
+import hashlib
+import hmac
 import json
-import uuid
+import logging
 import time
+import os
+import socket
+import sys
+import threading
+import Queue
+import collections
 
 from urlparse import urlparse
 
-from oauth2client import clientsecrets, xsrfutil
-from oauth2client.client import OAuth2WebServerFlow
-
 from oauth2client import util
 
+LOGGER = logging.getLogger(__name__)
+
+# httplib, httplib2, uuid, the oauth2client flow, clientsecrets and xsrfutil
+# modules, and the gloebit_cache, gloebit_pool and gloebit_http2 modules,
+# are imported where first used.  Most processes (a fresh WSGI daemon, a
+# CLI balance lookup) only need some of them, and importing them up front
+# dominates the cost of importing this module.
+
 GLOEBIT_SERVER = 'www.gloebit.com'
 GLOEBIT_SANDBOX = 'sandbox.gloebit.com'
 GLOEBIT_OAUTH2_AUTH_URI = 'https://%s/oauth2/authorize'
@@ -76,6 +89,73 @@ GLOEBIT_CHARACTER_GRANT_URI = 'https://%s/grant-character-product/%s/%s/%s/'
 
 CHECK_SSL_CERT = False
 
+# Endpoint URIs per Gloebit host, keyed by authorization URI and API
+# base URI.  Filled by _endpoints() and shared by every Gloebit object
+# for that host.
+_ENDPOINTS = {}
+
+# Access tokens whose Gloebit user id a merchant with a snapshot store
+# remembers, for keying the store by user.
+_MAX_SNAPSHOT_USERS = 10000
+
+def _endpoint_uri(template, api_uri, *args):
+    """ fill in an endpoint URI template for the API at api_uri """
+    return api_uri + template[len('https://%s'):] % args
+
+def _endpoints(auth_uri, api_uri=None):
+    """Return the dictionary of endpoint URIs for a Gloebit API.
+
+    The API is at api_uri, or by default at https on auth_uri's host.
+    """
+    key = (auth_uri, api_uri)
+    endpoints = _ENDPOINTS.get(key)
+    if endpoints is None:
+        if api_uri is None:
+            api_uri = 'https://' + urlparse(auth_uri).hostname
+        api_uri = api_uri.rstrip('/')
+        def uri(template):
+            """ endpoint URI for this API """
+            return _endpoint_uri(template, api_uri)
+        endpoints = {
+            'api_uri': api_uri,
+            'hostname': urlparse(api_uri).netloc,
+            'user_uri': uri(GLOEBIT_USER_URI),
+            'visit_uri': uri(GLOEBIT_VISIT_URI),
+            'balance_uri': uri(GLOEBIT_BALANCE_URI),
+            'characters_uri': uri(GLOEBIT_CHARACTERS_URI),
+            'create_character_uri': uri(GLOEBIT_CREATE_CHARACTER_URI),
+            'update_character_uri': uri(GLOEBIT_UPDATE_CHARACTER_URI),
+            'delete_character_uri': uri(GLOEBIT_DELETE_CHARACTER_URI),
+            'transact_uri': uri(GLOEBIT_TRANSACT_URI),
+            'user_products_uri': uri(GLOEBIT_USER_PRODUCTS_URI),
+        }
+        _ENDPOINTS[key] = endpoints
+    return endpoints
+
+def cooperative():
+    """Return True if gevent or eventlet has monkey-patched threading.
+
+    Locks, threads and sleeps the module creates after patching are then
+    cooperative, so Gloebit calls and background workers run as greenlets.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return True
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('thread'):
+        return True
+    return False
+
+def predates_patching(part):
+    """Return True if part's lock was made before monkey-patching.
+
+    Such an object (e.g. a RateLimiter or PoolManager) blocks the whole
+    event loop while it waits on its lock under gevent or eventlet.
+    Objects without a lock never predate it.
+    """
+    lock = getattr(part, '_lock', None)
+    return lock is not None and type(lock) is not type(threading.Lock())
+
 class Error(Exception):
     """Base error for this module."""
 
@@ -113,13 +193,85 @@ class TransactRequestError(TransactError):
 class TransactFailureError(TransactError):
     """Gloebit transact request was processed but returned success=False."""
 
+class UnknownProductError(TransactFailureError, ProductsAccessError):
+    """Product is not in the merchant's product catalog.
+
+    Raised locally, before contacting Gloebit, in place of the purchase
+    (TransactFailureError) or consume/grant (ProductsAccessError) failure
+    Gloebit would return.
+    """
+
+class InsufficientFundsError(TransactFailureError):
+    """Purchase refused locally: the user's known balance is too low."""
+
+class RateLimitError(Error):
+    """Client-side rate limiter refused to send a request to Gloebit."""
+
+class PoolTimeoutError(Error):
+    """Timed out waiting for a connection from a ConnectionPool."""
+
+class RequestCancelledError(Error):
+    """Request abandoned because another copy of it was answered first."""
+
+class SubmissionQueueFullError(Error):
+    """Background submission queue is full; request was not queued."""
+
+class HoldCanceledError(TransactFailureError):
+    """Gloebit canceled a held purchase, or it expired unsettled."""
+
+class PollResult(collections.namedtuple(
+        'PollResult', 'credential balance products error')):
+    """One user's entry from Gloebit.poll_users().
+
+    Fields are the credential polled, the balance and product inventory
+    (None if not requested or if polling failed), and the exception that
+    ended polling this user (e.g. AccessTokenError), or None.
+    """
+    __slots__ = ()
+
+class CharacterList(list):
+    """List of Gloebit characters, indexed by character id and name.
+
+    Iterates in the order Gloebit returned the characters.  The id and
+    name indexes are built once, on first lookup, so repeated lookups
+    against the same list are dictionary hits.  Treat the list as
+    read-only; the indexes are not updated if it is modified.
+    """
+
+    def __init__(self, characters=()):
+        list.__init__(self, characters)
+        self._by_id = None
+        self._by_name = None
+
+    def _build_index(self):
+        """ build the id and name indexes """
+        by_id = {}
+        by_name = {}
+        for character in self:
+            by_id.setdefault(character.get('id'), character)
+            by_name.setdefault(character.get('name'), character)
+        self._by_id = by_id
+        self._by_name = by_name
+
+    def by_id(self, character_id, default=None):
+        """ return the character with the given Gloebit id """
+        if self._by_id is None:
+            self._build_index()
+        return self._by_id.get(character_id, default)
+
+    def by_name(self, name, default=None):
+        """ return the first character with the given name """
+        if self._by_name is None:
+            self._build_index()
+        return self._by_name.get(name, default)
+
 class ClientSecrets(object):
     """Container for OAuth2 client secrets."""
 
     @util.positional(3)
     def __init__(self, client_id, client_secret,
                  redirect_uri=None, auth_uri=None, token_uri=None,
-                 _sandbox=False):
+                 api_uri=None, _sandbox=False):
         """Create a ClientSecrets.
 
         Args:
@@ -132,6 +284,9 @@ class ClientSecrets(object):
             Gloebit callback with code.
           auth_uri: string, URL for Gloebit authorization method.
           token_uri: string, URL for Gloebit access token method.
+          api_uri: string, Base URL (scheme, host and port) of the Gloebit
+            API endpoints, e.g. 'http://127.0.0.1:8000' for a local test
+            server.  Defaults to https on the authorization URL's host.
           _sandbox: Boolean, Set to True to use sandbox testing server.
         """
         self.client_id = client_id
@@ -139,6 +294,7 @@ class ClientSecrets(object):
         self.redirect_uri = redirect_uri
         self.auth_uri = auth_uri
         self.token_uri = token_uri
+        self.api_uri = api_uri
 
         if _sandbox:
             self.auth_uri = GLOEBIT_OAUTH2_AUTH_URI % GLOEBIT_SANDBOX
@@ -156,6 +312,8 @@ class ClientSecrets(object):
 
         Very closely resembles oauth2client.client.flow_from_clientsecrets().
         """
+        from oauth2client import clientsecrets
+
         _client_type, client_info = \
                       clientsecrets.loadfile(filename, cache=cache)
         constructor_kwargs = {
@@ -183,7 +341,11 @@ class Gloebit(object):
     @util.positional(2)
     def __init__(self, client_secrets,
                  scope='transact inventory character user',
-                 redirect_uri=None, secret_key=None):
+                 redirect_uri=None, secret_key=None, coalesce_reads=True,
+                 rate_limiter=None, pool_manager=None, transport=None,
+                 balance_ledger=None, catalog=None, http2=False,
+                 conditional_reads=True, holds=None, call_executor=None,
+                 cooperative_mode=False, hedger=None, snapshot=None):
         """Create a Merchant that will use the given ClientSecrets.
 
         Args:
@@ -195,9 +357,71 @@ class Gloebit(object):
             the ClientSecrets.
           secret_key: string, Application's secret key; used for cross-site
             forgery prevention, if provided.
+          coalesce_reads: Boolean, If True, concurrent identical reads
+            (same endpoint, access token and character) share one request
+            to Gloebit and its result or exception.
+          rate_limiter: RateLimiter, Paces requests sent to Gloebit, if
+            provided.  May be shared by several Gloebit objects for the
+            same merchant.
+          pool_manager: gloebit_pool.PoolManager, Supplies this merchant's
+            connection pool.  Defaults to the process-wide
+            gloebit_pool.default_pool_manager().
+          transport: Object with a request(uri, method, headers, body)
+            method returning (response, content), used instead of the
+            connection pool; e.g. a gloebit_replay.ReplayTransport.
+          balance_ledger: BalanceLedger, Local record of user balances
+            used to refuse clearly unaffordable purchases without asking
+            Gloebit, if provided.
+          catalog: ProductCatalog, Merchant's products.  If provided,
+            product names are checked locally before purchase, consume
+            and grant requests, and its prices feed the balance ledger.
+          http2: Boolean, If True (and no transport is given), concurrent
+            requests are multiplexed over one HTTP/2 connection per host
+            with a gloebit_http2.Http2Transport, falling back to the
+            connection pool where HTTP/2 is unavailable.
+          conditional_reads: Boolean, If True, product inventories and
+            character lists are kept with their ETag or Last-Modified
+            validators and revalidated with conditional GETs; a 304 reply
+            reuses the kept copy instead of downloading and parsing it.
+          holds: HoldTable, If provided, purchases queued with the
+            submit_purchase_* methods use Gloebit's hold flow, and are
+            settled when Gloebit calls the table's hold URLs.  Use a
+            gloebit_holds.SharedHoldTable when several processes serve
+            the app.
+          call_executor: CallExecutor, Runs the calls passed to
+            call_async().  Defaults to the process-wide
+            default_call_executor().
+          cooperative_mode: Boolean, If True, the merchant is meant to run
+            under gevent or eventlet.  Raises Error unless threading,
+            socket and time are already monkey-patched, and unless the
+            rate limiter, balance ledger, catalog, hold table, pool
+            manager, call executor, hedger and snapshot given were
+            created after patching.  Their locks would otherwise block
+            the whole event loop.  Only the objects passed here are
+            checked, not ones assigned to the merchant later.  Patching
+            does not make file locks or SQLite cooperative: a
+            SnapshotStore write, and each database call of a
+            gloebit_holds.SharedHoldTable, still blocks the loop while it
+            runs.
+          hedger: gloebit_hedge.Hedger, If provided, reads (user_info(),
+            user_balance(), product inventories and character lists)
+            that are slow to answer are hedged with a duplicate request;
+            the first answer is used and the other request is cancelled.
+            Only the connection pool and Http2Transport can cancel a
+            request, so reads through another transport are not hedged.
+          snapshot: gloebit_snapshot.SnapshotStore, If provided, product
+            inventories read from Gloebit, and the product counts in
+            purchase, consume and grant responses, are written to this
+            host-local store, keyed by Gloebit user id.  The id of an
+            access token is learned from user_info(), or else fetched
+            once if 'user' is in scope; without it the write is skipped.
 
         Returns:
           A Merchant ready for user authorization and Gloebit methods.
+
+        Raises:
+          Error if cooperative_mode is set but the process is not
+          monkey-patched, or a shared object predates the patching.
         """
         self.client_secrets = client_secrets
         self.client_id = client_secrets.client_id
@@ -212,44 +436,92 @@ class Gloebit(object):
 
         self.secret_key = secret_key
 
-        parsed_auth_uri = urlparse(self.auth_uri)
-        hostname = parsed_auth_uri.hostname
-        self.user_uri = GLOEBIT_USER_URI % hostname
-        self.visit_uri = GLOEBIT_VISIT_URI % hostname
-        self.balance_uri = GLOEBIT_BALANCE_URI % hostname
-        self.characters_uri = GLOEBIT_CHARACTERS_URI % hostname
-        self.create_character_uri = GLOEBIT_CREATE_CHARACTER_URI % hostname
-        self.update_character_uri = GLOEBIT_UPDATE_CHARACTER_URI % hostname
-        self.delete_character_uri = GLOEBIT_DELETE_CHARACTER_URI % hostname
-        self.transact_uri = GLOEBIT_TRANSACT_URI % hostname
+        endpoints = _endpoints(self.auth_uri, client_secrets.api_uri)
+        self.user_uri = endpoints['user_uri']
+        self.visit_uri = endpoints['visit_uri']
+        self.balance_uri = endpoints['balance_uri']
+        self.characters_uri = endpoints['characters_uri']
+        self.create_character_uri = endpoints['create_character_uri']
+        self.update_character_uri = endpoints['update_character_uri']
+        self.delete_character_uri = endpoints['delete_character_uri']
+        self.transact_uri = endpoints['transact_uri']
         self.flow = None
 
-        self._hostname = hostname
+        self._api_uri = endpoints['api_uri']
+        self._hostname = endpoints['hostname']
+        self._user_products_uri = endpoints['user_products_uri']
+        self._submissions = None
+        self._submissions_lock = threading.Lock()
+        self._single_flight = None
+        self._validators = None
+        if coalesce_reads or conditional_reads:
+            import gloebit_cache
+            if coalesce_reads:
+                self._single_flight = gloebit_cache.SingleFlight()
+            if conditional_reads:
+                self._validators = gloebit_cache.ValidatorCache()
+        self.rate_limiter = rate_limiter
+        if pool_manager is None:
+            import gloebit_pool
+            pool_manager = gloebit_pool.default_pool_manager()
+        self.cooperative_mode = cooperative_mode
+        if cooperative_mode:
+            _check_cooperative(rate_limiter=rate_limiter,
+                               balance_ledger=balance_ledger,
+                               catalog=catalog, holds=holds,
+                               pool_manager=pool_manager,
+                               call_executor=call_executor, hedger=hedger,
+                               snapshot=snapshot)
+        self._pool = pool_manager.pool(self._hostname, self.client_id)
+        if transport is None:
+            transport = self._pool
+            if http2:
+                import gloebit_http2
+                transport = gloebit_http2.Http2Transport(self._pool)
+        self.transport = transport
+        self._listeners = []
+        self.balance_ledger = balance_ledger
+        self.catalog = catalog
+        self.holds = holds
+        self.call_executor = call_executor
+        self.hedger = hedger
+        self.snapshot = snapshot
+        self._user_ids = collections.OrderedDict()
+        self._user_ids_lock = threading.Lock()
 
     @util.positional(3)
     def ready_flow (self, redirect_uri, user):
         """ create oauth2 flow object """
+        self.flow = self._new_flow(redirect_uri, user)
+
+    @util.positional(3)
+    def _new_flow(self, redirect_uri, user):
+        """ return a new oauth2 flow object, leaving self.flow alone """
+        from oauth2client.client import OAuth2WebServerFlow
+
         if redirect_uri is None:
             redirect_uri = self.redirect_uri
-        self.flow = OAuth2WebServerFlow(self.client_id,
-                                        self.client_secret,
-                                        self.scope,
-                                        redirect_uri=redirect_uri,
-                                        auth_uri=self.auth_uri,
-                                        token_uri=self.token_uri,
-                                        revoke_uri=None)
+        flow = OAuth2WebServerFlow(self.client_id,
+                                   self.client_secret,
+                                   self.scope,
+                                   redirect_uri=redirect_uri,
+                                   auth_uri=self.auth_uri,
+                                   token_uri=self.token_uri,
+                                   revoke_uri=None)
         if user:
-            self.flow.params['state'] = \
+            from oauth2client import xsrfutil
+            flow.params['state'] = \
                 xsrfutil.generate_token(self.secret_key, user)
+        return flow
 
     @util.positional(2)
     def _products_uri(self, character_id):
         """ return uri to use for consuming a product """
         if character_id:
             q_character_id = urllib.quote(character_id)
-            return GLOEBIT_CHARACTER_PRODUCTS_URI % \
-                   (self._hostname, q_character_id)
-        return GLOEBIT_USER_PRODUCTS_URI % (self._hostname)
+            return _endpoint_uri(GLOEBIT_CHARACTER_PRODUCTS_URI,
+                                 self._api_uri, q_character_id)
+        return self._user_products_uri
 
     @util.positional(4)
     def _consume_uri(self, character_id, product, count):
@@ -257,9 +529,11 @@ class Gloebit(object):
         q_product = urllib.quote(product)
         if character_id:
             q_character_id = urllib.quote(character_id)
-            return GLOEBIT_CHARACTER_CONSUME_URI % \
-                   (self._hostname, q_character_id, q_product, count)
-        return GLOEBIT_USER_CONSUME_URI % (self._hostname, q_product, count)
+            return _endpoint_uri(GLOEBIT_CHARACTER_CONSUME_URI,
+                                 self._api_uri, q_character_id, q_product,
+                                 count)
+        return _endpoint_uri(GLOEBIT_USER_CONSUME_URI, self._api_uri,
+                             q_product, count)
 
     @util.positional(4)
     def _grant_uri(self, character_id, product, count):
@@ -267,9 +541,185 @@ class Gloebit(object):
         q_product = urllib.quote(product)
         if character_id:
             q_character_id = urllib.quote(character_id)
-            return GLOEBIT_CHARACTER_GRANT_URI % \
-                   (self._hostname, q_character_id, q_product, count)
-        return GLOEBIT_USER_GRANT_URI % (self._hostname, q_product, count)
+            return _endpoint_uri(GLOEBIT_CHARACTER_GRANT_URI,
+                                 self._api_uri, q_character_id, q_product,
+                                 count)
+        return _endpoint_uri(GLOEBIT_USER_GRANT_URI, self._api_uri,
+                             q_product, count)
+
+    @util.positional(4)
+    def _request(self, uri, method, access_token, body=None,
+                 endpoint_class='read', headers=None, hedge=False):
+        """Send an authorized request to Gloebit.
+
+        Args:
+          uri: string, Gloebit endpoint.
+          method: string, HTTP method.
+          access_token: string, User's access token.
+          body: JSON-serializable object to POST, if any.
+          endpoint_class: string, Rate limiter class of the endpoint:
+            'read', 'transact' or 'character'.
+          headers: dictionary, Extra request headers, if any.
+          hedge: Boolean, If True and a hedger is set, the request is
+            idempotent and may be hedged.
+
+        Returns:
+          Tuple of the response headers and the response body.
+
+        Raises:
+          RateLimitError if the rate limiter refused the request.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(endpoint_class)
+
+        headers = dict(headers or {}, Authorization='Bearer ' + access_token)
+        headers['Accept-Encoding'] = 'gzip'
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body)
+
+        if not self._listeners:
+            return self._send(uri, method, headers, body, hedge)
+
+        call = {'endpoint': _endpoint_name(uri), 'uri': uri,
+                'method': method}
+        listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener.call_started(call)
+            except Error:
+                raise
+            except Exception:
+                LOGGER.exception('Gloebit listener %r failed before %s',
+                                 listener, call['endpoint'])
+        start = time.time()
+        error = None
+        try:
+            return self._send(uri, method, headers, body, hedge)
+        except Exception as exn:
+            error = exn
+            raise
+        finally:
+            elapsed = time.time() - start
+            for listener in listeners:
+                try:
+                    listener.call_finished(call, elapsed, error)
+                except Exception:
+                    LOGGER.exception('Gloebit listener %r failed after %s',
+                                     listener, call['endpoint'])
+
+    def _send(self, uri, method, headers, body, hedge):
+        """ send a request through the transport, hedged if allowed """
+        # Only the built-in transports can cancel a losing copy.
+        if not hedge or self.hedger is None or \
+                not getattr(self.transport, 'cancellable', False):
+            return self.transport.request(uri, method, headers, body)
+        return self.hedger.call(
+            _endpoint_name(uri),
+            lambda cancel: self.transport.request(uri, method, headers, body,
+                                                  cancel=cancel),
+            self._allow_hedge)
+
+    def _allow_hedge(self):
+        """ take a read token for a hedge without waiting; False if none """
+        if self.rate_limiter is None:
+            return True
+        try:
+            self.rate_limiter.acquire('read', mode='reject')
+        except RateLimitError:
+            return False
+        return True
+
+    @util.positional(1)
+    def warm_up(self, connections=2, dns_ttl=300.0):
+        """Prepare for the first Gloebit calls in a fresh process.
+
+        Resolves the Gloebit host into the DNS cache and opens up to
+        `connections` keep-alive connections (TCP and TLS handshakes) in
+        this merchant's connection pool, or its one HTTP/2 connection, so
+        early requests do not pay for them.  Connections already checked
+        out by requests are not waited for.  Failures are ignored;
+        requests will just connect as usual.  Meant for worker start-up,
+        e.g. from the WSGI script.
+
+        Args:
+          connections: integer, Connections to open.
+          dns_ttl: float, Seconds Gloebit host addresses are cached.
+
+        Returns:
+          Number of connections opened.
+        """
+        import gloebit_pool
+
+        parsed = urlparse(self.user_uri)
+        cache = gloebit_pool.install_dns_cache(ttl=dns_ttl)
+        cache.add_host(parsed.hostname)
+        try:
+            cache.resolve(parsed.hostname, parsed.port or
+                          (443 if parsed.scheme == 'https' else 80))
+        except socket.error:
+            return 0
+        if not hasattr(self.transport, 'warm_up'):
+            return 0
+        try:
+            return self.transport.warm_up(
+                '%s://%s/' % (parsed.scheme, parsed.netloc), connections)
+        except (Error, EnvironmentError):
+            # E.g. a TLS setup failure.
+            return 0
+
+    def add_listener(self, listener):
+        """Report every request sent to Gloebit to listener.
+
+        The listener's call_started(call) and call_finished(call, elapsed,
+        error) methods run in the requesting thread, around the request.
+        call is a dictionary with the 'endpoint' name (e.g. 'balance' or
+        'get-user-products'), 'uri' and 'method'.  error is the exception
+        raised by the request, or None.
+
+        A listener may refuse a call by raising an Error from
+        call_started().  Any other exception a listener raises is logged
+        to the 'gloebit' logger and ignored, so a broken listener never
+        fails a call, or hides its result.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ stop reporting requests to listener """
+        self._listeners.remove(listener)
+
+    def _get(self, uri, access_token, headers=None):
+        """ GET a read-only endpoint, sharing identical in-flight requests """
+        if self._single_flight is None:
+            return self._request(uri, 'GET', access_token, headers=headers,
+                                 hedge=True)
+        return self._single_flight.call(
+            (uri, access_token) + tuple(sorted((headers or {}).items())),
+            lambda: self._request(uri, 'GET', access_token, headers=headers,
+                                  hedge=True))
+
+    def _get_field(self, uri, access_token, exception, field):
+        """Return one field of a read-only endpoint's response.
+
+        With conditional reads on, the field's last value is kept with the
+        response's validators, which are sent with the next GET of the
+        same URI and token; on 304 Not Modified the kept value is reused.
+
+        Raises:
+          As for _success_fields(), with field required.
+        """
+        if self._validators is None:
+            resp, response_json = self._get(uri, access_token)
+            return _success_fields(resp, response_json, exception, field)
+        key = (uri, access_token)
+        entry = self._validators.get(key)
+        resp, response_json = self._get(
+            uri, access_token, self._validators.conditions(entry))
+        if resp.status == 304 and entry is not None:
+            return copy.copy(entry[2])
+        value = _success_fields(resp, response_json, exception, field)
+        self._validators.store(key, resp, value)
+        return copy.copy(value)
 
     @util.positional(1)
     def user_authorization_url(self, user=None, redirect_uri=None):
@@ -288,13 +738,16 @@ class Gloebit(object):
         if redirect_uri is None:
             redirect_uri = self.redirect_uri
 
-        self.ready_flow (redirect_uri, user)
+        # Use a flow local to this call so one Gloebit object can serve
+        # concurrent requests.
+        flow = self._new_flow(redirect_uri, user)
 
         if user and self.secret_key is not None:
-            self.flow.params['state'] = \
+            from oauth2client import xsrfutil
+            flow.params['state'] = \
                 xsrfutil.generate_token(self.secret_key, user)
 
-        return self.flow.step1_get_authorize_url()
+        return flow.step1_get_authorize_url()
 
     @util.positional(2)
     def exchange_for_user_credential(self, query_args, user=None):
@@ -311,21 +764,20 @@ class Gloebit(object):
         Returns:
           An Oauth2Credentials object for authorizing Gloebit requests.
         """
-        self.ready_flow (None, user)
+        flow = self._new_flow(None, user)
 
         # Need better checks here.  If we have a secret key and a user, then
         # we need to expect a state and throw an error if we did not get one.
         #
         if user and 'state' in query_args:
+            from oauth2client import xsrfutil
             if not xsrfutil.validate_token(self.secret_key,
                                            query_args['state'],
                                            user):
                 raise CrossSiteError
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        credential = self.flow.step2_exchange(query_args['code'], http=http)
+        credential = flow.step2_exchange(query_args['code'],
+                                         http=self.transport)
 
         return credential
 
@@ -356,19 +808,16 @@ class Gloebit(object):
 
         access_token = credential.access_token
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.user_uri,
-            method='GET',
-            headers={'Authorization': 'Bearer ' + access_token}
-        )
+        resp, response_json = self._get(self.user_uri, access_token)
 
-        response = _success_check(resp, response_json, UserInfoError)
+        user_id, name = _success_fields(resp, response_json, UserInfoError,
+                                        'id', 'full-name',
+                                        optional=('id', 'full-name'))
+        if user_id is not None:
+            self._remember_user(access_token, user_id)
 
-        return { 'id': response.get('id', None),
-                 'name': response.get('full-name', None) }
+        return { 'id': user_id,
+                 'name': name }
 
     @util.positional(2)
     def user_balance(self, credential):
@@ -388,23 +837,20 @@ class Gloebit(object):
             invalid.
           BalanceAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'balance' field.
         """
         if "balance" not in self.scope:
             raise GloebitScopeError
 
         access_token = credential.access_token
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.balance_uri,
-            method='GET',
-            headers={'Authorization': 'Bearer ' + access_token}
-        )
+        resp, response_json = self._get(self.balance_uri, access_token)
 
-        response = _success_check(resp, response_json, BalanceAccessError)
-        return response['balance']
+        balance = _success_fields(resp, response_json, BalanceAccessError,
+                                  'balance')
+        if self.balance_ledger is not None:
+            self.balance_ledger.update(access_token, balance)
+        return balance
 
     @util.positional(4)
     def purchase_item(self, credential, item, item_price,
@@ -440,18 +886,40 @@ class Gloebit(object):
             invalid.
           TransactFailureError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+          InsufficientFundsError (a TransactFailureError) if the balance
+            ledger knows the user cannot afford the purchase.
+        """
+        transaction = self.item_transaction(credential, item, item_price,
+                                            item_quantity, username)
+
+        balance, _count = self.send_transaction(credential.access_token,
+                                                transaction)
+
+        return balance
+
+    def item_transaction(self, credential, item, item_price, item_quantity,
+                         username):
+        """Check a purchase_item() locally and build its transaction.
+
+        For sending the purchase later with send_transaction(), as the
+        submission queue and gloebit_outbox do.
+
+        Returns:
+          The transaction dictionary, with a fresh id.
+
+        Raises:
+          As for purchase_item(), for the checks made before sending.
         """
         if "transact" not in self.scope:
             raise GloebitScopeError
 
-        if not username:
-            if 'user' in self.scope.split():
-                userinfo = self.user_info(credential)
-                username = userinfo['name']
-            else:
-                username = "Unknown"
-
         total_cost = item_price * item_quantity
+        if self.balance_ledger is not None:
+            self.balance_ledger.check(credential.access_token, total_cost)
+
+        username = self._username(credential, username)
+
+        import uuid
 
         transaction = {
             'version':                     1,
@@ -467,23 +935,50 @@ class Gloebit(object):
             'consumer-key':                self.client_id,
             'username-on-application':     username,
         }
+        return transaction
 
-        access_token = credential.access_token
+    def _username(self, credential, username):
+        """ return username, or the user's Gloebit name if not given """
+        if username:
+            return username
+        if 'user' in self.scope.split():
+            return self.user_info(credential)['name']
+        return 'Unknown'
+
+    def send_transaction(self, access_token, transaction):
+        """POST a transaction to Gloebit and check the response.
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.transact_uri,
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(transaction),
-        )
+        The transaction is one built by item_transaction() or
+        product_transaction(), possibly some time before.
 
-        response = _success_check(resp, response_json, TransactFailureError)
+        Keeps the balance ledger current: the balance in a successful
+        response replaces the ledger's, and a failure drops it, since
+        the ledger may have been wrong.
 
-        return response.get('balance', None)
+        Returns:
+          Tuple of the response's balance and product count; either is
+            None if not in the response.
+        """
+        resp, response_json = self._request(
+            self.transact_uri, 'POST', access_token, body=transaction,
+            endpoint_class='transact')
+
+        try:
+            balance, count = _success_fields(
+                resp, response_json, TransactFailureError,
+                'balance', 'product-count',
+                optional=('balance', 'product-count'))
+        except TransactFailureError:
+            if self.balance_ledger is not None:
+                self.balance_ledger.forget(access_token)
+            raise
+
+        if self.balance_ledger is not None and balance is not None:
+            self.balance_ledger.update(access_token, balance)
+        if transaction.get('product'):
+            self._snapshot_count(access_token, transaction.get('character-id'),
+                                 transaction['product'], count)
+        return balance, count
 
     @util.positional(2)
     def _get_products(self, credential, character_id=None):
@@ -504,24 +999,25 @@ class Gloebit(object):
             invalid.
           ProductsAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'products' field.
         """
         if "inventory" not in self.scope:
             raise GloebitScopeError
 
         access_token = credential.access_token
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-
-        resp, response_json = http.request(
-            uri=self._products_uri (character_id),
-            method='GET',
-            headers={'Authorization': 'Bearer ' + access_token}
-        )
-
-        response = _success_check(resp, response_json, ProductsAccessError)
-        return response['products']
+        requested = time.time()
+        products = self._get_field(self._products_uri(character_id),
+                                   access_token, ProductsAccessError,
+                                   'products')
+        if self.snapshot is not None:
+            user_id = self._snapshot_user(access_token)
+            if user_id is not None and not self.snapshot.put_inventory(
+                    user_id, character_id, products, updated=requested):
+                LOGGER.warning('Gloebit snapshot full; inventory of user %s'
+                               ' character %s not written', user_id,
+                               character_id)
+        return products
 
     @util.positional(2)
     def user_products(self, credential):
@@ -568,16 +1064,51 @@ class Gloebit(object):
             invalid.
           TransactFailureError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+          UnknownProductError (a TransactFailureError) if the catalog does
+            not list the product.
+          InsufficientFundsError (a TransactFailureError) if the balance
+            ledger knows the product's price and that the user cannot
+            afford the purchase.
+        """
+        transaction = self.product_transaction(credential, product,
+                                               product_quantity,
+                                               character_id, username)
+
+        balance, remaining = self.send_transaction(credential.access_token,
+                                                   transaction)
+        return (balance, remaining)
+
+    def product_transaction(self, credential, product, product_quantity,
+                            character_id, username):
+        """Check a product purchase locally and build its transaction.
+
+        For sending the purchase later, as for item_transaction().
+
+        Returns:
+          The transaction dictionary, with a fresh id.
+
+        Raises:
+          As for _purchase_product(), for the checks made before sending.
         """
         if "transact" not in self.scope:
             raise GloebitScopeError
 
-        if not username:
-            if 'user' in self.scope.split():
-                userinfo = self.user_info(credential)
-                username = userinfo['name']
-            else:
-                username = 'Unknown'
+        if self.catalog is not None:
+            self.catalog.validate(product)
+
+        if self.balance_ledger is not None:
+            price = None
+            if self.catalog is not None:
+                price = self.catalog.price(product)
+            if price is None:
+                price = self.balance_ledger.price(product)
+            if price is not None:
+                self.balance_ledger.check(credential.access_token,
+                                          price * product_quantity)
+
+        username = self._username(credential, username)
+
+        import uuid
 
         transaction = {
             'version':                     1,
@@ -593,25 +1124,7 @@ class Gloebit(object):
             'character-id':                character_id,
             'username-on-application':     username,
         }
-
-        access_token = credential.access_token
-
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.transact_uri,
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(transaction),
-        )
-
-        response = _success_check(resp, response_json, TransactFailureError)
-
-        balance = response.get('balance', None)
-        remaining = response.get('product-count', None)
-        return (balance, remaining)
+        return transaction
 
     @util.positional(3)
     def purchase_user_product(self, credential, product,
@@ -655,28 +1168,27 @@ class Gloebit(object):
             invalid.
           ProductsAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+          UnknownProductError (a ProductsAccessError) if the catalog does
+            not list the product.
         """
         if "inventory" not in self.scope:
             raise GloebitScopeError
 
+        if self.catalog is not None:
+            self.catalog.validate(product)
+
         access_token = credential.access_token
         transaction = {}
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self._consume_uri(character_id, product, product_quantity),
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(transaction),
-        )
+        resp, response_json = self._request(
+            self._consume_uri(character_id, product, product_quantity),
+            'POST', access_token, body=transaction,
+            endpoint_class='transact')
 
-        response = _success_check(resp, response_json, ProductsAccessError)
-        print "response: " + str(response)
-
-        return response.get('product-count', None)
+        count = _success_fields(resp, response_json, ProductsAccessError,
+                                'product-count', optional=('product-count',))
+        self._snapshot_count(access_token, character_id, product, count)
+        return count
 
     @util.positional(4)
     def consume_user_product(self, credential, product, product_quantity=1):
@@ -692,8 +1204,8 @@ class Gloebit(object):
                                     product_quantity)
 
     @util.positional(3)
-    def _grant_product(self, credential product,
-                       product_quantity=1, character_id=character_id):
+    def _grant_product(self, credential, product,
+                       product_quantity=1, character_id=None):
         """Use credential to grant user's product(s) via Gloebit.
 
         This method is for consuming (deleting) one or more of a product that
@@ -716,28 +1228,81 @@ class Gloebit(object):
             invalid.
           ProductsAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+          UnknownProductError (a ProductsAccessError) if the catalog does
+            not list the product.
         """
         if "inventory" not in self.scope:
             raise GloebitScopeError
 
+        if self.catalog is not None:
+            self.catalog.validate(product)
+
         access_token = credential.access_token
         transaction = {}
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self._grant_uri(character_id, product, product_quantity),
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(transaction),
-        )
+        resp, response_json = self._request(
+            self._grant_uri(character_id, product, product_quantity),
+            'POST', access_token, body=transaction,
+            endpoint_class='transact')
+
+        count = _success_fields(resp, response_json, ProductsAccessError,
+                                'product-count', optional=('product-count',))
+        self._snapshot_count(access_token, character_id, product, count)
+        return count
+
+    def _snapshot_count(self, access_token, character_id, product, count):
+        """ write a product count from a response through to the snapshot """
+        if self.snapshot is None or count is None:
+            return
+        user_id = self._snapshot_user(access_token)
+        if user_id is not None and not self.snapshot.put(
+                user_id, character_id, product, count):
+            LOGGER.warning('Gloebit snapshot full; count of %s for user %s'
+                           ' character %s not written', product, user_id,
+                           character_id)
+
+    def _remember_user(self, access_token, user_id):
+        """ record the Gloebit user id of an access token """
+        if self.snapshot is None:
+            return
+        with self._user_ids_lock:
+            self._user_ids.pop(access_token, None)
+            self._user_ids[access_token] = user_id
+            while len(self._user_ids) > _MAX_SNAPSHOT_USERS:
+                self._user_ids.popitem(last=False)
+
+    def _snapshot_user(self, access_token):
+        """Return the Gloebit user id to key snapshot entries by.
+
+        An access token not yet seen by user_info() costs one user
+        request, if 'user' is in scope.
 
-        response = _success_check(resp, response_json, ProductsAccessError)
-        print "response: " + str(response)
-
-        return response.get('product-count', None)
+        Returns:
+          The user id, or None if it cannot be learned; the caller then
+          skips the snapshot write.
+        """
+        with self._user_ids_lock:
+            user_id = self._user_ids.get(access_token)
+        if user_id is not None:
+            return user_id
+        if "user" not in self.scope:
+            LOGGER.warning('Gloebit snapshot write skipped: user id unknown'
+                           ' and "user" not in scope')
+            return None
+        import httplib
+        import httplib2
+
+        try:
+            resp, response_json = self._get(self.user_uri, access_token)
+            user_id = _success_fields(resp, response_json, UserInfoError,
+                                      'id')
+        except (Error, EnvironmentError, httplib.HTTPException,
+                httplib2.HttpLib2Error):
+            LOGGER.warning('Gloebit snapshot write skipped: user id lookup'
+                           ' failed', exc_info=True)
+            return None
+        self._remember_user(access_token, user_id)
+        return user_id
 
     @util.positional(3)
     def grant_user_product(self, credential, product, product_quantity=1):
@@ -754,15 +1319,18 @@ class Gloebit(object):
                                    character_id=character_id)
 
     @util.positional(2)
-    def user_characters(self, credential):
+    def user_characters(self, credential, indexed=False):
         """Use credential to retrieve Gloebit user character list.
 
         Args:
           credential: Oauth2Credentials object, Gloebit authorization credential
             acquired from 2-step authorization process (oauth2).
+          indexed: Boolean, Set to True to get a CharacterList, which also
+            supports lookups by character id and name.
 
         Returns:
-          List of user's characters, each is a dictionary.
+          List of user's characters, each is a dictionary.  A CharacterList
+            if indexed is True.
 
         Raises:
           GloebitScopeError if 'character' not in Merchant's scope.
@@ -771,22 +1339,18 @@ class Gloebit(object):
             invalid.
           CharacterAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'characters' field.
         """
         if "character" not in self.scope:
             raise GloebitScopeError
 
         access_token = credential.access_token
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.characters_uri,
-            method='GET',
-            headers={'Authorization': 'Bearer ' + access_token})
-
-        response = _success_check(resp, response_json, CharacterAccessError)
-        return response['characters']
+        characters = self._get_field(self.characters_uri, access_token,
+                                     CharacterAccessError, 'characters')
+        if indexed:
+            return CharacterList(characters)
+        return characters
 
     @util.positional(3)
     def create_character(self, credential, character):
@@ -807,6 +1371,7 @@ class Gloebit(object):
             invalid.
           CharacterAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'character' field.
         """
         if "character" not in self.scope:
             raise GloebitScopeError
@@ -816,18 +1381,12 @@ class Gloebit(object):
         if character.get ('name', None) == None:
             raise CharacterAccessError('character must have "name" field')
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.create_character_uri,
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(character))
+        resp, response_json = self._request(
+            self.create_character_uri, 'POST', access_token, body=character,
+            endpoint_class='character')
 
-        response = _success_check(resp, response_json, CharacterAccessError)
-        return response['character']
+        return _success_fields(resp, response_json, CharacterAccessError,
+                               'character')
 
     @util.positional(3)
     def update_character(self, credential, character):
@@ -848,6 +1407,7 @@ class Gloebit(object):
             invalid.
           CharacterAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'character' field.
         """
         if "character" not in self.scope:
             raise GloebitScopeError
@@ -857,18 +1417,12 @@ class Gloebit(object):
         if character.get ('name', None) == None:
             raise CharacterAccessError('character must have "name" field')
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.update_character_uri,
-            method='POST',
-            headers={'Authorization': 'Bearer ' + access_token,
-                     'Content-Type': 'application/json'},
-            body=json.dumps(character))
+        resp, response_json = self._request(
+            self.update_character_uri, 'POST', access_token, body=character,
+            endpoint_class='character')
 
-        response = _success_check(resp, response_json, CharacterAccessError)
-        return response['character']
+        return _success_fields(resp, response_json, CharacterAccessError,
+                               'character')
 
     @util.positional(3)
     def delete_character(self, credential, character_id):
@@ -889,22 +1443,1341 @@ class Gloebit(object):
             invalid.
           CharacterAccessError if Gloebit returned 200 HTTP status with False
             success and a failure reason other than access token error.
+            Also if a successful response has no 'success' field.
         """
         if "character" not in self.scope:
             raise GloebitScopeError
 
         access_token = credential.access_token
 
-        http = httplib2.Http()
-        if not CHECK_SSL_CERT:
-            http.disable_ssl_certificate_validation = True
-        resp, response_json = http.request(
-            uri=self.delete_character_uri + character_id,
-            method='GET',
-            headers={'Authorization': 'Bearer ' + access_token})
+        resp, response_json = self._request(
+            self.delete_character_uri + character_id, 'GET', access_token,
+            endpoint_class='character')
+
+        return _success_fields(resp, response_json, CharacterAccessError,
+                               'success')
+
+    def call_async(self, function, *args, **kwargs):
+        """Start a Gloebit call on a worker thread and return its Future.
+
+        Lets a page make its independent Gloebit calls concurrently, e.g.
+          products = merchant.call_async(merchant.user_products, credential)
+          characters = merchant.user_characters(credential)
+          products = products.result()
+
+        Args:
+          function: callable, Usually a method of this object.
+          args, kwargs: Its arguments.
+
+        Returns:
+          A Future for function's return value or exception.
+        """
+        executor = self.call_executor
+        if executor is None:
+            executor = default_call_executor()
+        return executor.submit(function, *args, **kwargs)
+
+    @util.positional(2)
+    def poll_users(self, credentials, balance=True, products=False,
+                   concurrency=8, rate_limiter=None):
+        """Poll many users' balances and inventories, e.g. for dashboards.
+
+        Yields a PollResult per credential as soon as it is complete, so
+        results come in completion order, not input order.  At most
+        `concurrency` users are polled at once, and credentials are
+        taken from the iterable only as polling slots free up, so memory
+        use does not grow with the number of credentials.  A failure for
+        one user, such as an expired token, is reported in that user's
+        PollResult and does not stop the others.
+
+        Requests go through this merchant's rate limiter, if any, and
+        also through rate_limiter, which can hold a bulk job to a share
+        of the merchant's rate, e.g. RateLimiter(rates={'read': (20, 5)}).
+
+        Args:
+          credentials: iterable of Oauth2Credentials objects.
+          balance: Boolean, Set to True to fetch balances.
+          products: Boolean, Set to True to fetch user product inventories.
+          concurrency: integer, Users polled at once.
+          rate_limiter: RateLimiter, Extra limit for this job's requests.
+
+        Returns:
+          An iterator of PollResult.  Closing it early stops polling.
+
+        Raises:
+          Whatever iterating over credentials raises.
+        """
+        credentials = iter(credentials)
+        lock = threading.Lock()
+        results = Queue.Queue(concurrency)
+        stopped = threading.Event()
+        done = object()
+
+        def fetch(read):
+            """ make one read, within the job's rate limit """
+            if rate_limiter is not None:
+                rate_limiter.acquire('read')
+            return read()
+
+        def put(item):
+            """ hand an item to the consumer unless it stopped listening """
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def work():
+            """ poll users until the credentials run out """
+            while not stopped.is_set():
+                try:
+                    with lock:
+                        credential = next(credentials)
+                except StopIteration:
+                    break
+                except Exception as exn:
+                    # Raised again in the consumer's thread.
+                    put(exn)
+                    break
+                user_balance = user_products = error = None
+                try:
+                    if balance:
+                        user_balance = fetch(
+                            lambda: self.user_balance(credential))
+                    if products:
+                        user_products = fetch(
+                            lambda: self.user_products(credential))
+                except Exception as exn:
+                    # Reported with this user's result.
+                    user_balance = user_products = None
+                    error = exn
+                put(PollResult(credential, user_balance, user_products, error))
+            put(done)
+
+        workers = [threading.Thread(target=work, name='gloebit-poll-%d' % n)
+                   for n in range(concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            running = len(workers)
+            while running:
+                item = results.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+    @util.positional(1)
+    def enable_submission_queue(self, max_pending=1000, workers=2,
+                                block=True):
+        """Configure the background queue used by the submit_* methods.
+
+        Args:
+          max_pending: integer, Maximum number of queued requests.  Grants
+            coalesced into an already queued request do not count.
+          workers: integer, Number of worker threads sending requests.
+          block: Boolean, If True, submitting to a full queue waits for
+            room.  If False, it raises SubmissionQueueFullError.
 
-        response = _success_check(resp, response_json, CharacterAccessError)
-        return response['success']
+        Returns:
+          The SubmissionQueue.
+
+        Raises:
+          Error if a submission queue is already in use.
+        """
+        with self._submissions_lock:
+            if self._submissions is not None:
+                raise Error('submission queue already enabled')
+            self._submissions = SubmissionQueue(self,
+                                                max_pending=max_pending,
+                                                workers=workers,
+                                                block=block)
+            return self._submissions
+
+    def _submission_queue(self):
+        """ return the submission queue, creating a default one if needed """
+        with self._submissions_lock:
+            if self._submissions is None:
+                self._submissions = SubmissionQueue(self)
+            return self._submissions
+
+    @util.positional(3)
+    def submit_grant_user_product(self, credential, product,
+                                  product_quantity=1, callback=None):
+        """ queue a grant of a user product, return a Future """
+        return self._submission_queue().submit(
+            'grant', credential, product, product_quantity,
+            callback=callback)
+
+    @util.positional(4)
+    def submit_grant_character_product(self, credential, character_id,
+                                       product, product_quantity=1,
+                                       callback=None):
+        """ queue a grant of a character product, return a Future """
+        return self._submission_queue().submit(
+            'grant', credential, product, product_quantity,
+            character_id=character_id, callback=callback)
+
+    @util.positional(3)
+    def submit_consume_user_product(self, credential, product,
+                                    product_quantity=1, callback=None):
+        """ queue a consume of a user product, return a Future """
+        return self._submission_queue().submit(
+            'consume', credential, product, product_quantity,
+            callback=callback)
+
+    @util.positional(4)
+    def submit_consume_character_product(self, credential, character_id,
+                                         product, product_quantity=1,
+                                         callback=None):
+        """ queue a consume of a character product, return a Future """
+        return self._submission_queue().submit(
+            'consume', credential, product, product_quantity,
+            character_id=character_id, callback=callback)
+
+    @util.positional(4)
+    def submit_purchase_item(self, credential, item, item_price,
+                             item_quantity=1, username=None, callback=None):
+        """Queue a purchase_item() and return a Future right away.
+
+        The local checks (scope, balance ledger, username lookup) run
+        before queuing and raise as for purchase_item(); pass username to
+        avoid a user_info() call.  Without hold URLs, the Future's result
+        is a tuple of the balance and product count Gloebit returned.
+        With a HoldTable, it is the PendingHold, which settles when
+        Gloebit consumes or cancels the hold.
+        """
+        transaction = self.item_transaction(credential, item, item_price,
+                                            item_quantity, username)
+        return self._submit_transaction(credential, transaction, callback)
+
+    @util.positional(3)
+    def submit_purchase_user_product(self, credential, product,
+                                     product_quantity=1, username=None,
+                                     callback=None):
+        """ queue a purchase of a user product, return a Future """
+        transaction = self.product_transaction(credential, product,
+                                               product_quantity, None,
+                                               username)
+        return self._submit_transaction(credential, transaction, callback)
+
+    @util.positional(4)
+    def submit_purchase_character_product(self, credential, character_id,
+                                          product, product_quantity=1,
+                                          username=None, callback=None):
+        """ queue a purchase of a character product, return a Future """
+        transaction = self.product_transaction(credential, product,
+                                               product_quantity,
+                                               character_id, username)
+        return self._submit_transaction(credential, transaction, callback)
+
+    def _submit_transaction(self, credential, transaction, callback):
+        """ queue a transaction, held if a HoldTable is configured """
+        queue = self._submission_queue()
+        if self.holds is None:
+            return queue.submit_transaction(credential, transaction,
+                                            callback=callback)
+        transaction.update(self.holds.urls(transaction['id']))
+        hold = self.holds.add(transaction)
+        if callback is not None:
+            hold.add_done_callback(callback)
+        holds = self.holds
+        queue.submit_transaction(
+            credential, transaction,
+            callback=lambda posted: holds.posted(hold, posted))
+        return hold
+
+    @util.positional(1)
+    def drain_submissions(self, timeout=None, close=False):
+        """Wait for queued grants, consumes and purchases to be sent.
+
+        Args:
+          timeout: float, Seconds to wait.  None waits forever.
+          close: Boolean, Set to True at shutdown to also stop the
+            worker threads.  Later submissions start a new queue.
+
+        Returns:
+          True if the queue emptied, False on timeout.
+        """
+        with self._submissions_lock:
+            submissions = self._submissions
+            if close:
+                self._submissions = None
+        if submissions is None:
+            return True
+        if close:
+            return submissions.close(timeout=timeout)
+        return submissions.drain(timeout=timeout)
+
+class MerchantRegistry(object):
+    """Keeps one shared Gloebit object per merchant.
+
+    For multi-tenant services that would otherwise build a Gloebit per
+    tenant per request.  Objects are built once, with parsed secrets and
+    precomputed endpoints, and shared between threads; callers must not
+    modify them.  Merchants are keyed by client id and secret, so changed
+    secrets get a new Gloebit.  The least recently used merchants are
+    dropped when more than max_merchants are held.  Merchants loaded from
+    a client secrets file are rebuilt when the file's mtime changes.
+
+    Rate limiters, balance ledgers, catalogs, hold tables and snapshots
+    hold one merchant's state, so they are not accepted as shared Gloebit
+    arguments; give a factory for each instead, which is called with the
+    merchant's ClientSecrets when its Gloebit is built.
+    """
+
+    PER_MERCHANT = ('rate_limiter', 'balance_ledger', 'catalog', 'holds',
+                    'snapshot')
+
+    @util.positional(1)
+    def __init__(self, max_merchants=128, factories=None, **gloebit_kwargs):
+        """Create a MerchantRegistry.
+
+        Args:
+          max_merchants: integer, Most Gloebit objects to keep.
+          factories: dict, Maps per-merchant Gloebit arguments (see
+            PER_MERCHANT) to a function taking the merchant's
+            ClientSecrets and returning that merchant's own object, e.g.
+            {'catalog': lambda secrets: catalogs[secrets.client_id]}.
+          gloebit_kwargs: Keyword arguments shared by every Gloebit
+            constructed, e.g. scope, secret_key or pool_manager.
+
+        Raises:
+          ValueError if gloebit_kwargs has a per-merchant argument, or
+          factories has an argument that is not per-merchant.
+        """
+        factories = dict(factories or {})
+        shared = [name for name in self.PER_MERCHANT
+                  if gloebit_kwargs.get(name) is not None]
+        if shared:
+            raise ValueError('%s must not be shared between merchants; '
+                             'pass factories instead' % ', '.join(shared))
+        unknown = [name for name in factories
+                   if name not in self.PER_MERCHANT]
+        if unknown:
+            raise ValueError('no per-merchant argument %s' %
+                             ', '.join(unknown))
+        self.max_merchants = max_merchants
+        self._factories = factories
+        self._gloebit_kwargs = gloebit_kwargs
+        self._lock = threading.Lock()
+        self._merchants = collections.OrderedDict()
+        self._files = {}
+
+    def get(self, client_secrets):
+        """ return the shared Gloebit for client_secrets """
+        key = (client_secrets.client_id, client_secrets.client_secret)
+        with self._lock:
+            merchant = self._merchants.pop(key, None)
+            if merchant is None:
+                merchant = self._build(client_secrets)
+            self._store(key, merchant)
+            return merchant
+
+    @util.positional(2)
+    def get_from_file(self, filename, redirect_uri=None, _sandbox=False):
+        """Return the shared Gloebit for a client secrets JSON file.
+
+        The file is parsed on first use and again only when its mtime
+        changes; the Gloebit built from the old secrets is then dropped.
+        """
+        mtime = os.stat(filename).st_mtime
+        with self._lock:
+            loaded = self._files.get(filename)
+            if loaded is not None and loaded[0] == mtime:
+                merchant = self._merchants.pop(loaded[1], None)
+                if merchant is not None:
+                    self._store(loaded[1], merchant)
+                    return merchant
+
+        client_secrets = ClientSecrets.from_file(filename,
+                                                 redirect_uri=redirect_uri,
+                                                 _sandbox=_sandbox)
+        key = (client_secrets.client_id, client_secrets.client_secret)
+        merchant = self._build(client_secrets)
+        with self._lock:
+            loaded = self._files.get(filename)
+            if loaded is not None:
+                self._merchants.pop(loaded[1], None)
+            self._merchants.pop(key, None)
+            self._store(key, merchant)
+            self._files[filename] = (mtime, key)
+        return merchant
+
+    def discard(self, client_id):
+        """ drop the merchants with client_id, if held """
+        with self._lock:
+            for key in [key for key in self._merchants
+                        if key[0] == client_id]:
+                del self._merchants[key]
+
+    def _build(self, client_secrets):
+        """ construct a Gloebit with shared and per-merchant arguments """
+        kwargs = dict(self._gloebit_kwargs)
+        for name, factory in self._factories.items():
+            kwargs[name] = factory(client_secrets)
+        return Gloebit(client_secrets, **kwargs)
+
+    def _store(self, key, merchant):
+        """ insert as most recently used and evict; lock must be held """
+        self._merchants[key] = merchant
+        while len(self._merchants) > self.max_merchants:
+            self._merchants.popitem(last=False)
+
+    def __len__(self):
+        return len(self._merchants)
+
+class Future(object):
+    """Result of a request sent by a background worker."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._traceback = None
+        self._callbacks = []
+
+    def done(self):
+        """ return True once the result or exception is set """
+        return self._done.is_set()
+
+    @util.positional(1)
+    def result(self, timeout=None):
+        """Wait for and return the result.
+
+        Raises:
+          The request's exception, if it failed.
+          Error if timeout expired first.
+        """
+        if not self._done.wait(timeout):
+            raise Error('timed out waiting for result')
+        if self._exception is not None:
+            # With the worker's traceback, when it was set while handling.
+            raise type(self._exception), self._exception, self._traceback
+        return self._result
+
+    @util.positional(1)
+    def exception(self, timeout=None):
+        """ wait for and return the request's exception, or None """
+        if not self._done.wait(timeout):
+            raise Error('timed out waiting for result')
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """ call callback(future) when done, or now if already done """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        """ set the result and run callbacks """
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        """ set the exception and run callbacks """
+        self._exception = exception
+        if sys.exc_info()[1] is exception:
+            self._traceback = sys.exc_info()[2]
+        self._finish()
+
+    def _finish(self):
+        """ mark done and run callbacks """
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOGGER.exception('Gloebit future callback %r failed',
+                                 callback)
+
+class SubmissionQueue(object):
+    """Bounded queue of grants, consumes and purchases sent by workers.
+
+    Grants of the same product to the same user or character that are
+    still waiting in the queue are coalesced into one request for the
+    summed count.  All coalesced submitters share the same Future, whose
+    result is the product count Gloebit returned.  Consumes are never
+    coalesced, since one failing consume would fail the others.
+    """
+
+    def __init__(self, gloebit, max_pending=1000, workers=2, block=True):
+        self._gloebit = gloebit
+        self._queue = Queue.Queue(max_pending)
+        self._block = block
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._coalescing = {}
+        self._unfinished = 0
+        self._num_workers = workers
+        self._workers = []
+        self._closed = False
+        self._stopping = threading.Event()
+
+    @util.positional(5)
+    def submit(self, kind, credential, product, product_quantity,
+               character_id=None, callback=None):
+        """Queue a 'grant' or 'consume' request.
+
+        Returns:
+          A Future for the new product count.
+
+        Raises:
+          SubmissionQueueFullError if the queue is full and not blocking.
+          Error if the queue has been closed.
+        """
+        key = None
+        if kind == 'grant':
+            key = (credential.access_token, character_id, product)
+        with self._lock:
+            if self._closed:
+                raise Error('submission queue is closed')
+            self._start_workers()
+            entry = self._coalescing.get(key) if key else None
+            if entry is not None:
+                entry['quantity'] += product_quantity
+            else:
+                entry = {'kind': kind,
+                         'key': key,
+                         'credential': credential,
+                         'character_id': character_id,
+                         'product': product,
+                         'quantity': product_quantity,
+                         'future': Future()}
+                try:
+                    self._queue.put_nowait(entry)
+                except Queue.Full:
+                    entry = None
+                else:
+                    self._unfinished += 1
+                    if key:
+                        self._coalescing[key] = entry
+        if entry is None:
+            # Wait for room outside the lock so workers can make progress.
+            if not self._block:
+                raise SubmissionQueueFullError
+            entry = {'kind': kind,
+                     'key': None,
+                     'credential': credential,
+                     'character_id': character_id,
+                     'product': product,
+                     'quantity': product_quantity,
+                     'future': Future()}
+            with self._lock:
+                self._unfinished += 1
+            self._queue.put(entry)
+        future = entry['future']
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    @util.positional(3)
+    def submit_transaction(self, credential, transaction, callback=None):
+        """Queue a transaction for Gloebit's transact endpoint.
+
+        Returns:
+          A Future for the tuple of the balance and product count.
+
+        Raises:
+          As for submit().
+        """
+        entry = {'kind': 'transact',
+                 'key': None,
+                 'credential': credential,
+                 'transaction': transaction,
+                 'future': Future()}
+        with self._lock:
+            if self._closed:
+                raise Error('submission queue is closed')
+            self._start_workers()
+            self._unfinished += 1
+        try:
+            self._queue.put(entry, self._block)
+        except Queue.Full:
+            with self._lock:
+                self._unfinished -= 1
+                if self._unfinished == 0:
+                    self._idle.notify_all()
+            raise SubmissionQueueFullError
+        future = entry['future']
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def _start_workers(self):
+        """ start worker threads, called with the lock held """
+        while len(self._workers) < self._num_workers:
+            worker = threading.Thread(target=self._work,
+                                      name='gloebit-submit-%d' %
+                                      len(self._workers))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        """ worker thread main loop """
+        while True:
+            if self._stopping.is_set():
+                try:
+                    entry = self._queue.get_nowait()
+                except Queue.Empty:
+                    return
+            else:
+                entry = self._queue.get()
+            if entry is None:
+                return
+            with self._lock:
+                if self._coalescing.get(entry['key']) is entry:
+                    del self._coalescing[entry['key']]
+            future = entry['future']
+            try:
+                if self._stopping.is_set():
+                    # Left queued when close() gave up waiting.
+                    raise Error('submission queue is closed')
+                count = self._send(entry)
+            except Exception as exn:
+                # Handed to the submitter through the Future.
+                future.set_exception(exn)
+            else:
+                future.set_result(count)
+            with self._lock:
+                self._unfinished -= 1
+                if self._unfinished == 0:
+                    self._idle.notify_all()
+
+    def _send(self, entry):
+        """ send a queued request, returning Gloebit's reply """
+        merchant = self._gloebit
+        if entry['kind'] == 'transact':
+            return merchant.send_transaction(
+                entry['credential'].access_token, entry['transaction'])
+        if entry['kind'] == 'consume':
+            return merchant.consume_product(
+                entry['credential'], entry['character_id'],
+                entry['product'], product_quantity=entry['quantity'])
+        if entry['character_id'] is None:
+            return merchant.grant_user_product(
+                entry['credential'], entry['product'],
+                product_quantity=entry['quantity'])
+        return merchant.grant_character_product(
+            entry['credential'], entry['character_id'], entry['product'],
+            product_quantity=entry['quantity'])
+
+    @util.positional(1)
+    def drain(self, timeout=None):
+        """ wait until every queued request is done; False on timeout """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._unfinished:
+                if deadline is None:
+                    self._idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._idle.wait(remaining)
+        return True
+
+    @util.positional(1)
+    def close(self, timeout=None):
+        """Refuse new requests, drain, and stop the worker threads.
+
+        Requests still queued when the timeout passes are failed with
+        Error rather than sent.  Returns False on timeout.
+        """
+        with self._lock:
+            self._closed = True
+        drained = self.drain(timeout=timeout)
+        with self._lock:
+            workers, self._workers = self._workers, []
+        self._stopping.set()
+        for _ in workers:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                # Workers empty the queue and return once it is empty.
+                break
+        return drained
+
+class CallExecutor(object):
+    """Worker threads running calls for Futures, for concurrent fan-out.
+
+    Workers are started as calls arrive, up to `workers`; further calls
+    wait in the queue.  Calls must not wait on other calls submitted to
+    the same executor, or they may wait forever.
+    """
+
+    def __init__(self, workers=16):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+
+    def submit(self, function, *args, **kwargs):
+        """ queue function(*args, **kwargs), return a Future """
+        future = Future()
+        with self._lock:
+            if self._idle <= 0 and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='gloebit-call-%d' %
+                                          len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            else:
+                self._idle -= 1
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def _work(self):
+        """ worker thread main loop """
+        while True:
+            future, function, args, kwargs = self._queue.get()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as exn:
+                # Handed to the caller through the Future.
+                future.set_exception(exn)
+            else:
+                future.set_result(result)
+            with self._lock:
+                self._idle += 1
+
+_DEFAULT_CALL_EXECUTOR = []
+# Module locks may predate gevent or eventlet monkey-patching.  They are
+# held only while creating an object, never across I/O or a wait, so a
+# greenlet cannot yield while holding one.
+_DEFAULT_CALL_EXECUTOR_LOCK = threading.Lock()
+
+def default_call_executor():
+    """Return the process-wide CallExecutor, creating it on first use.
+
+    One created before gevent or eventlet monkey-patching is replaced, so
+    cooperative callers get greenlet workers.
+    """
+    with _DEFAULT_CALL_EXECUTOR_LOCK:
+        if not _DEFAULT_CALL_EXECUTOR or \
+                predates_patching(_DEFAULT_CALL_EXECUTOR[0]):
+            _DEFAULT_CALL_EXECUTOR[:] = [CallExecutor()]
+        return _DEFAULT_CALL_EXECUTOR[0]
+
+class PendingHold(Future):
+    """Purchase waiting for Gloebit to settle it through hold URLs.
+
+    result() returns the transaction id once Gloebit consumes the hold.
+    It raises HoldCanceledError if Gloebit cancels the hold or it
+    expires, or the error of the transact request if that failed.
+
+    Attributes:
+      transaction_id: string, Id of the transaction.
+      transaction: dictionary, The transaction sent to Gloebit.
+      state: string, 'submitted', 'enacted', 'consumed', 'canceled',
+        'expired' or 'failed'.
+      created: float, Time the hold was added.
+      balance: float, Balance in Gloebit's reply to the transaction, once
+        it has replied.
+    """
+
+    def __init__(self, transaction):
+        Future.__init__(self)
+        self.transaction_id = transaction['id']
+        self.transaction = transaction
+        self.state = 'submitted'
+        self.created = time.time()
+        self.balance = None
+
+class HoldTable(object):
+    """Pending purchases settled by Gloebit calling hold URLs.
+
+    With hold URLs in a transaction, Gloebit holds the user's G$ and then
+    calls back: the enact URL asks the merchant to deliver the asset,
+    after which the consume URL completes the purchase, or the cancel
+    URL rolls it back.  The table builds those URLs, signed with the
+    merchant's secret so that only Gloebit (which sees them) can use
+    them, and answers the callbacks; gloebit_flask.hold_blueprint()
+    serves them.
+
+    Callbacks are idempotent, since Gloebit may retry them.  Callbacks
+    for holds this table does not know are refused for enact, and
+    acknowledged for consume and cancel, as there is nothing left to do.
+    Holds are forgotten max_age seconds after they were added.  Those
+    still unsettled then expire instead: an enacted asset is taken back
+    with the cancel callback, and the expired hold is kept for another
+    max_age, so that a late consume is refused rather than acknowledged.
+
+    This table keeps holds in the memory of the process that added them.
+    Use it only when that same process serves the hold endpoints, and
+    expect a restart to lose every unsettled hold.  With several
+    processes, or to survive restarts, use gloebit_holds.SharedHoldTable,
+    which keeps holds in a SQLite database.
+    """
+
+    @util.positional(3)
+    def __init__(self, base_url, secret, enact=None, cancel=None,
+                 max_age=3600.0):
+        """Create a HoldTable.
+
+        Args:
+          base_url: string, Absolute URL the hold endpoints are served
+            under, e.g. 'https://example.com/gloebit/hold'.
+          secret: string, Key for signing hold URLs, e.g. the app's
+            secret key.
+          enact: callable, Called as enact(hold) to deliver the asset.
+            A false return or an exception refuses the hold.  If None,
+            every hold is enacted.
+          cancel: callable, Called as cancel(hold) when Gloebit cancels
+            a hold that was enacted, to take the asset back.
+          max_age: float, Seconds a hold is kept.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.secret = secret
+        self.enact_callback = enact
+        self.cancel_callback = cancel
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._holds = collections.OrderedDict()
+        # Holds that expired unsettled, oldest first.
+        self._expired = collections.OrderedDict()
+
+    def _signature(self, transaction_id):
+        """ return the signature of a transaction id """
+        return hmac.new(self.secret, transaction_id,
+                        hashlib.sha256).hexdigest()
+
+    def urls(self, transaction_id):
+        """ return the hold URL fields of a transaction """
+        query = '?' + urllib.urlencode(
+            {'id': transaction_id, 'sig': self._signature(transaction_id)})
+        return {
+            'asset-enact-hold-url':   self.base_url + '/enact' + query,
+            'asset-consume-hold-url': self.base_url + '/consume' + query,
+            'asset-cancel-hold-url':  self.base_url + '/cancel' + query,
+        }
+
+    def add(self, transaction):
+        """ add a transaction about to be sent, return its PendingHold """
+        self.expire()
+        hold = PendingHold(transaction)
+        self._store(hold)
+        return hold
+
+    def get(self, transaction_id):
+        """ return the PendingHold for a transaction id, or None """
+        with self._lock:
+            return self._holds.get(transaction_id) or \
+                self._expired.get(transaction_id)
+
+    def pending(self):
+        """ return the number of holds not yet settled """
+        with self._lock:
+            return sum(1 for hold in self._holds.values() if not hold.done())
+
+    def posted(self, hold, posted):
+        """ record the outcome of sending the hold's transaction """
+        exn = posted.exception()
+        if exn is None:
+            self._set_balance(hold, posted.result()[0])
+        elif self._transition(hold.transaction_id, 'submitted', 'failed'):
+            self._settle(hold.transaction_id, exn)
+        elif self._transition(hold.transaction_id, 'enacted', 'failed'):
+            # Delivered, but Gloebit did not take the payment.
+            self._take_back(hold)
+            self._settle(hold.transaction_id, exn)
+
+    def _take_back(self, hold):
+        """ undo an enacted hold's delivery with the cancel callback """
+        if self.cancel_callback is None:
+            return
+        try:
+            self.cancel_callback(hold)
+        except Exception:
+            LOGGER.exception('Gloebit hold %s: cancel callback failed',
+                             hold.transaction_id)
+
+    def _verified(self, transaction_id, signature):
+        """ return the hold for a correctly signed id, or raise """
+        if not transaction_id or not signature or not hmac.compare_digest(
+                self._signature(transaction_id), str(signature)):
+            raise CrossSiteError('bad hold signature')
+        return self.get(transaction_id)
+
+    def _state(self, transaction_id):
+        """ return a hold's current state, 'forgotten' if unknown """
+        hold = self.get(transaction_id)
+        return hold.state if hold is not None else 'forgotten'
+
+    def enact(self, transaction_id, signature):
+        """Answer Gloebit's enact callback.
+
+        Returns:
+          Tuple of True if the asset was delivered, and a reason.
+        """
+        hold = self._verified(transaction_id, signature)
+        if hold is None:
+            return False, 'unknown hold'
+        if hold.state == 'enacted':
+            return True, 'already enacted'
+        if hold.state != 'submitted':
+            return False, 'hold is ' + hold.state
+        try:
+            if self.enact_callback is not None and \
+                    not self.enact_callback(hold):
+                return False, 'refused'
+        except Exception as exn:
+            LOGGER.exception('Gloebit hold %s: enact callback failed',
+                             hold.transaction_id)
+            return False, str(exn)
+        if not self._transition(transaction_id, 'submitted', 'enacted'):
+            state = self._state(transaction_id)
+            if state == 'enacted':
+                return True, 'already enacted'
+            # Canceled while the asset was being delivered: take it back.
+            self._take_back(hold)
+            return False, 'hold is ' + state
+        return True, 'enacted'
+
+    def consume(self, transaction_id, signature):
+        """ answer Gloebit's consume callback; return (success, reason) """
+        hold = self._verified(transaction_id, signature)
+        if hold is None:
+            return True, 'unknown hold'
+        if not self._transition(transaction_id, 'enacted', 'consumed'):
+            state = self._state(transaction_id)
+            if state == 'consumed':
+                return True, 'already consumed'
+            return False, 'hold is ' + state
+        self._settle(transaction_id)
+        return True, 'consumed'
+
+    def cancel(self, transaction_id, signature):
+        """ answer Gloebit's cancel callback; return (success, reason) """
+        hold = self._verified(transaction_id, signature)
+        if hold is None:
+            return True, 'unknown hold'
+        if self._transition(transaction_id, 'enacted', 'canceled'):
+            self._take_back(hold)
+        elif not self._transition(transaction_id, 'submitted', 'canceled'):
+            state = self._state(transaction_id)
+            if state == 'consumed':
+                return False, 'hold is consumed'
+            return True, 'already ' + state
+        self._settle(transaction_id, HoldCanceledError('canceled by Gloebit'))
+        return True, 'canceled'
+
+    def expire(self):
+        """ forget old holds, expiring those never settled """
+        cutoff = time.time() - self.max_age
+        expired = []
+        with self._lock:
+            while self._holds:
+                hold = next(self._holds.itervalues())
+                if hold.created >= cutoff:
+                    break
+                del self._holds[hold.transaction_id]
+                if hold.state in ('submitted', 'enacted'):
+                    expired.append((hold, hold.state))
+                    hold.state = 'expired'
+                    self._expired[hold.transaction_id] = hold
+            while self._expired:
+                hold = next(self._expired.itervalues())
+                if hold.created >= cutoff - self.max_age:
+                    break
+                del self._expired[hold.transaction_id]
+        for hold, state in expired:
+            if state == 'enacted':
+                self._take_back(hold)
+            hold.set_exception(HoldCanceledError('hold expired'))
+
+    def _store(self, hold):
+        """ keep a new hold """
+        with self._lock:
+            self._holds[hold.transaction_id] = hold
+
+    def _transition(self, transaction_id, old, new):
+        """ change a hold's state from old to new; False if it was not old """
+        with self._lock:
+            hold = self._holds.get(transaction_id)
+            if hold is None or hold.state != old:
+                return False
+            hold.state = new
+            return True
+
+    def _set_balance(self, hold, balance):
+        """ record the balance in Gloebit's reply to the transaction """
+        hold.balance = balance
+
+    def _settle(self, transaction_id, exception=None):
+        """ complete a hold's future: consumed, or failed with exception """
+        hold = self.get(transaction_id)
+        if hold is None:
+            return
+        if exception is None:
+            hold.set_result(transaction_id)
+        else:
+            hold.set_exception(exception)
+
+class ProductCatalog(object):
+    """Merchant's product list, indexed by name and refreshed periodically.
+
+    This client has no Gloebit endpoint for listing a merchant's
+    products, so the list comes from a loader callable: e.g. one reading
+    the list the merchant maintains on the Gloebit Merchant Tools page
+    from a file, or a static list.  The loader returns an iterable of
+    product names or of dictionaries with at least a 'name' and
+    optionally a 'price' in G$.
+
+    The list is loaded on first use.  start_refresh() reloads it from a
+    background thread; if a reload fails, the previous list is kept.
+    """
+
+    @util.positional(2)
+    def __init__(self, loader, refresh_interval=300.0):
+        """Create a ProductCatalog.
+
+        Args:
+          loader: callable returning the merchant's products.
+          refresh_interval: float, Seconds between background reloads.
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self._lock = threading.Lock()
+        self._products = None
+        self._names = None
+        self._refresher = None
+
+    @staticmethod
+    def from_list(products):
+        """ return a catalog of a fixed list of names or dictionaries """
+        products = list(products)
+        return ProductCatalog(lambda: products)
+
+    def load(self):
+        """ (re)load the product list now """
+        products = collections.OrderedDict()
+        for product in self.loader():
+            if not isinstance(product, dict):
+                product = {'name': product}
+            products[product['name']] = product
+        # Replace both indexes at once; readers never lock.
+        self._products, self._names = products, products.keys()
+        self.loaded_at = time.time()
+
+    def _index(self):
+        """ return the name index, loading it on first use """
+        if self._products is None:
+            with self._lock:
+                if self._products is None:
+                    self.load()
+        return self._products
+
+    def names(self):
+        """ return the product names, in loader order """
+        self._index()
+        return self._names
+
+    def get(self, name, default=None):
+        """ return the product dictionary for name """
+        return self._index().get(name, default)
+
+    def __contains__(self, name):
+        return name in self._index()
+
+    def price(self, name):
+        """ return the product's price, or None if unknown """
+        product = self._index().get(name)
+        if product is None:
+            return None
+        return product.get('price')
+
+    def validate(self, name):
+        """Check that name is in the catalog.
+
+        Raises:
+          UnknownProductError if it is not.
+        """
+        if name not in self._index():
+            raise UnknownProductError('unknown product: %s' % name)
+
+    def start_refresh(self):
+        """ reload every refresh_interval seconds from a daemon thread """
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               name='gloebit-catalog')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        """ background reload loop """
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.load()
+            except Exception:
+                # Keep serving the previous list until a reload works.
+                LOGGER.exception('Gloebit product catalog reload failed')
+
+class BalanceLedger(object):
+    """Locally known user balances, for refusing unaffordable purchases.
+
+    Balances are recorded from user_balance() and from the balance every
+    transaction response carries, keyed by access token.  A purchase is
+    refused locally only when a recorded balance younger than max_age is
+    below its cost; with no fresh balance, or no known price, Gloebit
+    decides as usual.  Balances can only be stale on the low side when
+    the user adds funds elsewhere, which max_age bounds.
+    """
+
+    @util.positional(1)
+    def __init__(self, max_age=60.0, max_users=10000, prices=None):
+        """Create a BalanceLedger.
+
+        Args:
+          max_age: float, Seconds a recorded balance is trusted.
+          max_users: integer, Most balances kept; the least recently
+            updated are dropped first.
+          prices: dictionary, Known product prices in G$, by product name,
+            for checking purchase_user_product() and
+            purchase_character_product().
+        """
+        self.max_age = max_age
+        self.max_users = max_users
+        self.prices = dict(prices or {})
+        self._lock = threading.Lock()
+        self._balances = collections.OrderedDict()
+
+    def update(self, access_token, balance):
+        """ record the user's balance as of now """
+        with self._lock:
+            self._balances.pop(access_token, None)
+            self._balances[access_token] = (balance, time.time())
+            while len(self._balances) > self.max_users:
+                self._balances.popitem(last=False)
+
+    def forget(self, access_token):
+        """ drop the user's recorded balance """
+        with self._lock:
+            self._balances.pop(access_token, None)
+
+    def balance(self, access_token):
+        """ return the user's fresh recorded balance, or None """
+        with self._lock:
+            entry = self._balances.get(access_token)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            return None
+        return entry[0]
+
+    def price(self, product):
+        """ return the known price of product, or None """
+        return self.prices.get(product)
+
+    def check(self, access_token, cost):
+        """Refuse a purchase the user clearly cannot afford.
+
+        Raises:
+          InsufficientFundsError if the fresh recorded balance is below
+            cost.
+        """
+        balance = self.balance(access_token)
+        if balance is not None and cost > balance:
+            raise InsufficientFundsError(
+                'insufficient balance: %s needed, %s available' %
+                (cost, balance))
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second, up to capacity.
+
+    Not thread-safe; RateLimiter serializes access.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self._stamp = time.time()
+
+    def _refill(self, now):
+        """ add tokens for the time elapsed since the last refill """
+        elapsed = now - self._stamp
+        if elapsed > 0:
+            self.tokens = min(self.capacity,
+                              self.tokens + elapsed * self.rate)
+        self._stamp = now
+
+    def wait_time(self, now, floor=0.0):
+        """ seconds until a token can be taken without going below floor """
+        self._refill(now)
+        missing = floor + 1 - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
+    def take(self):
+        """ remove one token """
+        self.tokens -= 1
+
+class RateLimiter(object):
+    """Client-side pacing of outbound Gloebit requests.
+
+    Each endpoint class ('read', 'transact', 'character') may have its own
+    token bucket, and all classes share an optional merchant-wide bucket.
+    Transactions have priority: other classes may not take the last
+    `reserve` fraction of the merchant bucket, so under pressure the
+    remaining budget goes to purchases.
+
+    A request that finds no token is handled according to the mode:
+      'block': sleep until a token is available (at most max_wait seconds,
+        then raise RateLimitError).
+      'reject': raise RateLimitError immediately.
+    acquire_async() waits without blocking the caller and returns a Future.
+    """
+
+    PRIORITY_CLASS = 'transact'
+
+    @util.positional(1)
+    def __init__(self, rates=None, merchant_rate=None, merchant_burst=None,
+                 reserve=0.2, mode='block', max_wait=None):
+        """Create a RateLimiter.
+
+        Args:
+          rates: dictionary, Maps endpoint class to a (rate, burst) tuple,
+            in requests per second.  Classes not listed are not limited
+            individually.
+          merchant_rate: float, Requests per second for all classes
+            together.  None for no merchant-wide limit.
+          merchant_burst: float, Merchant-wide bucket size.  Defaults to
+            merchant_rate.
+          reserve: float, Fraction of the merchant bucket only transactions
+            may use.
+          mode: string, 'block' or 'reject'.
+          max_wait: float, Longest a blocking acquire waits, in seconds.
+
+        Raises:
+          ValueError if mode is unknown, or a bucket could never hold a
+          whole token, e.g. merchant_rate=1 with the default reserve
+          leaves other classes 0.8 of a token.
+        """
+        if mode not in ('block', 'reject'):
+            raise ValueError('mode must be "block" or "reject"')
+        self.mode = mode
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._buckets = {}
+        for endpoint_class, (rate, burst) in (rates or {}).items():
+            self._buckets[endpoint_class] = TokenBucket(rate, burst)
+            if self._buckets[endpoint_class].capacity < 1:
+                raise ValueError('%s burst must be at least 1' %
+                                 endpoint_class)
+        self._merchant = None
+        self._reserve = 0.0
+        if merchant_rate is not None:
+            self._merchant = TokenBucket(merchant_rate, merchant_burst)
+            self._reserve = reserve * self._merchant.capacity
+            if self._merchant.capacity - self._reserve < 1:
+                raise ValueError('merchant_burst * (1 - reserve) must be at '
+                                 'least 1, or only transactions could run')
+
+    def _try_acquire(self, endpoint_class):
+        """ take a token if possible; return 0 or seconds to wait """
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(endpoint_class)
+            wait = 0.0
+            if bucket is not None:
+                wait = bucket.wait_time(now)
+            if self._merchant is not None:
+                floor = 0.0
+                if endpoint_class != self.PRIORITY_CLASS:
+                    floor = self._reserve
+                wait = max(wait, self._merchant.wait_time(now, floor))
+            if wait > 0:
+                return wait
+            if bucket is not None:
+                bucket.take()
+            if self._merchant is not None:
+                self._merchant.take()
+            return 0.0
+
+    @util.positional(2)
+    def acquire(self, endpoint_class, mode=None):
+        """Take a token for a request of endpoint_class.
+
+        Args:
+          endpoint_class: string, 'read', 'transact' or 'character'.
+          mode: string, Overrides the limiter's mode for this call.
+
+        Raises:
+          RateLimitError if no token could be taken.
+        """
+        mode = mode or self.mode
+        deadline = None
+        if self.max_wait is not None:
+            deadline = time.time() + self.max_wait
+        while True:
+            wait = self._try_acquire(endpoint_class)
+            if wait == 0:
+                return
+            if mode == 'reject':
+                raise RateLimitError('%s rate exceeded' % endpoint_class)
+            if deadline is not None:
+                if time.time() + wait > deadline:
+                    raise RateLimitError('%s rate exceeded' % endpoint_class)
+            time.sleep(wait)
+
+    def acquire_async(self, endpoint_class):
+        """Take a token without blocking the caller.
+
+        Returns:
+          A Future that completes once the token is taken, or fails with
+          RateLimitError if max_wait passes first.
+        """
+        future = Future()
+        deadline = None
+        if self.max_wait is not None:
+            deadline = time.time() + self.max_wait
+
+        def attempt():
+            """ try for a token, rescheduling until one is available """
+            wait = self._try_acquire(endpoint_class)
+            if wait == 0:
+                future.set_result(None)
+            elif deadline is not None and time.time() + wait > deadline:
+                future.set_exception(
+                    RateLimitError('%s rate exceeded' % endpoint_class))
+            else:
+                timer = threading.Timer(wait, attempt)
+                timer.daemon = True
+                timer.start()
+
+        attempt()
+        return future
+
+def _check_cooperative(**parts):
+    """ raise Error unless monkey-patched, with parts created after it """
+    if not cooperative():
+        raise Error('cooperative mode needs threading, socket and time '
+                    'monkey-patched by gevent or eventlet first')
+    for name, part in sorted(parts.items()):
+        if predates_patching(part):
+            raise Error('%s was created before monkey-patching' % name)
+
+def _endpoint_name(uri):
+    """ return the Gloebit endpoint name (first path segment) of uri """
+    return urlparse(uri).path.strip('/').split('/', 1)[0]
 
 def _success_check(resp, response_json, exception):
     """Check response and body for success or failure.
@@ -934,11 +2807,45 @@ def _success_check(resp, response_json, exception):
 
     response = json.loads(response_json)
 
-    if 'success' in response.keys():
-        if response['success'] != True:
-            if response['reason'] == 'unknown token2':
-                raise AccessTokenError
-            else:
-                raise exception(response['reason'])
+    if response.get('success', True) != True:
+        if response['reason'] == 'unknown token2':
+            raise AccessTokenError
+        else:
+            raise exception(response['reason'])
 
     return response
+
+def _success_fields(resp, response_json, exception, *fields, **kwargs):
+    """Check response like _success_check(), returning only some fields.
+
+    The parsed response is dropped as soon as the fields are extracted,
+    so callers never hold on to the rest of a large response.
+
+    Args:
+      resp, response_json, exception: As for _success_check().
+      fields: Names of the response fields wanted.
+      optional: Keyword-only sequence, Names among fields that Gloebit
+        may leave out; they are None if missing.
+
+    Returns:
+      The value of the only field, or a tuple of the values of several
+        fields.
+
+    Raises:
+      As for _success_check().
+      exception if a field not in optional is missing or null in a
+        successful response.
+    """
+    optional = kwargs.pop('optional', ())
+    if kwargs:
+        raise TypeError('unexpected arguments: %s' % ', '.join(kwargs))
+    response = _success_check(resp, response_json, exception)
+    values = []
+    for field in fields:
+        value = response.get(field)
+        if value is None and field not in optional:
+            raise exception('Gloebit response has no %r field' % field)
+        values.append(value)
+    if len(values) == 1:
+        return values[0]
+    return tuple(values)
@@ -0,0 +1,119 @@
+"""Read caches for the gloebit module.
+
+SingleFlight: Shares one in-flight call among concurrent callers asking
+  for the same thing, so identical reads reach Gloebit once.
+ValidatorCache: Keeps read-only responses with their ETag or
+  Last-Modified validators, for conditional GETs.
+
+A Gloebit object makes its own of each, unless coalesce_reads or
+conditional_reads is turned off; this module is imported on first use.
+"""
+
+import collections
+import threading
+
+from oauth2client import util
+
+import gloebit
+
+class ValidatorCache(object):
+    """Values of read-only responses, kept with their HTTP validators.
+
+    Entries are keyed by (URI, access token); the URI names the endpoint
+    and character.  Only responses carrying an ETag or Last-Modified
+    header are kept, and a kept value is only reused after Gloebit
+    answers a conditional GET with 304 Not Modified.  The least recently
+    used entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """ return (etag, last_modified, value) for key, or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def store(self, key, resp, value):
+        """ keep value with resp's validators, if it has any """
+        etag = resp.get('etag')
+        last_modified = resp.get('last-modified')
+        with self._lock:
+            self._entries.pop(key, None)
+            if etag is None and last_modified is None:
+                return
+            self._entries[key] = (etag, last_modified, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def conditions(entry):
+        """ return the conditional request headers for an entry """
+        if entry is None:
+            return None
+        if entry[0] is not None:
+            return {'If-None-Match': entry[0]}
+        return {'If-Modified-Since': entry[1]}
+
+class SingleFlight(object):
+    """Shares one call among concurrent callers asking for the same key.
+
+    The first caller for a key runs the call; callers arriving while it is
+    in flight wait for it and get the same result or exception.  Nothing
+    is cached once the call completes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, function):
+        """ run function(), or join an in-flight call for the same key """
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        result = None
+        exception = gloebit.Error('shared call was interrupted')
+        try:
+            result = function()
+            exception = None
+            return result
+        except Exception as exn:
+            exception = exn
+            raise
+        finally:
+            # Also reached on a KeyboardInterrupt, SystemExit or killed
+            # greenlet, so the key never stays in flight; waiters then
+            # get an Error instead.
+            self.finish(key, future, result=result, exception=exception)
+
+    def begin(self, key):
+        """Join the call for key, for callers that cannot block.
+
+        Returns:
+          Tuple of the call's Future and True if the caller is the leader.
+          The leader must run the call and pass its outcome to finish();
+          everyone else waits on, or adds a callback to, the Future.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = gloebit.Future()
+            return future, True
+
+    @util.positional(3)
+    def finish(self, key, future, result=None, exception=None):
+        """ end the leader's call and hand its outcome to the waiters """
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
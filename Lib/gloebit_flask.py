@@ -0,0 +1,374 @@
+"""Flask integration helpers for the gloebit module.
+
+SlowRequestProfiler: Opt-in sampling profiler that saves collapsed
+  stacks (flame graph input) for slow or randomly sampled requests.
+GloebitCallTrace: Records the Gloebit calls made while handling each
+  request, enforces an optional per-request budget, and reports the
+  calls in a Server-Timing response header.
+copy_request_context: Wraps a function to run in the current request's
+  context from another thread, e.g. for Gloebit.call_async().
+hold_blueprint: Endpoints Gloebit calls to enact, consume or cancel
+  held purchases in a gloebit.HoldTable.
+"""
+
+import logging
+import os
+import random
+import re
+import thread
+import threading
+import time
+
+from sys import _current_frames
+
+from flask import Blueprint, g, has_request_context, jsonify
+from flask import request
+from flask import _app_ctx_stack, _request_ctx_stack
+
+from oauth2client import util
+
+import gloebit
+
+LOGGER = logging.getLogger(__name__)
+
+class CallBudgetExceededError(gloebit.Error):
+    """A request tried to exceed its budget of Gloebit calls or time."""
+
+class SlowRequestProfiler(object):
+    """Sampling profiler for slow Flask requests.
+
+    While a request is handled, a background thread samples its stack
+    every `interval` seconds.  When the request finishes, the samples are
+    saved if it took at least `threshold` seconds, or if it was picked by
+    `sample_rate`; otherwise they are dropped.
+
+    Profiles are written to `directory` in collapsed-stack format, one
+    "frame;frame;...;frame count" line per distinct stack, ready for
+    flamegraph.pl or speedscope.  The root frame is the route
+    ('route:/main'); samples taken during a Gloebit call get a
+    'gloebit:<endpoint>' frame under it.  Functions the request runs on
+    other threads through copy_request_context(), such as calls passed
+    to Gloebit.call_async(), are sampled too, under a 'thread:<name>'
+    frame.  File names carry the route, the duration and the Gloebit
+    endpoints called.  The sampler thread sleeps while no request is
+    being profiled.
+
+    The sampler reads OS thread stacks, so it cannot see greenlets and
+    refuses to run under gevent or eventlet monkey-patching.
+    """
+
+    @util.positional(2)
+    def __init__(self, app=None, merchants=(), directory='profiles',
+                 threshold=0.5, sample_rate=0.0, interval=0.005):
+        """Create a SlowRequestProfiler.
+
+        Args:
+          app: Flask application to profile.  May be given later to
+            init_app().
+          merchants: Gloebit objects whose calls are tagged in profiles.
+          directory: string, Where profiles are written.
+          threshold: float, Requests at least this many seconds long are
+            saved.
+          sample_rate: float, Fraction of all other requests to save.
+          interval: float, Seconds between stack samples.
+
+        Raises:
+          gloebit.Error if threading is monkey-patched (see
+          gloebit.cooperative()).
+        """
+        if gloebit.cooperative():
+            raise gloebit.Error('SlowRequestProfiler cannot sample greenlets')
+        self.directory = directory
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._active = {}
+        self._sampler = None
+        self._saved = 0
+        for merchant in merchants:
+            merchant.add_listener(self)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ start profiling app's requests """
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        """ start sampling the current thread """
+        profile = {'start': time.time(),
+                   'samples': {},
+                   'endpoints': []}
+        g.gloebit_profiler = self
+        with self._lock:
+            self._attach(thread.get_ident(), profile, None)
+
+    def thread_started(self, request_ident):
+        """Sample the current thread into a request's profile.
+
+        Called by copy_request_context() wrappers as they start on
+        another thread, with the ident of the request's thread.
+        """
+        ident = thread.get_ident()
+        with self._lock:
+            owner = self._active.get(request_ident)
+            if owner is not None and ident not in self._active:
+                self._attach(ident, owner['profile'],
+                             threading.current_thread().name)
+
+    def thread_finished(self):
+        """ stop sampling the current thread for another's request """
+        with self._lock:
+            state = self._active.get(thread.get_ident())
+            if state is not None and state['thread'] is not None:
+                del self._active[thread.get_ident()]
+
+    def _attach(self, ident, profile, name):
+        """ sample thread ident into profile; lock must be held """
+        self._active[ident] = {'profile': profile,
+                               'thread': name,
+                               'gloebit': None}
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample,
+                                             name='gloebit-profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+        self._wake.notify()
+
+    def _teardown_request(self, _exc):
+        """ stop sampling and save the profile if it qualifies """
+        with self._lock:
+            state = self._active.get(thread.get_ident())
+            if state is None or state['thread'] is not None:
+                # Not a request thread; copy_request_context() wrappers
+                # also tear down their copy of the request context.
+                return
+            del self._active[thread.get_ident()]
+        profile = state['profile']
+        elapsed = time.time() - profile['start']
+        if elapsed >= self.threshold or random.random() < self.sample_rate:
+            rule = request.url_rule.rule if request.url_rule else request.path
+            self._save(rule, elapsed, profile)
+
+    def call_started(self, call):
+        """ Gloebit listener: tag samples with the endpoint being called """
+        state = self._active.get(thread.get_ident())
+        if state is not None:
+            state['gloebit'] = call['endpoint']
+            state['profile']['endpoints'].append(call['endpoint'])
+
+    def call_finished(self, _call, _elapsed, _error):
+        """ Gloebit listener: the call is over """
+        state = self._active.get(thread.get_ident())
+        if state is not None:
+            state['gloebit'] = None
+
+    def _sample(self):
+        """ sampler thread: record the stack of every active request """
+        while True:
+            with self._lock:
+                while not self._active:
+                    self._wake.wait()
+            time.sleep(self.interval)
+            frames = _current_frames()
+            with self._lock:
+                active = self._active.items()
+            for ident, state in active:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = _collapse(frame)
+                if state['gloebit']:
+                    stack = 'gloebit:%s;%s' % (state['gloebit'], stack)
+                if state['thread']:
+                    stack = 'thread:%s;%s' % (state['thread'], stack)
+                samples = state['profile']['samples']
+                samples[stack] = samples.get(stack, 0) + 1
+            del frames
+
+    def _save(self, rule, elapsed, profile):
+        """ write a profile in collapsed-stack format """
+        with self._lock:
+            self._saved += 1
+            number = self._saved
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tags = [rule] + sorted(set(profile['endpoints']))
+        name = '%s-%d-%d-%s-%dms.collapsed' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(), number,
+            re.sub(r'[^A-Za-z0-9]+', '_', '+'.join(tags)).strip('_'),
+            int(elapsed * 1000))
+        root = 'route:%s' % rule
+        with open(os.path.join(self.directory, name), 'w') as output:
+            for stack, count in sorted(profile['samples'].items()):
+                output.write('%s;%s %d\n' % (root, stack, count))
+
+def _collapse(frame):
+    """ return frame's stack, outermost first, as 'a;b;c' """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+class GloebitCallTrace(object):
+    """Per-request record and budget of Gloebit calls.
+
+    Every Gloebit call made while handling a request is recorded in
+    flask.g.gloebit_calls as (endpoint, seconds, error) tuples, and the
+    response gets a Server-Timing header listing each call and the total.
+
+    With max_calls or max_time set, a call that would go over the
+    request's budget is either refused with CallBudgetExceededError
+    (mode 'raise'), or made anyway and logged as a warning (mode 'log'),
+    which suits catching N+1 regressions in production.
+    """
+
+    @util.positional(2)
+    def __init__(self, app=None, merchants=(), max_calls=None,
+                 max_time=None, mode='raise', server_timing=True):
+        """Create a GloebitCallTrace.
+
+        Args:
+          app: Flask application.  May be given later to init_app().
+          merchants: Gloebit objects whose calls are traced.
+          max_calls: integer, Most Gloebit calls per request, or None.
+          max_time: float, Most seconds spent in Gloebit calls per request,
+            or None.
+          mode: string, 'raise' or 'log'; what to do when over budget.
+          server_timing: Boolean, Set to False to omit the Server-Timing
+            header.
+        """
+        if mode not in ('raise', 'log'):
+            raise ValueError('mode must be "raise" or "log"')
+        self.max_calls = max_calls
+        self.max_time = max_time
+        self.mode = mode
+        self.server_timing = server_timing
+        for merchant in merchants:
+            merchant.add_listener(self)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ trace Gloebit calls made by app's requests """
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    @staticmethod
+    def _before_request():
+        """ start an empty record """
+        g.gloebit_calls = []
+
+    def _after_request(self, response):
+        """ add the Server-Timing header """
+        calls = getattr(g, 'gloebit_calls', None)
+        if self.server_timing and calls:
+            metrics = ['gloebit-%d;desc="%s";dur=%.1f' %
+                       (number, endpoint, 1000 * elapsed)
+                       for number, (endpoint, elapsed, _error)
+                       in enumerate(calls, 1)]
+            metrics.append('gloebit;desc="%d calls";dur=%.1f' %
+                           (len(calls),
+                            1000 * sum(call[1] for call in calls)))
+            response.headers.add('Server-Timing', ', '.join(metrics))
+        return response
+
+    def call_started(self, call):
+        """ Gloebit listener: check the budget before the call """
+        if not has_request_context():
+            return
+        calls = getattr(g, 'gloebit_calls', None)
+        if calls is None:
+            return
+        problem = None
+        if self.max_calls is not None and len(calls) >= self.max_calls:
+            problem = 'more than %d Gloebit calls' % self.max_calls
+        elif self.max_time is not None and \
+                sum(c[1] for c in calls) >= self.max_time:
+            problem = 'more than %.3fs in Gloebit calls' % self.max_time
+        if problem is None:
+            return
+        message = '%s %s: %s (calling %s after %s)' % (
+            request.method, request.path, problem, call['endpoint'],
+            ', '.join(c[0] for c in calls))
+        if self.mode == 'raise':
+            raise CallBudgetExceededError(message)
+        LOGGER.warning(message)
+
+    @staticmethod
+    def call_finished(call, elapsed, error):
+        """ Gloebit listener: record the call """
+        if has_request_context():
+            calls = getattr(g, 'gloebit_calls', None)
+            if calls is not None:
+                calls.append((call['endpoint'], elapsed, error))
+
+def copy_request_context(function):
+    """Wrap function to run in the current request's context elsewhere.
+
+    Like flask.copy_current_request_context(), except that the wrapped
+    function also shares the request's flask.g.  So Gloebit calls made
+    through Gloebit.call_async() are still recorded by GloebitCallTrace
+    and count against the request's budget, and a SlowRequestProfiler
+    samples the thread running the function into the request's profile.
+    """
+    request_context = _request_ctx_stack.top.copy()
+    app = request_context.app
+    request_g = _app_ctx_stack.top.g
+    request_ident = thread.get_ident()
+
+    def wrapper(*args, **kwargs):
+        """ run function in a copy of the request context """
+        profiler = getattr(request_g, 'gloebit_profiler', None)
+        if profiler is not None:
+            profiler.thread_started(request_ident)
+        app_context = app.app_context()
+        app_context.g = request_g
+        try:
+            with app_context:
+                with request_context:
+                    return function(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.thread_finished()
+    return wrapper
+
+def hold_blueprint(holds, name='gloebit_holds'):
+    """Return a Flask blueprint answering Gloebit's hold callbacks.
+
+    Register it at the path of the table's base_url, e.g.
+      app.register_blueprint(hold_blueprint(holds),
+                             url_prefix='/gloebit/hold')
+    for HoldTable('https://example.com/gloebit/hold', ...).
+
+    Args:
+      holds: gloebit.HoldTable, Table of pending holds.
+      name: string, Blueprint name.
+    """
+    blueprint = Blueprint(name, __name__)
+
+    def callback(action):
+        """ return a view answering one kind of callback """
+        def view():
+            """ answer Gloebit with success and reason """
+            try:
+                success, reason = action(request.args.get('id'),
+                                         request.args.get('sig'))
+            except gloebit.CrossSiteError as exn:
+                return jsonify(success=False, reason=str(exn)), 403
+            return jsonify(success=success, reason=reason)
+        return view
+
+    for action in ('enact', 'consume', 'cancel'):
+        blueprint.add_url_rule('/' + action, action,
+                               callback(getattr(holds, action)),
+                               methods=['GET', 'POST'])
+    return blueprint
@@ -0,0 +1,291 @@
+"""Hedged reads for the gloebit module.
+
+Hedger: Sends a duplicate of a read that is slower than most, and uses
+  whichever copy answers first, cutting the slow tail of Gloebit reads.
+CancelToken: Lets the winning copy abandon the loser; the connection
+  pool and HTTP/2 transport accept one with each request.
+
+Typical use:
+  merchant = gloebit.Gloebit(secrets, hedger=gloebit_hedge.Hedger())
+"""
+
+import collections
+import heapq
+import threading
+import time
+
+from oauth2client import util
+
+import gloebit
+
+class CancelToken(object):
+    """Lets one thread abandon a request another thread is sending.
+
+    A transport given a token registers an abort function with watch()
+    while the request is in flight; cancel() calls it, e.g. closing the
+    request's connection, so that the request fails promptly.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._aborts = []
+
+    def cancel(self):
+        """ mark the token cancelled and abort the watched request """
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            aborts, self._aborts = self._aborts, []
+        for abort in aborts:
+            abort()
+
+    def watch(self, abort):
+        """ call abort() on cancel(), or now if already cancelled """
+        with self._lock:
+            if not self.cancelled:
+                self._aborts.append(abort)
+                return
+        abort()
+
+    def unwatch(self, abort):
+        """Stop watching, once the request is over.
+
+        Returns:
+          True if abort was still watched, so it has not run and will
+          not; False if cancel() took it.
+        """
+        with self._lock:
+            if abort in self._aborts:
+                self._aborts.remove(abort)
+                return True
+            return False
+
+class Hedger(object):
+    """Hedges slow reads with a duplicate request; the first answer wins.
+
+    Read tail latency comes from occasional slow responses, not from a slow
+    median.  A hedged read is sent on the calling thread.  If it has not
+    been answered after the endpoint's hedge delay, a worker thread sends
+    a duplicate on another pooled connection (another stream, with an
+    Http2Transport), and whichever answers first is returned.  The delay
+    is the `percentile` of the endpoint's recent latencies, so only the
+    slowest few percent of reads are hedged.  Until an endpoint has
+    min_samples latencies, its delay is max_delay.
+
+    Extra load is capped: each read earns max_extra of a hedge, and a
+    hedge needs a whole one saved, so hedges are at most about max_extra
+    of reads.  A hedge also needs a read token from the merchant's rate
+    limiter, taken without waiting.
+
+    The loser is cancelled through its CancelToken: a duplicate still
+    waiting for a worker is never sent, and a copy in flight has its
+    pooled connection closed (or its HTTP/2 stream reset), instead of
+    holding the connection until Gloebit answers.  A failed copy only
+    wins if no other copy is still running.
+
+    One timer thread sends the hedges, sleeping until the earliest
+    deadline.  Python 2's timed waits poll, so a new read whose deadline
+    is earlier than every pending one may be hedged up to 50 ms late;
+    under gevent or eventlet the wait is exact.
+    """
+
+    @util.positional(1)
+    def __init__(self, percentile=95.0, min_delay=0.005, max_delay=1.0,
+                 max_extra=0.05, burst=10.0, window=500, min_samples=20,
+                 workers=64):
+        """Create a Hedger.
+
+        Args:
+          percentile: float, Percentile of recent latencies after which a
+            read is hedged.
+          min_delay: float, Shortest hedge delay, in seconds.
+          max_delay: float, Longest hedge delay, in seconds.
+          max_extra: float, Most hedges per read, over time.
+          burst: float, Most hedges that may be saved up.
+          window: integer, Recent latencies kept per endpoint.
+          min_samples: integer, Latencies needed before the percentile is
+            used.
+          workers: integer, Most threads sending hedges; further hedges
+            wait for one.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_extra = max_extra
+        self.burst = burst
+        self.window = window
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.denied = 0
+        self._budget = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._samples = {}
+        self._delays = {}
+        self._due = []
+        self._sequence = 0
+        self._timer = None
+        self._executor = gloebit.CallExecutor(workers=workers)
+
+    def call(self, endpoint, send, allow_extra=None):
+        """Run send(), hedging it if it is slow, and return the first answer.
+
+        Args:
+          endpoint: string, Name latencies are kept under.
+          send: callable, Sends one copy of the request and returns the
+            reply.  Called as send(cancel) with a CancelToken, which is
+            cancelled if another copy wins; it should then fail promptly.
+            Must be safe to run twice.
+          allow_extra: callable, If provided, called before hedging; the
+            hedge is skipped unless it returns True.
+
+        Returns:
+          The first reply.
+
+        Raises:
+          The first copy's exception, if every copy sent failed.
+        """
+        race = {'winner': gloebit.Future(), 'running': 0, 'errors': [],
+                'settled': False, 'tokens': []}
+        with self._lock:
+            self.requests += 1
+            self._budget = min(self.burst, self._budget + self.max_extra)
+            delay = self._delays.get(endpoint, self.max_delay)
+            self._sequence += 1
+            deadline = time.time() + delay
+            heapq.heappush(self._due, (deadline, self._sequence, race,
+                                       endpoint, send, allow_extra))
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._timer_loop,
+                                               name='gloebit-hedger')
+                self._timer.daemon = True
+                self._timer.start()
+            if self._due[0][0] == deadline:
+                self._wake.notify()
+            race['running'] += 1
+        self._attempt(race, endpoint, send, False)
+        return race['winner'].result()
+
+    def stats(self):
+        """Return a dictionary of hedging counters.
+
+        requests: Reads sent through the hedger.
+        hedged: Duplicates sent.  hedge_rate is hedged / requests.
+        hedge_wins: Reads answered first by the duplicate.
+        cancelled: Losers never sent.
+        dropped: Losers cancelled in flight, or answered after the winner.
+        denied: Hedges skipped for lack of budget or rate limiter tokens.
+        delays: Current hedge delay per endpoint, in seconds.
+        """
+        with self._lock:
+            return {'requests': self.requests,
+                    'hedged': self.hedged,
+                    'hedge_rate': (float(self.hedged) / self.requests
+                                   if self.requests else 0.0),
+                    'hedge_wins': self.hedge_wins,
+                    'cancelled': self.cancelled,
+                    'dropped': self.dropped,
+                    'denied': self.denied,
+                    'delays': dict(self._delays)}
+
+    def _timer_loop(self):
+        """ timer thread: hedge the reads still unanswered at their delay """
+        while True:
+            with self._lock:
+                while True:
+                    now = time.time()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._wake.wait(self._due[0][0] - now if self._due
+                                    else None)
+                due = []
+                while self._due and self._due[0][0] <= now:
+                    entry = heapq.heappop(self._due)
+                    if not entry[2]['settled']:
+                        due.append(entry[2:])
+            for race, endpoint, send, allow_extra in due:
+                if self._take_hedge(allow_extra):
+                    self._start(race, endpoint, send)
+
+    def _take_hedge(self, allow_extra):
+        """ spend a hedge from the budget; False if none may be sent """
+        with self._lock:
+            if self._budget < 1.0:
+                self.denied += 1
+                return False
+            self._budget -= 1.0
+        if allow_extra is not None and not allow_extra():
+            with self._lock:
+                self._budget += 1.0
+                self.denied += 1
+            return False
+        with self._lock:
+            self.hedged += 1
+        return True
+
+    def _start(self, race, endpoint, send):
+        """ send a hedge from a worker """
+        with self._lock:
+            race['running'] += 1
+        self._executor.submit(self._attempt, race, endpoint, send, True)
+
+    def _attempt(self, race, endpoint, send, hedge):
+        """ send a copy unless the race is over, settle it """
+        token = CancelToken()
+        with self._lock:
+            if race['settled']:
+                race['running'] -= 1
+                self.cancelled += 1
+                return
+            race['tokens'].append(token)
+        start = time.time()
+        try:
+            result = send(token)
+        except Exception as exn:
+            # If every copy fails, the first error is raised to the caller.
+            with self._lock:
+                race['running'] -= 1
+                if race['settled']:
+                    self.dropped += 1
+                    return
+                race['errors'].append(exn)
+                if race['running']:
+                    return
+                race['settled'] = True
+            race['winner'].set_exception(race['errors'][0])
+            return
+        with self._lock:
+            race['running'] -= 1
+            self._record(endpoint, time.time() - start)
+            if race['settled']:
+                self.dropped += 1
+                return
+            race['settled'] = True
+            if hedge:
+                self.hedge_wins += 1
+            losers = [other for other in race['tokens'] if other is not token]
+        race['winner'].set_result(result)
+        for loser in losers:
+            loser.cancel()
+
+    def _record(self, endpoint, latency):
+        """ keep a latency, updating the endpoint's delay now and then """
+        entry = self._samples.get(endpoint)
+        if entry is None:
+            entry = self._samples[endpoint] = [
+                0, collections.deque(maxlen=self.window)]
+        entry[0] += 1
+        entry[1].append(latency)
+        if entry[0] < self.min_samples or \
+                (entry[0] - self.min_samples) % 16:
+            return
+        ordered = sorted(entry[1])
+        index = int(round(self.percentile / 100.0 * (len(ordered) - 1)))
+        self._delays[endpoint] = min(self.max_delay,
+                                     max(self.min_delay, ordered[index]))
@@ -0,0 +1,253 @@
+"""Durable Gloebit hold table shared by an app's processes.
+
+gloebit.HoldTable keeps pending holds in the memory of the process that
+queued the purchases.  A multi-process deployment may route Gloebit's
+enact, consume or cancel callback to any process.  A restart loses every
+hold.  A SharedHoldTable keeps holds in a SQLite database in write-ahead
+log mode instead, so that:
+  - any process opening the same file answers callbacks for holds added
+    by the others, and
+  - holds added before a restart are still enacted, consumed and
+    canceled after it.
+Every state change is a conditional UPDATE.  A callback that Gloebit
+retries, and that two processes answer at once, changes a hold only
+once.  Likewise, when processes expire an unsettled hold at once, only
+one of them takes an enacted asset back.
+
+A PendingHold's result is only available in the process that added it.
+When another process answers the consume or cancel callback, the adding
+process notices on its next poll, every poll_interval seconds, and
+settles the PendingHold then.
+
+Each row holds the transaction id, the JSON transaction (no access
+token), the state, the time it was added and the balance Gloebit
+replied with.
+
+Under gevent or eventlet, SQLite calls are not cooperative: each one
+blocks the event loop while it runs.
+
+Typical use, in every process:
+  holds = SharedHoldTable('https://example.com/gloebit/hold', secret,
+                          '/var/lib/app/gloebit-holds.db')
+  merchant = gloebit.Gloebit(secrets, holds=holds)
+  app.register_blueprint(gloebit_flask.hold_blueprint(holds),
+                         url_prefix='/gloebit/hold')
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from oauth2client import util
+
+import gloebit
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS holds (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    balance REAL
+);
+CREATE INDEX IF NOT EXISTS holds_created ON holds (created);
+'''
+
+# SQLite's default limit on the parameters of one statement is 999.
+_POLL_BATCH = 500
+
+class SharedHoldTable(gloebit.HoldTable):
+    """HoldTable kept in a SQLite database shared by local processes."""
+
+    @util.positional(4)
+    def __init__(self, base_url, secret, filename, enact=None, cancel=None,
+                 max_age=3600.0, poll_interval=0.5):
+        """Open (or create) a shared hold table.
+
+        Args:
+          base_url: string, Absolute URL the hold endpoints are served
+            under, e.g. 'https://example.com/gloebit/hold'.
+          secret: string, Key for signing hold URLs.  Every process
+            sharing the file must use the same one.
+          filename: string, SQLite database file.
+          enact: callable, Called as enact(hold) to deliver the asset.
+            A false return or an exception refuses the hold.  If None,
+            every hold is enacted.
+          cancel: callable, Called as cancel(hold) when Gloebit cancels
+            a hold that was enacted, to take the asset back.
+          max_age: float, Seconds a hold is kept.
+          poll_interval: float, Seconds between checks for holds this
+            process added and another process settled.
+        """
+        gloebit.HoldTable.__init__(self, base_url, secret, enact=enact,
+                                   cancel=cancel, max_age=max_age)
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30.0,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        # Unsettled holds added by this process, by transaction id.
+        self._futures = {}
+        self._stopped = threading.Event()
+        self._poller = None
+
+    def get(self, transaction_id):
+        """ return the PendingHold for a transaction id, or None """
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT payload, state, created, balance FROM holds'
+                ' WHERE id = ?', (transaction_id,)).fetchone()
+        if row is None:
+            return None
+        payload, state, created, balance = row
+        with self._lock:
+            hold = self._futures.get(transaction_id)
+        if hold is None:
+            hold = gloebit.PendingHold(json.loads(payload))
+            hold.created = created
+        hold.state = state
+        hold.balance = balance
+        return hold
+
+    def pending(self):
+        """ return the number of holds not yet settled, in all processes """
+        with self._db_lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM holds WHERE state IN (?, ?)',
+                ('submitted', 'enacted')).fetchone()[0]
+
+    def expire(self):
+        """ forget old holds, expiring those never settled """
+        cutoff = time.time() - self.max_age
+        with self._db_lock:
+            unsettled = self._db.execute(
+                'SELECT id, state FROM holds WHERE created < ?'
+                ' AND state IN (?, ?)',
+                (cutoff, 'submitted', 'enacted')).fetchall()
+        for transaction_id, state in unsettled:
+            # Conditional, so that only one process takes an asset back.
+            if self._transition(transaction_id, state, 'expired') and \
+                    state == 'enacted':
+                hold = self.get(transaction_id)
+                if hold is not None:
+                    self._take_back(hold)
+        with self._db_lock:
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM holds WHERE created < ?'
+                    ' AND (state != ? OR created < ?)',
+                    (cutoff, 'expired', cutoff - self.max_age))
+        with self._lock:
+            expired = [hold for hold in self._futures.values()
+                       if hold.created < cutoff]
+        self._check(expired)
+
+    def close(self):
+        """ stop polling and close the database """
+        self._stopped.set()
+        if self._poller is not None:
+            self._poller.join()
+        with self._db_lock:
+            self._db.close()
+
+    def _store(self, hold):
+        """ insert a new hold and watch it until it settles """
+        with self._db_lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT INTO holds (id, payload, state, created)'
+                    ' VALUES (?, ?, ?, ?)',
+                    (hold.transaction_id, json.dumps(hold.transaction),
+                     hold.state, hold.created))
+        with self._lock:
+            self._futures[hold.transaction_id] = hold
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop,
+                                                name='gloebit-holds')
+                self._poller.daemon = True
+                self._poller.start()
+
+    def _transition(self, transaction_id, old, new):
+        """ change a hold's state from old to new; False if it was not old """
+        with self._db_lock:
+            with self._db:
+                changed = self._db.execute(
+                    'UPDATE holds SET state = ? WHERE id = ? AND state = ?',
+                    (new, transaction_id, old)).rowcount
+        if changed:
+            with self._lock:
+                hold = self._futures.get(transaction_id)
+                if hold is not None:
+                    hold.state = new
+        return bool(changed)
+
+    def _set_balance(self, hold, balance):
+        """ record the balance in Gloebit's reply to the transaction """
+        hold.balance = balance
+        with self._db_lock:
+            with self._db:
+                self._db.execute('UPDATE holds SET balance = ? WHERE id = ?',
+                                 (balance, hold.transaction_id))
+
+    def _settle(self, transaction_id, exception=None):
+        """ complete a hold's future, if this process added it """
+        with self._lock:
+            hold = self._futures.pop(transaction_id, None)
+        if hold is None:
+            return
+        if exception is None:
+            hold.set_result(transaction_id)
+        else:
+            hold.set_exception(exception)
+
+    def _poll_loop(self):
+        """ settle holds that other processes consumed or canceled """
+        while not self._stopped.wait(self.poll_interval):
+            with self._lock:
+                holds = self._futures.values()
+            self._check(holds)
+
+    def _check(self, holds):
+        """ settle those of holds whose stored state is settled """
+        for start in range(0, len(holds), _POLL_BATCH):
+            batch = holds[start:start + _POLL_BATCH]
+            with self._db_lock:
+                states = dict(self._db.execute(
+                    'SELECT id, state FROM holds WHERE id IN (%s)' %
+                    ', '.join('?' * len(batch)),
+                    [hold.transaction_id for hold in batch]).fetchall())
+            self._resolve(batch, states)
+
+    def _resolve(self, holds, states):
+        """Bring this process's holds up to date with their stored states.
+
+        Args:
+          holds: list, PendingHolds added by this process.
+          states: dictionary, Stored state by transaction id.  A hold
+            missing from it was deleted by an expire() elsewhere.
+        """
+        for hold in holds:
+            state = states.get(hold.transaction_id)
+            if state == 'failed':
+                continue    # Set here by posted(), which settles it.
+            if state in ('submitted', 'enacted'):
+                hold.state = state
+                continue
+            if state == 'consumed':
+                exception = None
+            elif state == 'canceled':
+                exception = gloebit.HoldCanceledError('canceled by Gloebit')
+            else:
+                state = 'expired'
+                exception = gloebit.HoldCanceledError('hold expired')
+            with self._lock:
+                if self._futures.pop(hold.transaction_id, None) is None:
+                    continue
+            hold.state = state
+            if exception is None:
+                hold.set_result(hold.transaction_id)
+            else:
+                hold.set_exception(exception)
@@ -0,0 +1,248 @@
+"""HTTP/2 transport for the gloebit module.
+
+Http2Transport sends a Gloebit object's concurrent requests to a host as
+streams on one HTTP/2 connection, instead of one pooled socket per
+request in flight.  It needs the optional hyper package, and falls back
+to the merchant's connection pool without it.
+
+Gloebit(..., http2=True) imports this module and creates the transport.
+"""
+
+import socket
+import threading
+
+from urlparse import urlparse
+
+import gloebit
+
+class Http2Response(dict):
+    """Response headers of an HTTP/2 request, shaped like httplib2.Response.
+
+    Header names are lower case, repeated headers are joined with ', '.
+    """
+
+    def __init__(self, status, headers):
+        dict.__init__(self)
+        for name, value in headers:
+            if name in self:
+                value = self[name] + ', ' + value
+            self[name] = value
+        self.status = status
+        self['status'] = str(status)
+
+class Http2Transport(object):
+    """Multiplexes concurrent Gloebit requests over one HTTP/2 connection.
+
+    An HTTP/1.1 pool needs a socket per request in flight; this transport
+    sends every request to a host as a stream on a single HTTP/2
+    connection.  It needs the optional hyper package.  When hyper is not
+    installed, or a host does not negotiate HTTP/2, requests to that host
+    go to the fallback transport instead (normally the merchant's
+    ConnectionPool).  Plain http URIs are spoken as HTTP/2 with prior
+    knowledge (h2c), which is meant for local test servers.
+
+    hyper 0.7 holds a connection's read lock while it blocks reading the
+    socket.  A request whose reply another thread has already read still
+    waits for that lock, so it only returns once the next frame arrives
+    on the connection.  Under concurrent load, this adds up to about one
+    response time to some requests; see bench/bench_http2.py.
+
+    Attributes:
+      requests: integer, Requests sent over HTTP/2.
+      fallback_requests: integer, Requests sent to the fallback.
+      in_flight: integer, HTTP/2 streams currently open.
+      max_in_flight: integer, Most HTTP/2 streams open at once.
+    """
+
+    # request() takes a cancel argument.
+    cancellable = True
+
+    def __init__(self, fallback):
+        """Create an Http2Transport.
+
+        Args:
+          fallback: Transport used for hosts without HTTP/2.
+        """
+        self.fallback = fallback
+        self.requests = 0
+        self.fallback_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._connections = {}
+        self._http1_hosts = set()
+
+    def _connection(self, scheme, netloc):
+        """ return the connection for a host, or None to use the fallback """
+        key = (scheme, netloc)
+        connection = self._connections.get(key)
+        if connection is not None or key in self._http1_hosts:
+            return connection
+        with self._connect_lock:
+            connection = self._connections.get(key)
+            if connection is not None or key in self._http1_hosts:
+                return connection
+            try:
+                import hyper
+            except ImportError:
+                self._http1_hosts.add(key)
+                return None
+            ssl_context = None
+            if scheme == 'https' and not gloebit.CHECK_SSL_CERT:
+                import ssl
+                from hyper import tls
+                ssl_context = tls.init_context()
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+            connection = hyper.HTTP20Connection(
+                netloc, secure=(scheme == 'https'), ssl_context=ssl_context)
+            try:
+                connection.connect()
+            except AssertionError:
+                # hyper's check that ALPN/NPN selected h2.
+                connection.close()
+                self._http1_hosts.add(key)
+                return None
+            except _http2_errors():
+                # Unreachable for now; let the fallback report it, and try
+                # HTTP/2 again next time.
+                connection.close()
+                return None
+            self._connections[key] = connection
+            return connection
+
+    def _discard(self, key, connection):
+        """ forget a broken connection so the next request reconnects """
+        with self._connect_lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        try:
+            connection.close()
+        except _http2_errors():
+            pass
+
+    def request(self, uri, method='GET', headers=None, body=None,
+                cancel=None):
+        """Send the request as an HTTP/2 stream.
+
+        Args:
+          uri, method, headers, body: The request.
+          cancel: gloebit_hedge.CancelToken, If provided, cancelling it
+            resets the stream (or, on the fallback, closes the
+            connection).  The request fails once the next frame arrives
+            on the connection.
+
+        Returns:
+          Tuple of the response headers and the response body.
+        """
+        parsed = urlparse(uri)
+        connection = self._connection(parsed.scheme, parsed.netloc)
+        if connection is None:
+            with self._lock:
+                self.fallback_requests += 1
+            if cancel is not None and getattr(self.fallback, 'cancellable',
+                                              False):
+                return self.fallback.request(uri, method, headers, body,
+                                             cancel=cancel)
+            return self.fallback.request(uri, method, headers, body)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        abort = None
+        try:
+            stream_id = connection.request(method, path, body=body,
+                                           headers=headers or {})
+            if cancel is not None:
+                abort = lambda: _reset_stream(connection, stream_id)
+                cancel.watch(abort)
+            response = connection.get_response(stream_id)
+            content = response.read()
+            resp = Http2Response(response.status,
+                                 response.headers.iter_raw())
+        except Exception as exn:
+            # Only a broken connection is replaced; a reset stream or a bad
+            # reply leaves the other streams on it running.
+            if _http2_connection_error(exn):
+                self._discard((parsed.scheme, parsed.netloc), connection)
+            raise
+        finally:
+            if abort is not None:
+                cancel.unwatch(abort)
+            with self._lock:
+                self.in_flight -= 1
+        return resp, content
+
+    def warm_up(self, uri, count):
+        """Open the HTTP/2 connection to uri's host.
+
+        Falls back to warming up the fallback's connections for hosts
+        without HTTP/2.
+
+        Returns:
+          Number of connections opened.
+        """
+        parsed = urlparse(uri)
+        if self._connection(parsed.scheme, parsed.netloc) is not None:
+            return 1
+        if hasattr(self.fallback, 'warm_up'):
+            return self.fallback.warm_up(uri, count)
+        return 0
+
+    def stats(self):
+        """ return a dictionary of this transport's counters """
+        with self._lock:
+            return {'connections': len(self._connections),
+                    'http1_hosts': len(self._http1_hosts),
+                    'requests': self.requests,
+                    'fallback_requests': self.fallback_requests,
+                    'in_flight': self.in_flight,
+                    'max_in_flight': self.max_in_flight}
+
+    def close(self):
+        """ close all HTTP/2 connections """
+        with self._connect_lock:
+            connections = self._connections.values()
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+def _http2_errors():
+    """ return the exceptions an HTTP/2 exchange raises on a broken connection """
+    import h2.exceptions
+    from hyper.common.exceptions import SocketError
+    from hyper.http20.exceptions import HTTP20Error
+
+    return (EnvironmentError, SocketError, HTTP20Error,
+            h2.exceptions.H2Error)
+
+def _http2_connection_error(exn):
+    """ return True if exn leaves an HTTP/2 connection unusable """
+    import h2.exceptions
+    from hyper.common.exceptions import SocketError
+    from hyper.http20 import exceptions
+
+    if isinstance(exn, (exceptions.StreamResetError,
+                        h2.exceptions.StreamClosedError)):
+        return False
+    return isinstance(exn, (socket.error, SocketError,
+                            exceptions.ConnectionError,
+                            exceptions.ProtocolError,
+                            exceptions.HPACKDecodingError,
+                            exceptions.HPACKEncodingError,
+                            h2.exceptions.ProtocolError))
+
+def _reset_stream(connection, stream_id):
+    """ reset an HTTP/2 stream whose reply is no longer wanted """
+    stream = connection.streams.get(stream_id)
+    if stream is None:
+        return
+    try:
+        stream.close(0x8)   # CANCEL
+    except _http2_errors():
+        # E.g. the connection broke, which fails the request anyway.
+        pass
@@ -0,0 +1,333 @@
+"""Durable local outbox for Gloebit transactions.
+
+A TransactionOutbox records each purchase in a local SQLite database, in
+write-ahead log mode, before the purchase is sent to Gloebit.  Background
+senders then drain the outbox.  The user-facing request can return as
+soon as the purchase is committed locally.  If the process dies before
+Gloebit answers, the purchase is still in the outbox.  The next outbox
+opened on the same file sends it again, with the same transaction id.
+Resending is safe because Gloebit treats a repeated transaction id as the
+same transaction.
+
+Each row holds the transaction id, the access token to send it with, the
+JSON transaction and a status:
+  pending: Recorded, not yet answered by Gloebit.
+  done: Gloebit accepted it.  balance and product_count hold its reply.
+  failed: Gloebit refused it, or it ran out of attempts.  error says why.
+Errors other than a refusal leave a transaction pending and retry it
+with exponential backoff.  Such errors include network errors, HTTP
+errors and rate limiting.
+
+The database file stores access tokens, so keep it as private as the
+app's other credentials.  Only one process should use an outbox file at
+a time.
+
+Under gevent or eventlet, senders are greenlets, but SQLite calls are not
+cooperative: each commit blocks the event loop while it runs.
+
+Typical use:
+  outbox = TransactionOutbox(merchant, '/var/lib/app/gloebit-outbox.db')
+  future = outbox.purchase_user_product(credential, 'hat')
+  ... respond to the user; future.result() if the outcome is needed ...
+  outbox.close()
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from oauth2client import util
+
+import gloebit
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    access_token TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    balance REAL,
+    product_count INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt);
+'''
+
+# Gloebit's answer to these is final; anything else may succeed later.
+FINAL_ERRORS = (gloebit.TransactFailureError, gloebit.AccessTokenError,
+                gloebit.GloebitScopeError)
+
+class OutboxFuture(gloebit.Future):
+    """Future of a transaction sent through an outbox.
+
+    Its result is a tuple of the balance and product count from Gloebit's
+    reply.  Either can be None.
+
+    Attributes:
+      transaction_id: string, Id of the transaction, for status().
+    """
+
+    def __init__(self, transaction_id):
+        gloebit.Future.__init__(self)
+        self.transaction_id = transaction_id
+
+class TransactionOutbox(object):
+    """SQLite-backed queue of Gloebit transactions with background senders.
+
+    Senders claim up to batch_size due transactions at a time.  They send
+    them through the merchant's usual transaction path, which applies the
+    rate limiter and updates the balance ledger.  Each batch's outcomes
+    are committed to the database together.
+    """
+
+    @util.positional(3)
+    def __init__(self, merchant, filename, senders=2, batch_size=20,
+                 retry_delay=1.0, max_attempts=10, synchronous='NORMAL'):
+        """Open (or create) an outbox and start sending what it holds.
+
+        Transactions left pending by an earlier process are sent again.
+
+        Args:
+          merchant: Gloebit, Merchant that builds and sends transactions.
+          filename: string, SQLite database file.
+          senders: integer, Number of sender threads.
+          batch_size: integer, Most transactions a sender claims at once.
+          retry_delay: float, Seconds before the first retry of a
+            transaction.  The delay doubles with each attempt.
+          max_attempts: integer, Attempts before a transaction is failed.
+          synchronous: string, SQLite synchronous setting.  'NORMAL'
+            survives process crashes.  'FULL' also survives power loss,
+            at the cost of a sync on every commit.
+        """
+        self.merchant = merchant
+        self.filename = filename
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30.0,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=%s' % synchronous)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._claimed = set()
+        self._futures = {}
+        self._closed = False
+        self._senders = []
+        for number in range(senders):
+            thread = threading.Thread(target=self._send_loop,
+                                      name='gloebit-outbox-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self._senders.append(thread)
+
+    @util.positional(4)
+    def purchase_item(self, credential, item, item_price, item_quantity=1,
+                      username=None):
+        """Record a purchase_item() and return its OutboxFuture.
+
+        The merchant's local checks run first and raise as for
+        Gloebit.purchase_item().
+        """
+        return self._record(credential.access_token,
+                            self.merchant.item_transaction(
+                                credential, item, item_price,
+                                item_quantity, username))
+
+    @util.positional(3)
+    def purchase_user_product(self, credential, product,
+                              product_quantity=1, username=None):
+        """ record a purchase of a user product, return its OutboxFuture """
+        return self._record(credential.access_token,
+                            self.merchant.product_transaction(
+                                credential, product, product_quantity,
+                                None, username))
+
+    @util.positional(4)
+    def purchase_character_product(self, credential, character_id, product,
+                                   product_quantity=1, username=None):
+        """ record a purchase of a character product, return its future """
+        return self._record(credential.access_token,
+                            self.merchant.product_transaction(
+                                credential, product, product_quantity,
+                                character_id, username))
+
+    def _record(self, access_token, transaction):
+        """ commit a transaction to the outbox and wake a sender """
+        now = time.time()
+        future = OutboxFuture(transaction['id'])
+        with self._lock:
+            if self._closed:
+                raise gloebit.Error('outbox is closed')
+            self._futures[transaction['id']] = future
+        try:
+            with self._db_lock:
+                with self._db:
+                    self._db.execute(
+                        'INSERT INTO outbox (id, access_token, payload,'
+                        ' status, created, updated, next_attempt)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (transaction['id'], access_token,
+                         json.dumps(transaction), PENDING, now, now, now))
+        except Exception:
+            with self._lock:
+                self._futures.pop(transaction['id'], None)
+            raise
+        with self._lock:
+            self._changed.notify_all()
+        return future
+
+    def status(self, transaction_id):
+        """Return a transaction's row as a dictionary, or None if unknown.
+
+        The dictionary has the keys status, attempts, created, updated,
+        balance, product_count and error.
+        """
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT status, attempts, created, updated, balance,'
+                ' product_count, error FROM outbox WHERE id = ?',
+                (transaction_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('status', 'attempts', 'created', 'updated',
+                         'balance', 'product_count', 'error'), row))
+
+    def pending(self):
+        """ return the number of transactions not yet answered """
+        with self._db_lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM outbox WHERE status = ?',
+                (PENDING,)).fetchone()[0]
+
+    def purge(self, max_age):
+        """Delete answered transactions older than max_age seconds.
+
+        Returns:
+          Number of rows deleted.
+        """
+        with self._db_lock:
+            with self._db:
+                return self._db.execute(
+                    'DELETE FROM outbox WHERE status != ? AND updated < ?',
+                    (PENDING, time.time() - max_age)).rowcount
+
+    @util.positional(1)
+    def drain(self, timeout=None):
+        """Wait until no transactions are pending.
+
+        Returns:
+          True if the outbox drained, False if timeout expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending():
+            remaining = 0.1
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.time())
+                if remaining <= 0:
+                    return False
+            with self._lock:
+                self._changed.wait(remaining)
+        return True
+
+    @util.positional(1)
+    def close(self, timeout=None):
+        """Stop the senders after their current batches.
+
+        Transactions still pending stay in the database, to be sent by
+        the next outbox opened on it.
+        """
+        with self._lock:
+            self._closed = True
+            self._changed.notify_all()
+        for thread in self._senders:
+            thread.join(timeout)
+        with self._db_lock:
+            self._db.close()
+
+    def _claim(self):
+        """ wait for due transactions, claim and return them; None if closed """
+        with self._lock:
+            while not self._closed:
+                now = time.time()
+                with self._db_lock:
+                    rows = self._db.execute(
+                        'SELECT id, access_token, payload, attempts,'
+                        ' next_attempt FROM outbox WHERE status = ?'
+                        ' ORDER BY next_attempt LIMIT ?',
+                        (PENDING, self.batch_size + len(self._claimed))
+                    ).fetchall()
+                rows = [row for row in rows if row[0] not in self._claimed]
+                due = [row[:4] for row in rows if row[4] <= now]
+                if due:
+                    self._claimed.update(row[0] for row in due)
+                    return due
+                # Sleep until the next retry is due, or until new work or
+                # a finished batch changes things.
+                self._changed.wait(rows[0][4] - now if rows else None)
+            return None
+
+    def _send_loop(self):
+        """ sender thread: send claimed batches until closed """
+        while True:
+            batch = self._claim()
+            if batch is None:
+                return
+            self._finish([self._send(*row) for row in batch])
+
+    def _send(self, transaction_id, access_token, payload, attempts):
+        """ send one transaction; return its outcome """
+        try:
+            balance, count = self.merchant.send_transaction(
+                access_token, json.loads(payload))
+        except FINAL_ERRORS as exn:
+            return transaction_id, FAILED, attempts + 1, None, exn
+        except Exception as exn:
+            # Anything else, e.g. a dropped connection, is recorded with
+            # the row and retried.
+            if attempts + 1 >= self.max_attempts:
+                return transaction_id, FAILED, attempts + 1, None, exn
+            return transaction_id, PENDING, attempts + 1, None, exn
+        return transaction_id, DONE, attempts + 1, (balance, count), None
+
+    def _finish(self, outcomes):
+        """ commit a batch's outcomes and settle their futures """
+        now = time.time()
+        with self._db_lock:
+            with self._db:
+                for transaction_id, status, attempts, result, exn in outcomes:
+                    balance, count = result or (None, None)
+                    delay = self.retry_delay * 2 ** min(attempts - 1, 10)
+                    self._db.execute(
+                        'UPDATE outbox SET status = ?, attempts = ?,'
+                        ' updated = ?, next_attempt = ?, balance = ?,'
+                        ' product_count = ?, error = ? WHERE id = ?',
+                        (status, attempts, now, now + delay, balance, count,
+                         None if exn is None else repr(exn),
+                         transaction_id))
+        settled = []
+        with self._lock:
+            for transaction_id, status, _attempts, result, exn in outcomes:
+                self._claimed.discard(transaction_id)
+                if status != PENDING:
+                    settled.append((self._futures.pop(transaction_id, None),
+                                    result, exn))
+            self._changed.notify_all()
+        for future, result, exn in settled:
+            if future is None:
+                continue
+            if exn is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exn)
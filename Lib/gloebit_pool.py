@@ -0,0 +1,423 @@
+"""Connection pools and DNS caching for the gloebit module.
+
+PoolManager: Keep-alive connection pools per (Gloebit host, merchant),
+  with a process-wide socket limit and fair hand-off of freed
+  connections between merchants.
+ConnectionPool: One merchant's pool for one host; the transport a
+  Gloebit object sends its requests through by default.
+DnsCache: Bounded-time cache of address lookups for Gloebit hosts,
+  installed by Gloebit.warm_up().
+
+Gloebit objects share default_pool_manager() unless given their own
+PoolManager.  This module is imported when the first Gloebit object is
+created.
+"""
+
+import collections
+import socket
+import threading
+import time
+
+from oauth2client import util
+
+import gloebit
+
+class ConnectionPool(object):
+    """Keep-alive connections to one Gloebit host for one merchant.
+
+    Created and scheduled by a PoolManager.  Each pooled connection is an
+    httplib2.Http object, used by one request at a time.
+
+    Attributes:
+      in_use: integer, Connections currently checked out.
+      waiting: integer, Requests queued for a connection (queue depth).
+      max_waiting: integer, Largest queue depth seen.
+      requests: integer, Connections handed out so far.
+      wait_time: float, Total seconds requests spent queued.
+      idle_connections: list, Open connections not checked out.  Like
+        waiters, managed by the PoolManager under its lock.
+      waiters: collections.deque, [event, connection] pairs of the
+        queued requests, oldest first.
+    """
+
+    # request() takes a cancel argument.
+    cancellable = True
+
+    def __init__(self, manager, key, max_connections):
+        self.manager = manager
+        self.key = key
+        self.max_connections = max_connections
+        self.in_use = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.requests = 0
+        self.wait_time = 0.0
+        self.idle_connections = []
+        self.waiters = collections.deque()
+
+    def request(self, uri, method, headers, body, cancel=None):
+        """Send a request on a pooled connection.
+
+        Args:
+          uri, method, headers, body: The request.
+          cancel: gloebit_hedge.CancelToken, If provided, cancelling it
+            closes the connection, so that the request fails at once and
+            the connection is not handed out again.
+
+        Returns:
+          Tuple of the response headers and the response body.
+
+        Raises:
+          RequestCancelledError if cancel was cancelled first.
+        """
+        if cancel is not None and cancel.cancelled:
+            raise gloebit.RequestCancelledError('request cancelled before sending')
+        http = self.manager.acquire(self)
+        succeeded = False
+        abort = None
+        try:
+            if cancel is not None:
+                abort = lambda: _abort_http(http)
+                cancel.watch(abort)
+            result = http.request(uri=uri, method=method, headers=headers,
+                                  body=body)
+            succeeded = True
+            return result
+        finally:
+            # unwatch() first: an abort that ran, or is running, as the
+            # request finished has shut the connection's socket.
+            aborted = abort is not None and not cancel.unwatch(abort)
+            # After any exception (including a KeyboardInterrupt or killed
+            # greenlet) the connection may be half-used; do not hand it
+            # out again.
+            self.manager.release(self, http,
+                                 reusable=succeeded and not aborted)
+
+    def warm_up(self, uri, count):
+        """Open up to count connections to uri's host and keep them idle.
+
+        Returns:
+          Number of connections opened.
+        """
+        import httplib
+        import httplib2
+
+        # Only take connections free right now: waiting for one while
+        # holding others could deadlock against requests doing the same.
+        https = []
+        for _ in range(min(count, self.max_connections)):
+            http = self.manager.acquire(self, wait=False)
+            if http is None:
+                break
+            https.append(http)
+        opened = 0
+        for http in https:
+            reusable = False
+            try:
+                # Any response will do; the point is the open connection.
+                http.request(uri=uri, method='HEAD')
+                reusable = True
+                opened += 1
+            except (EnvironmentError, httplib.HTTPException,
+                    httplib2.HttpLib2Error):
+                pass
+            finally:
+                self.manager.release(self, http, reusable=reusable)
+        return opened
+
+    def stats(self):
+        """ return a dictionary of this pool's counters """
+        return {'in_use': self.in_use,
+                'idle': len(self.idle_connections),
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'requests': self.requests,
+                'wait_time': self.wait_time}
+
+def _abort_http(http):
+    """ make the request in progress on an httplib2.Http fail at once """
+    for conn in http.connections.values():
+        # httplib2 reconnects and resends after a dropped connection.
+        conn.connect = _refuse_connect
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+def _refuse_connect():
+    """ stand-in connect() of a connection whose request was cancelled """
+    raise gloebit.RequestCancelledError('request cancelled')
+
+class PoolManager(object):
+    """Connection pools per (Gloebit host, merchant) with a socket limit.
+
+    Each merchant gets its own pool for each host, capped at
+    max_connections_per_pool, and all pools together hold at most
+    max_sockets open connections.  When requests have to wait, freed
+    connections are handed to waiting pools in round-robin order, so one
+    busy merchant cannot starve the others.  Give each merchant its own
+    RateLimiter to also isolate rate budgets.
+    """
+
+    @util.positional(1)
+    def __init__(self, max_sockets=64, max_connections_per_pool=8,
+                 timeout=None):
+        """Create a PoolManager.
+
+        Args:
+          max_sockets: integer, Most connections open in all pools.
+          max_connections_per_pool: integer, Most connections open to one
+            host for one merchant.
+          timeout: float, Seconds a request may wait for a connection
+            before PoolTimeoutError.  None waits forever.
+        """
+        self.max_sockets = max_sockets
+        self.max_connections_per_pool = max_connections_per_pool
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._ready = collections.deque()
+        self._open = 0
+
+    def pool(self, hostname, client_id):
+        """ return the pool for hostname and merchant client_id """
+        key = (hostname, client_id)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(self, key,
+                                      self.max_connections_per_pool)
+                self._pools[key] = pool
+            return pool
+
+    def stats(self):
+        """ return counters for every pool, keyed by (host, client id) """
+        with self._lock:
+            stats = dict((key, pool.stats())
+                         for key, pool in self._pools.items())
+            stats['open'] = self._open
+            return stats
+
+    @util.positional(2)
+    def acquire(self, pool, wait=True):
+        """Check out a connection from pool, waiting for one if needed.
+
+        Args:
+          pool: ConnectionPool, Pool to check a connection out of.
+          wait: Boolean, If False, return None rather than wait when no
+            connection is free.
+
+        Raises:
+          PoolTimeoutError if none was free within the manager's timeout.
+        """
+        with self._lock:
+            if (not pool.waiters and self._can_grant(pool) and
+                    not self._queued_for_socket(pool)):
+                http = self._grant(pool)
+                return http or _new_http()
+            if not wait:
+                return None
+            waiter = [threading.Event(), None]
+            pool.waiters.append(waiter)
+            pool.waiting += 1
+            pool.max_waiting = max(pool.max_waiting, pool.waiting)
+            if pool not in self._ready:
+                self._ready.append(pool)
+        start = time.time()
+        try:
+            waiter[0].wait(self.timeout)
+        except BaseException:
+            # Interrupted while queued: leave the queue, or hand back a
+            # connection granted meanwhile.
+            self._withdraw(pool, waiter)
+            raise
+        with self._lock:
+            pool.wait_time += time.time() - start
+            if not waiter[0].is_set():
+                pool.waiters.remove(waiter)
+                pool.waiting -= 1
+                raise gloebit.PoolTimeoutError(
+                    'no connection to %s for %s' % pool.key)
+        return waiter[1] or _new_http()
+
+    @util.positional(3)
+    def release(self, pool, http, reusable=True):
+        """ return a connection to pool and wake the next waiter """
+        with self._lock:
+            pool.in_use -= 1
+            if reusable:
+                pool.idle_connections.append(http)
+            else:
+                self._open -= 1
+                _close_http(http)
+            self._dispatch()
+
+    def _withdraw(self, pool, waiter):
+        """ remove a waiter from pool's queue, releasing any grant """
+        with self._lock:
+            if not waiter[0].is_set():
+                pool.waiters.remove(waiter)
+                pool.waiting -= 1
+                return
+            if waiter[1] is None:
+                # Granted a slot for a connection not yet opened.
+                pool.in_use -= 1
+                self._open -= 1
+                self._dispatch()
+                return
+        self.release(pool, waiter[1])
+
+    def _can_grant(self, pool):
+        """ True if pool may check out a connection now; lock held """
+        if pool.in_use >= pool.max_connections:
+            return False
+        if pool.idle_connections or self._open < self.max_sockets:
+            return True
+        return any(other.idle_connections for other in self._pools.values())
+
+    def _queued_for_socket(self, pool):
+        """True if other pools wait for the socket pool would take.
+
+        At the socket limit, a pool without an idle connection of its own
+        can only take another pool's socket; pools already waiting below
+        their own cap are first in line for it.  Lock must be held.
+        """
+        if pool.idle_connections or self._open < self.max_sockets:
+            return False
+        return any(other.waiters and
+                   other.in_use < other.max_connections
+                   for other in self._ready if other is not pool)
+
+    def _grant(self, pool):
+        """Check out a connection for pool; lock must be held.
+
+        Returns:
+          An idle httplib2.Http to reuse, or None if the caller should
+          open a new one.
+        """
+        pool.in_use += 1
+        pool.requests += 1
+        if pool.idle_connections:
+            return pool.idle_connections.pop()
+        if self._open >= self.max_sockets:
+            # At the socket limit: close another pool's idle connection.
+            for other in self._pools.values():
+                if other.idle_connections:
+                    _close_http(other.idle_connections.pop(0))
+                    break
+        else:
+            self._open += 1
+        return None
+
+    def _dispatch(self):
+        """ hand free capacity to waiting pools round-robin; lock held """
+        skipped = 0
+        while self._ready and skipped < len(self._ready):
+            pool = self._ready.popleft()
+            if not pool.waiters:
+                continue
+            if not self._can_grant(pool):
+                self._ready.append(pool)
+                skipped += 1
+                continue
+            waiter = pool.waiters.popleft()
+            pool.waiting -= 1
+            waiter[1] = self._grant(pool)
+            waiter[0].set()
+            if pool.waiters:
+                self._ready.append(pool)
+            skipped = 0
+
+_DEFAULT_POOL_MANAGER = []
+_DEFAULT_POOL_MANAGER_LOCK = threading.Lock()
+
+def default_pool_manager():
+    """Return the process-wide PoolManager, creating it on first use.
+
+    One created before gevent or eventlet monkey-patching is replaced;
+    waiting on its locks would block the event loop.
+    """
+    with _DEFAULT_POOL_MANAGER_LOCK:
+        if not _DEFAULT_POOL_MANAGER or \
+                gloebit.predates_patching(_DEFAULT_POOL_MANAGER[0]):
+            _DEFAULT_POOL_MANAGER[:] = [PoolManager()]
+        return _DEFAULT_POOL_MANAGER[0]
+
+class DnsCache(object):
+    """Caches address lookups for Gloebit hosts for a bounded time.
+
+    Once installed, it stands in for socket.getaddrinfo() process-wide,
+    but only answers from the cache for hosts added with add_host();
+    lookups for any other host go straight to the resolver.
+    """
+
+    def __init__(self, ttl=300.0, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._getaddrinfo = socket.getaddrinfo
+        self._lock = threading.Lock()
+        self._hosts = set()
+        self._entries = collections.OrderedDict()
+
+    def add_host(self, host):
+        """ cache lookups for host from now on """
+        with self._lock:
+            self._hosts.add(host)
+
+    def resolve(self, host, port):
+        """ look up host now, filling the cache """
+        return self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    def getaddrinfo(self, host, port, *args):
+        """ socket.getaddrinfo(), cached for added hosts """
+        if host not in self._hosts:
+            return self._getaddrinfo(host, port, *args)
+        key = (host, port) + args
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and now - entry[1] < self.ttl:
+            return list(entry[0])
+        addresses = self._getaddrinfo(host, port, *args)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (addresses, now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return list(addresses)
+
+    def install(self):
+        """ make socket.getaddrinfo() use this cache """
+        socket.getaddrinfo = self.getaddrinfo
+
+_DNS_CACHE = []
+_DNS_CACHE_LOCK = threading.Lock()
+
+def install_dns_cache(ttl=300.0):
+    """Return the process-wide DnsCache, installing it on first use.
+
+    A later call with a different ttl updates the cache's ttl.
+    """
+    with _DNS_CACHE_LOCK:
+        if not _DNS_CACHE:
+            cache = DnsCache(ttl=ttl)
+            cache.install()
+            _DNS_CACHE.append(cache)
+        _DNS_CACHE[0].ttl = ttl
+        return _DNS_CACHE[0]
+
+def _new_http():
+    """ return a new httplib2.Http configured for Gloebit """
+    import httplib2
+
+    http = httplib2.Http()
+    if not gloebit.CHECK_SSL_CERT:
+        http.disable_ssl_certificate_validation = True
+    return http
+
+def _close_http(http):
+    """ close the sockets held by an httplib2.Http """
+    for connection in http.connections.values():
+        connection.close()
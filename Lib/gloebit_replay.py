@@ -0,0 +1,194 @@
+"""Record and replay Gloebit HTTP traffic.
+
+A RecordingTransport wraps a Gloebit object's transport and appends every
+request and response to a log file.  A ReplayTransport serves responses
+from such a log without any network access, so the library and the Flask
+example can be load-tested deterministically.
+
+The log holds one compact JSON object per line (gzip-compressed if the
+file name ends in '.gz'):
+  m: HTTP method.
+  u: request URI.
+  b: request body, or null.
+  s: response status.
+  h: response headers needed by the client (content-type, etag,
+     last-modified).
+  r: response body.
+  d: seconds the request took.
+Authorization headers are never written, and the OAuth secrets in token
+exchanges (client_secret, code, access_token, refresh_token, id_token)
+are replaced by REDACTED in both the request and the response.  A replayed
+token exchange hands out the placeholder token, which the ReplayTransport
+accepts like any other.
+
+Typical use:
+  merchant = gloebit.Gloebit(secrets)
+  merchant.transport = RecordingTransport('gloebit.log.gz',
+                                          merchant.transport)
+  ... exercise the app against Gloebit ...
+  merchant.transport.close()
+
+  merchant.transport = ReplayTransport('gloebit.log.gz', timing=True)
+"""
+
+import collections
+import gzip
+import json
+import threading
+import time
+import urllib
+import urlparse
+
+from oauth2client import util
+
+import gloebit
+
+RECORDED_HEADERS = ('content-type', 'etag', 'last-modified')
+SECRET_FIELDS = ('client_secret', 'code', 'access_token', 'refresh_token',
+                 'id_token')
+REDACTED = 'REDACTED'
+
+class ReplayMissError(gloebit.Error):
+    """The replay log has no response for a request."""
+
+def _open(filename, mode):
+    """ open a log file, compressed if its name ends in .gz """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+def _redact_form(body):
+    """ return a form-encoded request body with its secrets redacted """
+    fields = urlparse.parse_qsl(body, keep_blank_values=True)
+    if not any(name in SECRET_FIELDS for name, _value in fields):
+        return body
+    return urllib.urlencode([(name, REDACTED if name in SECRET_FIELDS
+                              else value) for name, value in fields])
+
+def _redact_json(content):
+    """ return a JSON response body with its top-level secrets redacted """
+    try:
+        fields = json.loads(content)
+    except ValueError:
+        return content
+    if not isinstance(fields, dict) or \
+            not any(name in SECRET_FIELDS for name in fields):
+        return content
+    for name in SECRET_FIELDS:
+        if name in fields:
+            fields[name] = REDACTED
+    return json.dumps(fields)
+
+class ReplayResponse(dict):
+    """Response headers served from a replay log, like httplib2.Response."""
+
+    def __init__(self, status, headers):
+        dict.__init__(self, headers)
+        self.status = status
+        self['status'] = str(status)
+
+class RecordingTransport(object):
+    """Transport that logs every request and response it forwards."""
+
+    def __init__(self, filename, transport):
+        """Create a RecordingTransport.
+
+        Args:
+          filename: string, Log file to append to.
+          transport: The transport to forward requests to, normally the
+            Gloebit object's current transport.
+        """
+        self.transport = transport
+        self._file = _open(filename, 'ab')
+        self._lock = threading.Lock()
+
+    def request(self, uri, method='GET', headers=None, body=None):
+        """ forward the request and log it with its response """
+        start = time.time()
+        resp, content = self.transport.request(uri, method, headers, body)
+        content_type = dict((name.lower(), value) for name, value in
+                            (headers or {}).items()).get('content-type', '')
+        entry = {
+            'm': method,
+            'u': uri,
+            'b': _redact_form(body) if body and content_type.startswith(
+                'application/x-www-form-urlencoded') else body,
+            's': resp.status,
+            'h': dict((name, resp[name]) for name in RECORDED_HEADERS
+                      if name in resp),
+            'r': _redact_json(content) if content else content,
+            'd': round(time.time() - start, 6),
+        }
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+        return resp, content
+
+    def close(self):
+        """ flush and close the log """
+        with self._lock:
+            self._file.close()
+
+class ReplayTransport(object):
+    """Transport that answers requests from a recorded log.
+
+    Requests are matched on method and URI.  Repeated requests for the
+    same method and URI get the recorded responses in order.  Request
+    bodies are not compared, since transactions carry fresh ids and
+    timestamps.
+    """
+
+    @util.positional(2)
+    def __init__(self, filename, timing=False, speed=1.0, loop=True):
+        """Create a ReplayTransport.
+
+        Args:
+          filename: string, Log written by a RecordingTransport.
+          timing: Boolean, If True, each response is delayed by the time
+            the original request took, divided by speed.
+          speed: float, Playback speed-up for timing.
+          loop: Boolean, If True, start over from the first recorded
+            response once a method and URI run out.  If False, raise
+            ReplayMissError instead.
+        """
+        self.timing = timing
+        self.speed = speed
+        self.loop = loop
+        self._entries = collections.defaultdict(list)
+        self._cursors = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        log = _open(filename, 'rb')
+        try:
+            for line in log:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[(entry['m'], entry['u'])].append(entry)
+        finally:
+            log.close()
+
+    def request(self, uri, method='GET', headers=None, body=None):
+        """ return the next recorded (response, content) for the request """
+        key = (method, uri)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise ReplayMissError('%s %s not recorded' % key)
+            index = self._cursors[key]
+            if index >= len(entries):
+                if not self.loop:
+                    raise ReplayMissError('%s %s replayed %d times' %
+                                          (method, uri, len(entries)))
+                index = 0
+            self._cursors[key] = index + 1
+        entry = entries[index]
+        if self.timing and entry['d'] > 0:
+            time.sleep(entry['d'] / self.speed)
+        content = entry['r']
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return ReplayResponse(entry['s'], entry['h']), content
+
+    def rewind(self):
+        """ start every method and URI over from its first response """
+        with self._lock:
+            self._cursors.clear()
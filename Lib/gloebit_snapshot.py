@@ -0,0 +1,380 @@
+"""Host-local shared-memory snapshot of Gloebit product inventories.
+
+Game-server processes on one host often ask Gloebit for the same
+players' user_products() and character_products().  A SnapshotStore
+keeps product counts in a memory-mapped file, which every process on the
+host maps.  Readers look counts up in place, without copying the table,
+taking a lock or making a network call.
+
+Entries are keyed by (user, character, product), with character None
+for user products.  user is whatever string identifies the player to
+every process.  Gloebit's write-through uses the Gloebit user id, which
+stays the same across the player's sessions and access tokens, so
+readers look counts up by the id user_info() returns.  Only a digest of
+the key is stored.
+
+Each entry records when it was written, so a reader can refuse counts
+older than it tolerates.  Entries older than the file's expire_after
+read as absent, and writers reuse their slots, so players who stop
+playing do not fill the table for good.  Each entry also records its
+source:
+  inventory: A full inventory read from Gloebit.  A product missing from
+    the inventory counts as 0 from then on.
+  update: A purchase, consume or grant response.
+A merchant created with Gloebit(snapshot=store) writes both kinds
+through.  Typically one refresher process keeps inventories fresh, e.g.
+with poll_users(products=True) and character_products() calls, and
+every process's purchases, consumes and grants update counts as they
+happen.
+
+File layout:
+  Header (64 bytes): magic, capacity (slots), used slot count and
+  expire_after (seconds; 0 if entries never expire).
+  Slots (40 bytes each), an open-addressed hash table with linear
+  probing, each holding:
+    seq: Sequence counter, odd while a writer is changing the slot.
+    key: First 16 bytes of the SHA-1 of the key.
+    count: Product count.  For a (user, character) inventory marker,
+      the number of products in the inventory, or -1 while the
+      inventory is being written.
+    updated: Time the entry was written, in seconds since the epoch.
+    source: 1 for inventory, 2 for update.
+  A key is looked for in at most 32 slots from its home slot.  A writer
+  puts a new key in the first expired slot among them, or else in the
+  first empty one; if there is neither, the table counts as full.
+  Writers serialize on an exclusive flock() of the file.  Readers use the
+  seq counter as a seqlock: a slot read while seq was odd, or changed
+  during the read, is read again.
+
+Under gevent or eventlet, reads never block, but a writer waiting for
+another process's flock() blocks the event loop until it gets it.
+
+Typical use:
+  store = SnapshotStore('/dev/shm/gloebit-inventory')
+  merchant = gloebit.Gloebit(secrets, snapshot=store)    # refresher
+  ...
+  store = SnapshotStore('/dev/shm/gloebit-inventory', readonly=True)
+  entry = store.get(user_id, character_id, 'hat', max_age=30)
+  count = entry.count if entry is not None else merchant.character_products(
+      credential, character_id).get('hat', 0)
+"""
+
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from oauth2client import util
+
+import gloebit
+
+INVENTORY = 'inventory'
+UPDATE = 'update'
+
+_MAGIC = 'GLBSNAP2'
+_HEADER = struct.Struct('<8sIId')
+_HEADER_SIZE = 64
+_SEQ = struct.Struct('<I')
+_KEY = struct.Struct('<16s')
+_BODY = struct.Struct('<16sqdI')
+_SLOT = struct.Struct('<I16sqdI')
+_UPDATED = struct.Struct('<d')
+_UPDATED_AT = struct.calcsize('<I16sq')
+_EMPTY = '\0' * 16
+_SOURCES = {INVENTORY: 1, UPDATE: 2}
+_SOURCE_NAMES = {1: INVENTORY, 2: UPDATE}
+# Reads of a slot a writer keeps changing give up after this many tries,
+# e.g. if a writer died between the two seq updates.
+_READ_TRIES = 1000
+# What _get() returns for a slot it gave up reading.
+_BUSY = object()
+# Slots probed for a key, bounding the cost of a lookup in a full table.
+_MAX_PROBES = 32
+# Count of an inventory marker while the inventory is being written.
+_INCOMPLETE = -1
+
+class SnapshotEntry(collections.namedtuple(
+        'SnapshotEntry', 'count updated age source')):
+    """A product count read from a SnapshotStore.
+
+    Fields are the count, the time it was written, its age in seconds
+    when read, and its source (INVENTORY or UPDATE).
+    """
+    __slots__ = ()
+
+def _digest(user, character_id, product):
+    """ return the 16-byte key of (user, character, product) """
+    parts = []
+    for part in (user, character_id or '', product):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        parts.append(part)
+    return hashlib.sha1('\0'.join(parts)).digest()[:16]
+
+class SnapshotStore(object):
+    """Product counts in a memory-mapped file shared by local processes."""
+
+    @util.positional(2)
+    def __init__(self, filename, capacity=65536, expire_after=86400.0,
+                 readonly=False):
+        """Open a snapshot file, creating it if needed.
+
+        Args:
+          filename: string, Snapshot file, e.g. under /dev/shm.  A new
+            file is readable and writable by its owner only.
+          capacity: integer, Slots in a new file.  An existing file keeps
+            its own capacity.  Each user or character inventory takes one
+            slot plus one per product.
+          expire_after: float, Seconds after which an entry in a new file
+            reads as absent and its slot may be reused, or None to keep
+            entries until the file is removed.  An existing file keeps
+            its own setting.
+          readonly: Boolean, If True, map the file read-only; it must
+            exist.
+
+        Raises:
+          gloebit.Error if the file is not a snapshot file.
+        """
+        self.filename = filename
+        self.readonly = readonly
+        self.retries = 0
+        self.full = 0
+        self.reclaimed = 0
+        self._lock = threading.Lock()
+        if readonly:
+            self._fd = os.open(filename, os.O_RDONLY)
+        else:
+            self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd,
+                                 _HEADER_SIZE + capacity * _SLOT.size)
+                    os.write(self._fd, _HEADER.pack(
+                        _MAGIC, capacity, 0, expire_after or 0.0))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        magic, self.capacity, _used, expire_after = _HEADER.unpack(
+            os.read(self._fd, _HEADER.size).ljust(_HEADER.size, '\0'))
+        self.expire_after = expire_after or None
+        if magic != _MAGIC:
+            os.close(self._fd)
+            raise gloebit.Error('%s is not a Gloebit snapshot file' %
+                                filename)
+        self._map = mmap.mmap(
+            self._fd, _HEADER_SIZE + self.capacity * _SLOT.size,
+            access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+    def used(self):
+        """ return the number of slots in use """
+        return _HEADER.unpack_from(self._map, 0)[2]
+
+    @util.positional(4)
+    def get(self, user, character_id, product, max_age=None):
+        """Return the count of a product, without asking Gloebit.
+
+        A product missing from the newest full inventory of the user or
+        character counts as 0, as of that inventory.  While an inventory
+        is being written, counts older than it are unknown.
+
+        Args:
+          user: string, Player's key, e.g. the Gloebit user id.
+          character_id: string, Character, or None for user products.
+          product: string, Product name.
+          max_age: float, Oldest acceptable entry, in seconds.
+
+        Returns:
+          A SnapshotEntry, or None if the count is unknown, too old or
+          expired.
+        """
+        now = time.time()
+        # The marker first: it is completed after the inventory's counts,
+        # so a count read after it is at least as new as the inventory.
+        inventory = self._get(_digest(user, character_id, ''))
+        entry = self._get(_digest(user, character_id, product))
+        if inventory is _BUSY or entry is _BUSY:
+            # Not absent, just unreadable for now: the count is unknown.
+            return None
+        inventory = self._live(inventory, now)
+        entry = self._live(entry, now)
+        if entry is None or (inventory is not None and
+                             entry[1] < inventory[1]):
+            if inventory is None or inventory[0] == _INCOMPLETE:
+                return None
+            entry = (0, inventory[1], inventory[2])
+        age = now - entry[1]
+        if max_age is not None and age > max_age:
+            return None
+        return SnapshotEntry(entry[0], entry[1], age,
+                             _SOURCE_NAMES.get(entry[2]))
+
+    @util.positional(5)
+    def put(self, user, character_id, product, count, source=UPDATE):
+        """Write a product count.
+
+        Returns:
+          False if the table is full, True otherwise.
+        """
+        with self._writing():
+            return self._put(_digest(user, character_id, product), count,
+                             time.time(), _SOURCES[source])
+
+    @util.positional(4)
+    def put_inventory(self, user, character_id, products, updated=None):
+        """Write a full inventory, a dictionary of product counts.
+
+        Products written earlier and missing from it count as 0.  Counts
+        written after `updated` (e.g. by a purchase made while the
+        inventory was being read) are kept.  The inventory's marker is
+        written as incomplete first and completed last, so that a reader
+        never takes an older count for a current one, even if the table
+        fills up part way.
+
+        Args:
+          user: string, Player's key.
+          character_id: string, Character, or None for user products.
+          products: dictionary, Product name to count.
+          updated: float, Time the inventory was requested from Gloebit.
+            Defaults to now.
+
+        Returns:
+          False if the table is full, True otherwise.
+        """
+        if updated is None:
+            updated = time.time()
+        source = _SOURCES[INVENTORY]
+        marker = _digest(user, character_id, '')
+        with self._writing():
+            if not self._put(marker, _INCOMPLETE, updated, source):
+                return False
+            for product, count in products.items():
+                if not self._put(_digest(user, character_id, product),
+                                 count, updated, source):
+                    return False
+            return self._put(marker, len(products), updated, source)
+
+    def stats(self):
+        """ return a dictionary of the store's counters """
+        return {'capacity': self.capacity,
+                'used': self.used(),
+                'expire_after': self.expire_after,
+                'retries': self.retries,
+                'full': self.full,
+                'reclaimed': self.reclaimed}
+
+    def close(self):
+        """ unmap and close the file """
+        self._map.close()
+        os.close(self._fd)
+
+    def _live(self, record, now):
+        """ return record, or None if it is missing or expired """
+        if record is None or (self.expire_after is not None and
+                              now - record[1] > self.expire_after):
+            return None
+        return record
+
+    def _slot(self, digest, claim):
+        """Find digest's slot offset by linear probing.
+
+        Looks at most _MAX_PROBES slots.  When claiming, a slot holding an
+        expired entry is reused in preference to an empty one further on.
+
+        Returns:
+          The offset, or None if digest is absent (and claim is False) or
+          the table is full.
+        """
+        start = struct.unpack_from('<Q', digest)[0] % self.capacity
+        if claim and self.expire_after is not None:
+            cutoff = time.time() - self.expire_after
+        else:
+            cutoff = None
+        reusable = None
+        for probe in xrange(min(_MAX_PROBES, self.capacity)):
+            offset = _HEADER_SIZE + ((start + probe) % self.capacity) * \
+                _SLOT.size
+            key = _KEY.unpack_from(self._map, offset + _SEQ.size)[0]
+            if key == digest:
+                return offset
+            if key == _EMPTY:
+                if not claim:
+                    return None
+                return reusable if reusable is not None else offset
+            if reusable is None and cutoff is not None and \
+                    _UPDATED.unpack_from(self._map, offset + _UPDATED_AT)[0] \
+                    < cutoff:
+                reusable = offset
+        return reusable
+
+    def _get(self, digest):
+        """ return (count, updated, source) for digest, None or _BUSY """
+        offset = self._slot(digest, False)
+        if offset is None:
+            return None
+        for _ in xrange(_READ_TRIES):
+            seq = _SEQ.unpack_from(self._map, offset)[0]
+            if seq & 1:
+                self.retries += 1
+                continue
+            record = _SLOT.unpack_from(self._map, offset)
+            if _SEQ.unpack_from(self._map, offset)[0] == seq == record[0]:
+                return record[2:] if record[1] == digest else None
+            self.retries += 1
+        return _BUSY
+
+    def _writing(self):
+        """ return a context manager holding the cross-process write lock """
+        if self.readonly:
+            raise gloebit.Error('snapshot store is read-only')
+        return _WriteLock(self._lock, self._fd)
+
+    def _put(self, digest, count, updated, source):
+        """ write one slot; the write lock must be held """
+        offset = self._slot(digest, True)
+        if offset is None:
+            self.full += 1
+            return False
+        seq, key, _count, current, _source = _SLOT.unpack_from(
+            self._map, offset)
+        new = key == _EMPTY
+        if key == digest and current > updated:
+            return True
+        if not new and key != digest:
+            self.reclaimed += 1
+        if seq & 1:
+            # A writer died mid-update; the slot is rewritten below.
+            seq += 1
+        _SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+        _BODY.pack_into(self._map, offset + _SEQ.size, digest, count,
+                        updated, source)
+        _SEQ.pack_into(self._map, offset, (seq + 2) & 0xffffffff)
+        if new:
+            _HEADER.pack_into(self._map, 0, _MAGIC, self.capacity,
+                              self.used() + 1, self.expire_after or 0.0)
+        return True
+
+class _WriteLock(object):
+    """ holds a thread lock and an exclusive flock() together """
+
+    def __init__(self, lock, fd):
+        self._thread_lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, *_exc):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
@@ -0,0 +1,105 @@
+"""Measure allocations of Gloebit response handling per endpoint.
+
+For each endpoint, a representative response body is handled the old way
+(_success_check() returning the whole parsed response, plus the debug
+str() consume and grant used to print) and the new way
+(_success_fields() extracting only the fields the endpoint returns).
+
+Allocation peaks are measured with tracemalloc, which Python 2 only has
+when built with the pytracemalloc patch; without it, only timings are
+reported.
+
+Usage:
+  python bench/bench_alloc.py [products] [characters]
+"""
+
+import json
+import os
+import sys
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(TOP, 'Lib'))
+
+import gloebit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class Response(dict):
+    """ successful response headers """
+    status = 200
+
+def bodies(products, characters):
+    """ return {endpoint: (body, fields, old_debug_print)} """
+    inventory = dict(('product-%d' % i, i) for i in range(products))
+    character_list = [{'id': '%032x' % i, 'name': 'character %d' % i,
+                       'color': 'green'} for i in range(characters)]
+    return {
+        'user': (json.dumps({'success': True, 'id': 'u' * 32,
+                             'full-name': 'player'}),
+                 ('id', 'full-name'), False),
+        'balance': (json.dumps({'success': True, 'balance': 12.5}),
+                    ('balance',), False),
+        'get-user-products': (json.dumps({'success': True,
+                                          'products': inventory}),
+                              ('products',), False),
+        'get-characters': (json.dumps({'success': True,
+                                       'characters': character_list}),
+                           ('characters',), False),
+        'transact': (json.dumps({'success': True, 'balance': 10.0,
+                                 'product-count': 3, 'id': 'x' * 36}),
+                     ('balance', 'product-count'), False),
+        'consume-user-product': (json.dumps({'success': True,
+                                             'product-count': 2}),
+                                 ('product-count',), True),
+    }
+
+def old_way(body, fields, debug_print):
+    """ handle a response as the client used to """
+    response = gloebit._success_check(Response(), body, gloebit.Error)
+    response.keys()
+    if debug_print:
+        str(response)
+    return [response.get(field) for field in fields], response
+
+def new_way(body, fields, _debug_print):
+    """ handle a response with _success_fields() """
+    return gloebit._success_fields(Response(), body, gloebit.Error, *fields)
+
+def measure(function, args, repeat):
+    """ return (seconds per call, peak bytes of one call or None) """
+    start = time.time()
+    for _ in range(repeat):
+        function(*args)
+    elapsed = (time.time() - start) / repeat
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+    return elapsed, peak
+
+def main():
+    """ run the benchmark """
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    characters = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    if tracemalloc is None:
+        print 'tracemalloc unavailable: reporting timings only'
+    print '%-22s %10s %10s %12s %12s' % \
+        ('endpoint', 'old us', 'new us', 'old peak B', 'new peak B')
+    for endpoint, args in sorted(bodies(products, characters).items()):
+        repeat = 200
+        old_time, old_peak = measure(old_way, args, repeat)
+        new_time, new_peak = measure(new_way, args, repeat)
+        print '%-22s %10.1f %10.1f %12s %12s' % \
+            (endpoint, 1e6 * old_time, 1e6 * new_time,
+             old_peak if old_peak is not None else '-',
+             new_peak if new_peak is not None else '-')
+
+if __name__ == '__main__':
+    main()
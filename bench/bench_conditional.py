@@ -0,0 +1,65 @@
+"""Check and measure gzip and conditional GETs of product inventories.
+
+Serves the stub Gloebit server over HTTP, gives a user a large product
+inventory and character list, and reads them repeatedly, with
+conditional reads off and on.  Checks that every read returns the
+stub's current state, including right after a grant, and reports the
+bytes the stub sent, the 304 replies and the time per read.
+
+Usage:
+  python bench/bench_conditional.py [products] [reads]
+"""
+
+import os
+import sys
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_stub
+from bench_http2 import SCOPE, Credential
+
+def run(name, stub, url, products, reads, conditional_reads):
+    """ read one user's inventory and characters repeatedly """
+    merchant = gloebit.Gloebit(gloebit_stub.stub_secrets(url), scope=SCOPE,
+                               conditional_reads=conditional_reads)
+    token = gloebit_stub.json.loads(
+        stub.handle('POST', '/oauth2/access-token')[2])['access_token']
+    credential = Credential(token)
+    user = stub.users[token]
+    user['products'].update(('product-%d' % i, i) for i in range(products))
+    for i in range(20):
+        merchant.create_character(credential, {'name': 'hero %d' % i})
+
+    bytes_before, not_modified_before = stub.bytes_sent, stub.not_modified
+    start = time.time()
+    for _ in range(reads):
+        assert merchant.user_products(credential) == user['products']
+        assert len(merchant.user_characters(credential)) == 20
+    elapsed = time.time() - start
+    sent = stub.bytes_sent - bytes_before
+    not_modified = stub.not_modified - not_modified_before
+
+    merchant.grant_user_product(credential, 'product-0')
+    assert merchant.user_products(credential)['product-0'] == 1, \
+        'stale inventory after grant'
+
+    print '%-12s %10d %8d %10.2f' % (name, sent, not_modified,
+                                     1000 * elapsed / (2 * reads))
+
+def main():
+    """ run the check """
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    stub = gloebit_stub.StubGloebit()
+    server, url = stub.serve()
+    print '%-12s %10s %8s %10s' % ('reads', 'bytes sent', '304s',
+                                   'ms/read')
+    run('full', stub, url, products, reads, False)
+    run('conditional', stub, url, products, reads, True)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Run the Gloebit client under gevent at high concurrency.
+
+Monkey-patches the process with gevent before anything else is imported,
+serves the stub Gloebit server over HTTP and creates a merchant in
+cooperative mode.  Many greenlets then each read a user's balance and
+inventory, grant, buy and consume products, queue a purchase and a grant
+on the submission queue and make a call through call_async(), while
+another greenlet polls every user with poll_users().
+
+Checks that everything finishes (a lock or wait that blocked the event
+loop would stall every greenlet), that each user's balance and
+inventory match what was done, that greenlets queued for the connection
+pool, and that the run took a fraction of the time the same calls would
+take one after another.  Also checks that cooperative mode refuses a
+rate limiter, hedger or hold table created before patching, and that the
+process-wide defaults are replaced.
+
+Usage:
+  python bench/bench_gevent.py [greenlets] [--gloebit-latency SECONDS]
+                               [--connections N]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import optparse
+import os
+import sys
+import threading
+import time
+
+import gevent
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_hedge
+import gloebit_pool
+import gloebit_stub
+from bench_http2 import SCOPE, Credential
+
+# Gloebit calls made by one session().
+SESSION_CALLS = 8
+
+def session(merchant, credential):
+    """ one user's reads, purchases and inventory changes """
+    merchant.user_balance(credential)
+    merchant.user_products(credential)
+    merchant.grant_user_product(credential, 'gem', product_quantity=2)
+    merchant.purchase_user_product(credential, 'hat', username='player')
+    merchant.consume_user_product(credential, 'gem')
+    merchant.call_async(merchant.user_balance, credential).result(timeout=60)
+    purchase = merchant.submit_purchase_user_product(credential, 'hat',
+                                                     username='player')
+    grant = merchant.submit_grant_user_product(credential, 'gem')
+    purchase.result(timeout=60)
+    grant.result(timeout=60)
+
+def poll(merchant, credentials):
+    """ poll every user's balance and inventory, return the result count """
+    count = 0
+    for result in merchant.poll_users(credentials, products=True,
+                                      concurrency=32):
+        assert result.error is None, result.error
+        count += 1
+    return count
+
+def made_before_patching(factory):
+    """ return factory(), made with the locks it would get unpatched """
+    patched = threading.Lock
+    threading.Lock = monkey.get_original('threading', 'Lock')
+    try:
+        return factory()
+    finally:
+        threading.Lock = patched
+
+def check_refusals():
+    """ cooperative mode must refuse objects made before patching """
+    # First, before any merchant creates the default pool manager.
+    stale = made_before_patching(gloebit_pool.default_pool_manager)
+    assert gloebit_pool.default_pool_manager() is not stale
+
+    for name, factory in (('rate_limiter', gloebit.RateLimiter),
+                          ('hedger', gloebit_hedge.Hedger),
+                          ('holds', lambda: gloebit.HoldTable(
+                              'http://127.0.0.1:1', 'secret'))):
+        stale = made_before_patching(factory)
+        try:
+            gloebit.Gloebit(gloebit_stub.stub_secrets('http://127.0.0.1:1'),
+                            cooperative_mode=True, **{name: stale})
+            raise AssertionError('stale %s accepted' % name)
+        except gloebit.Error:
+            pass
+
+def main():
+    """ run the check """
+    parser = optparse.OptionParser()
+    parser.add_option('--gloebit-latency', type='float', default=0.02)
+    parser.add_option('--connections', type='int', default=16)
+    options, args = parser.parse_args()
+    greenlets = int(args[0]) if args else 1000
+
+    assert gloebit.cooperative()
+    check_refusals()
+
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency)
+    server, url = stub.serve()
+    manager = gloebit_pool.PoolManager(
+        max_connections_per_pool=options.connections, timeout=60)
+    merchant = gloebit.Gloebit(gloebit_stub.stub_secrets(url), scope=SCOPE,
+                               pool_manager=manager,
+                               rate_limiter=gloebit.RateLimiter(),
+                               cooperative_mode=True)
+    merchant.enable_submission_queue(workers=8)
+    credentials = [
+        Credential(stub.new_token()) for _ in range(greenlets)]
+
+    start = time.time()
+    jobs = [gevent.spawn(session, merchant, credential)
+            for credential in credentials]
+    jobs.append(gevent.spawn(poll, merchant, credentials))
+    gevent.joinall(jobs, timeout=300)
+    elapsed = time.time() - start
+
+    unfinished = [job for job in jobs if not job.ready()]
+    assert not unfinished, '%d greenlets stalled' % len(unfinished)
+    for job in jobs:
+        if job.exception is not None:
+            raise job.exception
+    assert jobs[-1].value == greenlets
+
+    for credential in credentials:
+        user = stub.users[credential.access_token]
+        assert user['products'] == {'hat': 2, 'gem': 2}, user['products']
+        assert user['balance'] == gloebit_stub.INITIAL_BALANCE - \
+            2 * gloebit_stub.DEFAULT_PRICE, user['balance']
+
+    stats = manager.stats()
+    pool = [value for key, value in stats.items() if key != 'open'][0]
+    calls = greenlets * (SESSION_CALLS + 2)
+    serial = calls * options.gloebit_latency
+    print '%d greenlets, %d Gloebit calls in %.2f s (%.0f calls/s)' % (
+        greenlets, calls, elapsed, calls / elapsed)
+    print 'pool: %d connections, up to %d greenlets waiting, %d requests' % (
+        options.connections, pool['max_waiting'], pool['requests'])
+    print 'serial time at %.0f ms per call: %.1f s' % (
+        1000 * options.gloebit_latency, serial)
+    assert pool['max_waiting'] > 0, 'the pool was never contended'
+    assert elapsed < serial / 4, 'calls did not overlap'
+    merchant.drain_submissions(close=True)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Measure hedged reads against a Gloebit server with a slow tail.
+
+Serves the stub Gloebit server over HTTP.  Most requests take
+--gloebit-latency seconds, but a --slow-rate fraction of them take
+--slow-latency seconds.  Concurrent workers read balances, inventories
+and character lists, once without hedging and once with a
+gloebit_hedge.Hedger.
+
+Reports read latency percentiles, the extra requests the stub received
+per read, and the hedger's counters.  Checks that every read returned
+the stub's current state and that hedges stayed within the hedger's
+max_extra budget.
+
+Usage:
+  python bench/bench_hedge.py [--reads N] [--concurrency N]
+                              [--gloebit-latency SECONDS]
+                              [--slow-rate FRACTION]
+                              [--slow-latency SECONDS] [--max-extra FRACTION]
+"""
+
+import optparse
+import os
+import sys
+import threading
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_hedge
+import gloebit_pool
+import gloebit_stub
+from bench_http2 import SCOPE, new_player
+from loadtest import percentile
+
+def run(name, stub, url, options, hedger):
+    """ read with concurrent workers and print the results """
+    merchant = gloebit.Gloebit(
+        gloebit_stub.stub_secrets(url), scope=SCOPE, hedger=hedger,
+        pool_manager=gloebit_pool.PoolManager(max_connections_per_pool=64))
+    slow_rate, stub.slow_rate = stub.slow_rate, 0.0
+    players = [new_player(stub, merchant) for _ in range(options.concurrency)]
+    stub.slow_rate = slow_rate
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(credential, character_id):
+        """ make this worker's share of the reads, checking each """
+        user = stub.users[credential.access_token]
+        reads = [lambda: merchant.user_balance(credential) == user['balance'],
+                 lambda: merchant.user_products(credential) ==
+                 user['products'],
+                 lambda: merchant.character_products(
+                     credential, character_id) ==
+                 user['character-products'].get(character_id, {}),
+                 lambda: len(merchant.user_characters(credential)) == 1]
+        for number in range(options.reads // options.concurrency):
+            start = time.time()
+            assert reads[number % len(reads)](), 'stale read'
+            with lock:
+                latencies.append(time.time() - start)
+
+    requests_before = stub.requests
+    threads = [threading.Thread(target=worker, args=player)
+               for player in players]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    extra = float(stub.requests - requests_before) / len(latencies) - 1
+    print '%-10s %8.2f %8.2f %8.2f %8.2f %8.3f' % (
+        name, 1000 * percentile(latencies, 50),
+        1000 * percentile(latencies, 99), 1000 * percentile(latencies, 99.9),
+        1000 * latencies[-1], extra)
+    return extra
+
+def main():
+    """ run the benchmark """
+    parser = optparse.OptionParser()
+    parser.add_option('--reads', type='int', default=4000)
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--gloebit-latency', type='float', default=0.005)
+    parser.add_option('--slow-rate', type='float', default=0.02)
+    parser.add_option('--slow-latency', type='float', default=0.2)
+    parser.add_option('--max-extra', type='float', default=0.05)
+    options, _ = parser.parse_args()
+
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency,
+                                    slow_rate=options.slow_rate,
+                                    slow_latency=options.slow_latency)
+    server, url = stub.serve()
+    print '%-10s %8s %8s %8s %8s %8s' % ('reads', 'p50 ms', 'p99 ms',
+                                         'p99.9 ms', 'max ms', 'extra')
+    run('plain', stub, url, options, None)
+    hedger = gloebit_hedge.Hedger(max_extra=options.max_extra)
+    extra = run('hedged', stub, url, options, hedger)
+    server.shutdown()
+
+    stats = hedger.stats()
+    print 'hedge rate %.3f, %d hedges won, %d losers cancelled, ' \
+        '%d dropped, %d denied' % (stats['hedge_rate'], stats['hedge_wins'],
+                                   stats['cancelled'], stats['dropped'],
+                                   stats['denied'])
+    print 'delays: %s' % ', '.join(
+        '%s %.1f ms' % (endpoint, 1000 * delay)
+        for endpoint, delay in sorted(stats['delays'].items()))
+    assert stats['hedged'] <= options.max_extra * stats['requests'] + \
+        hedger.burst, stats
+    assert extra <= options.max_extra + 0.01, extra
+
+if __name__ == '__main__':
+    main()
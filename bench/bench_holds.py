@@ -0,0 +1,215 @@
+"""Check the hold flow end to end, and time checkout against settlement.
+
+Serves gloebit_flask.hold_blueprint() over HTTP, and lets the stub Gloebit
+server call its hold URLs.  Purchases are queued with
+submit_purchase_item(), which returns a PendingHold at once; the stub
+then enacts and consumes each hold.  A purchase the merchant refuses to
+enact must be canceled and refunded, and a hold URL with a bad signature
+must be rejected.
+
+Runs twice: once with a gloebit.HoldTable, and once with a
+gloebit_holds.SharedHoldTable in a temporary SQLite file.  In the shared
+run, the callbacks are served by a second table opened on the same file,
+as another worker process would, and a table reopened on the file (as
+after a restart) still answers for a hold added before it.
+
+Both tables are also checked for holds left unsettled: an enacted hold
+that expires, or whose transaction fails, has its asset taken back, and
+a consume callback arriving after expiry is refused.
+
+Reports checkout latency (until the PendingHold is returned) next to a
+synchronous purchase_item(), and settlement latency (until consumed).
+
+Usage:
+  python bench/bench_holds.py [purchases] [--gloebit-latency SECONDS]
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+from flask import Flask
+
+import gloebit
+import gloebit_flask
+import gloebit_holds
+import gloebit_stub
+from bench_http2 import Credential
+from loadtest import percentile
+
+def serve_holds(holds):
+    """ serve the hold blueprint on localhost, return its base URL """
+    app = Flask(__name__)
+    app.register_blueprint(gloebit_flask.hold_blueprint(holds),
+                           url_prefix='/gloebit/hold')
+    server = gloebit_stub.make_threaded_server('127.0.0.1', 0, app)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/gloebit/hold' % server.server_port
+
+def report(name, latencies):
+    """ print latency percentiles """
+    latencies = sorted(latencies)
+    print '%-12s %8.2f %8.2f %8.2f' % (
+        name, 1000 * percentile(latencies, 50),
+        1000 * percentile(latencies, 99), 1000 * latencies[-1])
+
+def run(name, options, purchases, adding, serving):
+    """ purchase through the adding table; serve callbacks from serving """
+    refused = set()
+    serving.enact_callback = \
+        lambda hold: hold.transaction['asset-code'] not in refused
+    adding.base_url = serving.base_url = serve_holds(serving)
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency)
+    token = gloebit_stub.json.loads(
+        stub.handle('POST', '/oauth2/access-token')[2])['access_token']
+    credential = Credential(token)
+    secrets = gloebit_stub.stub_secrets('http://127.0.0.1:1')
+    direct = gloebit.Gloebit(secrets, scope='transact', transport=stub)
+    held = gloebit.Gloebit(secrets, scope='transact', transport=stub,
+                           holds=adding)
+    held.enable_submission_queue(workers=4)
+
+    synchronous = []
+    for _ in range(purchases):
+        start = time.time()
+        direct.purchase_item(credential, 'gem', 1, username='player')
+        synchronous.append(time.time() - start)
+
+    checkout, settlement, pending = [], [], []
+    for _ in range(purchases):
+        start = time.time()
+        hold = held.submit_purchase_item(credential, 'gem', 1,
+                                         username='player')
+        checkout.append(time.time() - start)
+        pending.append((start, hold))
+    for start, hold in pending:
+        assert hold.result(timeout=30) == hold.transaction_id
+        settlement.append(time.time() - start)
+        assert hold.state == 'consumed'
+
+    refused.add('cursed gem')
+    hold = held.submit_purchase_item(credential, 'cursed gem', 5,
+                                     username='player')
+    try:
+        hold.result(timeout=30)
+    except gloebit.HoldCanceledError:
+        pass
+    assert hold.state == 'canceled'
+    time.sleep(0.2)
+    user = stub.users[token]
+    assert user['balance'] == gloebit_stub.INITIAL_BALANCE - 2 * purchases, \
+        user['balance']
+    assert adding.pending() == 0, adding.pending()
+
+    forged = hold.transaction['asset-consume-hold-url'].replace('sig=',
+                                                                'sig=0')
+    try:
+        urllib2.urlopen(forged, '{}')
+        raise AssertionError('forged hold URL accepted')
+    except urllib2.HTTPError as exn:
+        assert exn.code == 403
+
+    print '%s: %d held purchases consumed, 1 refused and refunded, ' \
+        'forged callback rejected' % (name, purchases)
+    print '%-12s %8s %8s %8s' % ('latency', 'p50 ms', 'p99 ms', 'max ms')
+    report('synchronous', synchronous)
+    report('checkout', checkout)
+    report('settlement', settlement)
+    held.drain_submissions(close=True)
+
+def check_restart(filename):
+    """ a reopened shared table answers for holds added before it """
+    before = gloebit_holds.SharedHoldTable('http://placeholder',
+                                           'hold-secret', filename)
+    hold = before.add({'id': 'before-restart', 'asset-code': 'gem'})
+    before.close()
+    after = gloebit_holds.SharedHoldTable('http://placeholder',
+                                          'hold-secret', filename)
+    signature = signed(after, hold)
+    assert after.enact(hold.transaction_id, signature) == (True, 'enacted')
+    assert after.consume(hold.transaction_id, signature) == \
+        (True, 'consumed')
+    assert after.get(hold.transaction_id).state == 'consumed'
+    after.close()
+    print 'shared: hold added before a restart consumed after it'
+
+def signed(table, hold):
+    """ return the signature of a hold's URLs """
+    return urlparse.parse_qs(urlparse.urlparse(
+        table.urls(hold.transaction_id)['asset-enact-hold-url']).query)[
+            'sig'][0]
+
+def check_unsettled(name, table):
+    """ expired and failed enacted holds are taken back """
+    taken_back = []
+    table.cancel_callback = taken_back.append
+    table.max_age = 0.2
+    failed = table.add({'id': 'failed', 'asset-code': 'gem'})
+    assert table.enact('failed', signed(table, failed)) == (True, 'enacted')
+    posted = gloebit.Future()
+    posted.set_exception(gloebit.TransactFailureError('declined'))
+    table.posted(failed, posted)
+    assert failed.exception(timeout=5) is posted.exception()
+    assert table.get('failed').state == 'failed'
+
+    late = table.add({'id': 'late', 'asset-code': 'gem'})
+    signature = signed(table, late)
+    assert table.enact('late', signature) == (True, 'enacted')
+    time.sleep(0.3)
+    table.expire()
+    assert isinstance(late.exception(timeout=5), gloebit.HoldCanceledError)
+    assert [hold.transaction_id for hold in taken_back] == \
+        ['failed', 'late'], taken_back
+    assert table.consume('late', signature) == (False, 'hold is expired')
+    assert table.cancel('late', signature) == (True, 'already expired')
+    time.sleep(0.2)
+    table.expire()
+    assert table.get('late') is None
+    print '%s: failed and expired enacted holds taken back, late consume ' \
+        'refused' % name
+
+def main():
+    """ run the checks and the timings """
+    parser = optparse.OptionParser()
+    parser.add_option('--gloebit-latency', type='float', default=0.05)
+    options, args = parser.parse_args()
+    purchases = int(args[0]) if args else 50
+
+    holds = gloebit.HoldTable('http://placeholder', 'hold-secret')
+    run('memory', options, purchases, holds, holds)
+    check_unsettled('memory', gloebit.HoldTable('http://placeholder',
+                                                'hold-secret'))
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'holds.db')
+        adding = gloebit_holds.SharedHoldTable(
+            'http://placeholder', 'hold-secret', filename,
+            poll_interval=0.05)
+        serving = gloebit_holds.SharedHoldTable(
+            'http://placeholder', 'hold-secret', filename)
+        run('shared', options, purchases, adding, serving)
+        adding.close()
+        serving.close()
+        check_restart(filename)
+        unsettled = gloebit_holds.SharedHoldTable(
+            'http://placeholder', 'hold-secret',
+            os.path.join(directory, 'unsettled.db'))
+        check_unsettled('shared', unsettled)
+        unsettled.close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Compare HTTP/1.1 pooling with HTTP/2 multiplexing for page fan-out.
+
+Simulates portal page loads against the stub Gloebit server: each page
+makes four concurrent Gloebit calls (user, balance, user products and
+character products), as a /main page that fans out would.  Pages are
+loaded by concurrent workers, once through the HTTP/1.1 connection pool
+(stub.serve()) and once through gloebit_http2.Http2Transport
+(stub.serve_h2()).
+
+Reports the sockets the server accepted and page latency percentiles for
+each.  The HTTP/2 run needs the hyper and h2 packages.
+
+The wsgiref-based HTTP/1.1 stub closes every connection after one
+response, so its socket count is one per request; a keep-alive server
+would see at most the pool size.  HTTP/2 tail latency is higher here,
+but not because of framing cost: CPU time per page is about the same
+for both.  hyper holds its read lock across blocking socket reads, so a
+call whose reply has already arrived can wait for the next reply on the
+connection (see gloebit_http2.Http2Transport).
+
+Usage:
+  python bench/bench_http2.py [--pages N] [--concurrency N]
+                              [--gloebit-latency SECONDS]
+"""
+
+import optparse
+import os
+import sys
+import threading
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_pool
+import gloebit_stub
+from loadtest import percentile
+
+class Credential(object):
+    """ just enough of an OAuth2Credentials for the gloebit module """
+
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+def new_player(stub, merchant):
+    """ return a credential and character id for a fresh stub user """
+    credential = Credential(stub.new_token())
+    character = merchant.create_character(credential, {'name': 'hero'})
+    return credential, character['id']
+
+def load_page(merchant, credential, character_id):
+    """ make a page's four Gloebit calls concurrently """
+    calls = [lambda: merchant.user_info(credential),
+             lambda: merchant.user_balance(credential),
+             lambda: merchant.user_products(credential),
+             lambda: merchant.character_products(credential, character_id)]
+    threads = [threading.Thread(target=call) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run(name, merchant, server, stub, options):
+    """ load pages with concurrent workers and print the results """
+    connections_before = server.connections
+    players = [new_player(stub, merchant) for _ in range(options.concurrency)]
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(player):
+        """ load this worker's share of the pages """
+        for _ in range(options.pages // options.concurrency):
+            start = time.time()
+            load_page(merchant, *player)
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(player,))
+               for player in players]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    print '%-10s %8d %8.1f %8.2f %8.2f %8.2f' % (
+        name, server.connections - connections_before, len(latencies) / elapsed,
+        1000 * percentile(latencies, 50), 1000 * percentile(latencies, 90),
+        1000 * percentile(latencies, 99))
+
+SCOPE = 'balance transact inventory character user'
+
+def main():
+    """ run the benchmark """
+    parser = optparse.OptionParser()
+    parser.add_option('--pages', type='int', default=400)
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--gloebit-latency', type='float', default=0.01)
+    options, _ = parser.parse_args()
+
+    print '%-10s %8s %8s %8s %8s %8s' % (
+        'transport', 'sockets', 'pages/s', 'p50 ms', 'p90 ms',
+        'p99 ms')
+
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency)
+    server, url = stub.serve()
+    merchant = gloebit.Gloebit(
+        gloebit_stub.stub_secrets(url), scope=SCOPE, coalesce_reads=False,
+        pool_manager=gloebit_pool.PoolManager(max_connections_per_pool=64))
+    run('http/1.1', merchant, server, stub, options)
+    server.shutdown()
+
+    try:
+        server, url = stub.serve_h2()
+        __import__('hyper')
+    except ImportError:
+        print 'http/2     skipped: needs the hyper and h2 packages'
+        return
+    merchant = gloebit.Gloebit(gloebit_stub.stub_secrets(url), scope=SCOPE,
+                               coalesce_reads=False, http2=True)
+    run('http/2', merchant, server, stub, options)
+    print 'http/2 streams: %(requests)d, max in flight %(max_in_flight)d, ' \
+        'fallback requests %(fallback_requests)d' % merchant.transport.stats()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
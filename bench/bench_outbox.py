@@ -0,0 +1,125 @@
+"""Check crash-safe replay of the transaction outbox, and time purchases.
+
+First, a child process records purchases in an outbox and dies before
+any are sent.  The parent opens an outbox on the same file, drains it
+against the stub Gloebit server, and checks that every purchase was
+applied exactly once.  The stub, like Gloebit, answers a resent
+transaction id with its first reply.
+
+Then it times a purchase made directly against a slow Gloebit and one
+recorded in the outbox.
+
+Usage:
+  python bench/bench_outbox.py [purchases] [--gloebit-latency SECONDS]
+"""
+
+import optparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_outbox
+import gloebit_stub
+from bench_http2 import Credential
+from loadtest import percentile
+
+class Unreachable(object):
+    """ transport of a process that dies before reaching Gloebit """
+
+    def request(self, *_args):
+        """ never answer """
+        raise gloebit.Error('unreachable')
+
+def merchant(transport):
+    """ return a merchant using transport, without user lookups """
+    return gloebit.Gloebit(gloebit_stub.stub_secrets('http://127.0.0.1:1'),
+                           scope='transact inventory', transport=transport)
+
+def child(filename, token, purchases):
+    """ record purchases, then die without sending or closing anything """
+    outbox = gloebit_outbox.TransactionOutbox(merchant(Unreachable()),
+                                              filename, senders=0)
+    for _ in range(purchases):
+        outbox.purchase_user_product(Credential(token), 'hat',
+                                     username='player')
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def check_replay(purchases):
+    """ crash a child with an unsent outbox, replay it, check the stub """
+    stub = gloebit_stub.StubGloebit()
+    token = gloebit_stub.json.loads(
+        stub.handle('POST', '/oauth2/access-token')[2])['access_token']
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'outbox.db')
+    subprocess.call([sys.executable, __file__, '--child', filename, token,
+                     str(purchases)])
+
+    outbox = gloebit_outbox.TransactionOutbox(merchant(stub), filename)
+    print 'after crash: %d pending' % outbox.pending()
+    assert outbox.drain(timeout=30)
+    outbox.close()
+    # A second restart must not send anything again.
+    outbox = gloebit_outbox.TransactionOutbox(merchant(stub), filename)
+    assert outbox.pending() == 0
+    outbox.close()
+
+    user = stub.users[token]
+    assert user['products']['hat'] == purchases, user['products']
+    assert user['balance'] == gloebit_stub.INITIAL_BALANCE - \
+        purchases * gloebit_stub.DEFAULT_PRICE
+    print 'replayed %d purchases, each applied once' % purchases
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+def time_purchases(purchases, latency):
+    """ compare purchase latency directly and through the outbox """
+    stub = gloebit_stub.StubGloebit(latency=latency)
+    token = gloebit_stub.json.loads(
+        stub.handle('POST', '/oauth2/access-token')[2])['access_token']
+    credential = Credential(token)
+    direct = merchant(stub)
+    directory = tempfile.mkdtemp()
+    outbox = gloebit_outbox.TransactionOutbox(
+        merchant(stub), os.path.join(directory, 'outbox.db'))
+
+    print '%-10s %8s %8s %8s' % ('purchase', 'p50 ms', 'p99 ms', 'max ms')
+    for name, buyer in (('direct', direct), ('outbox', outbox)):
+        latencies = []
+        for _ in range(purchases):
+            start = time.time()
+            buyer.purchase_user_product(credential, 'hat', username='player')
+            latencies.append(time.time() - start)
+        latencies.sort()
+        print '%-10s %8.2f %8.2f %8.2f' % (
+            name, 1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99), 1000 * latencies[-1])
+    start = time.time()
+    outbox.drain()
+    print 'outbox drained %.2f s after the last purchase' % \
+        (time.time() - start)
+    outbox.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+def main():
+    """ run the check and the timing """
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    parser = optparse.OptionParser()
+    parser.add_option('--gloebit-latency', type='float', default=0.05)
+    options, args = parser.parse_args()
+    purchases = int(args[0]) if args else 50
+    check_replay(purchases)
+    time_purchases(purchases, options.gloebit_latency)
+
+if __name__ == '__main__':
+    main()
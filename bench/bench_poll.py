@@ -0,0 +1,89 @@
+"""Measure Gloebit.poll_users() against a serial loop, and its memory use.
+
+Polls balances and inventories for many stub users, every tenth of them
+with an expired (unknown) token, once with a serial loop of
+user_balance() and user_products() calls and once with poll_users() at
+several concurrency levels.  Credentials are generated lazily, and the
+process's peak RSS is reported after each run, so growth with the
+number of users would show.
+
+Usage:
+  python bench/bench_poll.py [users] [--gloebit-latency SECONDS]
+"""
+
+import optparse
+import os
+import resource
+import sys
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_stub
+from bench_http2 import SCOPE, Credential
+
+def credentials(stub, users):
+    """ generate credentials, every tenth one expired """
+    for number in range(users):
+        if number % 10 == 9:
+            yield Credential('expired-%d' % number)
+        else:
+            yield Credential(stub.new_token())
+
+def serial(merchant, stub, users):
+    """ poll users one after the other, return (succeeded, failed) """
+    succeeded = failed = 0
+    for credential in credentials(stub, users):
+        try:
+            merchant.user_balance(credential)
+            merchant.user_products(credential)
+            succeeded += 1
+        except gloebit.Error:
+            failed += 1
+    return succeeded, failed
+
+def bulk(merchant, stub, users, concurrency):
+    """ poll users with poll_users(), return (succeeded, failed) """
+    succeeded = failed = 0
+    for result in merchant.poll_users(credentials(stub, users),
+                                      products=True,
+                                      concurrency=concurrency):
+        if result.error is None:
+            succeeded += 1
+        else:
+            assert isinstance(result.error, gloebit.AccessTokenError), \
+                result.error
+            failed += 1
+    return succeeded, failed
+
+def main():
+    """ run the benchmark """
+    parser = optparse.OptionParser()
+    parser.add_option('--gloebit-latency', type='float', default=0.005)
+    options, args = parser.parse_args()
+    users = int(args[0]) if args else 2000
+
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency)
+    merchant = gloebit.Gloebit(
+        gloebit_stub.stub_secrets('http://127.0.0.1:1'), scope=SCOPE,
+        transport=stub, conditional_reads=False)
+
+    print '%-14s %8s %8s %10s %12s' % ('polling', 'ok', 'expired',
+                                       'users/s', 'peak RSS KB')
+    runs = [('serial', lambda: serial(merchant, stub, users))]
+    for concurrency in (4, 16, 64):
+        runs.append(('bulk x%d' % concurrency,
+                     lambda n=concurrency: bulk(merchant, stub, users, n)))
+    for name, run in runs:
+        stub.users.clear()
+        start = time.time()
+        succeeded, failed = run()
+        elapsed = time.time() - start
+        print '%-14s %8d %8d %10.1f %12d' % (
+            name, succeeded, failed, users / elapsed,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+if __name__ == '__main__':
+    main()
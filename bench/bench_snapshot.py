@@ -0,0 +1,228 @@
+"""Check and measure the shared-memory inventory snapshot.
+
+A refresher merchant with a SnapshotStore reads many players' user and
+character inventories from the stub Gloebit server, filling the store.
+Reader processes then map the store read-only and look up every product
+count, checking each against the stub.  Meanwhile the parent keeps
+rewriting a hot one-product inventory, which the readers then read as
+often.  Each rewrite stores the same number as count and time, so a
+reader that saw a torn slot, or a count older than its inventory, would
+notice the two differ.
+
+Also checks write-through and staleness: a purchase, consume and grant
+made by the merchant show up in the store at once, under the player's
+Gloebit user id whatever the access token, a product missing from a
+newer inventory reads as 0, and max_age refuses old entries.  And checks
+that expired entries read as absent and their slots are reused, that an
+inventory cut short by a full table leaves older counts unknown rather
+than current, and that a new file is private to its owner.
+
+Reports lookups per CPU second per reader and the CPU time per lookup,
+next to the wall time of a user_products() call to the stub over HTTP.
+
+Usage:
+  python bench/bench_snapshot.py [players] [--readers N] [--lookups N]
+"""
+
+import json
+import optparse
+import os
+import random
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_snapshot
+import gloebit_stub
+from bench_http2 import SCOPE, Credential, new_player
+
+PRODUCTS = ['hat', 'shirt', 'pants', 'shoe', 'backpack', 'knife', 'torch']
+HOT = ('hot-user', None, 'hot-product')
+
+def reader(filename, expected_file, lookups):
+    """ child: look up counts, check them and the hot slot, print stats """
+    store = gloebit_snapshot.SnapshotStore(filename, readonly=True)
+    with open(expected_file) as expected:
+        expected = [tuple(entry) for entry in json.load(expected)]
+    # CPU time: readers and the writer may share fewer cores than they are.
+    start = time.clock()
+    for number in xrange(lookups):
+        user, character_id, product, count = expected[number % len(expected)]
+        entry = store.get(user, character_id, product)
+        assert entry is not None and entry.count == count, \
+            (user, character_id, product, entry, count)
+    elapsed = time.clock() - start
+    torn = 0
+    for _ in xrange(lookups):
+        entry = store.get(*HOT)
+        if entry is not None and entry.count != entry.updated:
+            torn += 1
+    print json.dumps({'lookups': lookups, 'elapsed': elapsed, 'torn': torn,
+                      'retries': store.retries})
+    store.close()
+
+def fill(stub, merchant, players):
+    """ give players inventories, read them through the merchant """
+    expected = []
+    for _ in range(players):
+        credential, character_id = new_player(stub, merchant)
+        user = stub.users[credential.access_token]
+        for owner, products in ((None, user['products']),
+                                (character_id, user['character-products']
+                                 .setdefault(character_id, {}))):
+            for product in random.sample(PRODUCTS, 4):
+                products[product] = random.randint(1, 50)
+            for product in PRODUCTS:
+                expected.append((user['id'], owner, product,
+                                 products.get(product, 0)))
+        merchant.user_products(credential)
+        merchant.character_products(credential, character_id)
+    return expected
+
+def check_write_through(stub, merchant, store):
+    """ purchases, consumes and grants update the store; staleness works """
+    credential, character_id = new_player(stub, merchant)
+    token = credential.access_token
+    user = stub.users[token]['id']
+    merchant.character_products(credential, character_id)
+    assert store.get(user, character_id, 'hat').count == 0
+    assert store.get(token, character_id, 'hat') is None
+    merchant.purchase_character_product(credential, character_id, 'hat',
+                                        product_quantity=3,
+                                        username='player')
+    entry = store.get(user, character_id, 'hat')
+    assert (entry.count, entry.source) == (3, 'update'), entry
+    merchant.consume_character_product(credential, character_id, 'hat')
+    merchant.grant_user_product(credential, 'torch', product_quantity=2)
+    assert store.get(user, character_id, 'hat').count == 2
+    assert store.get(user, None, 'torch').count == 2
+    # A newer inventory without the product makes it 0.
+    stub.users[token]['products'].clear()
+    merchant.user_products(credential)
+    entry = store.get(user, None, 'torch')
+    assert (entry.count, entry.source) == (0, 'inventory'), entry
+    time.sleep(0.05)
+    assert store.get(user, None, 'torch', max_age=0.01) is None
+    assert store.get(user, None, 'torch', max_age=60) is not None
+    assert store.get('unknown', None, 'torch') is None
+    # A second session of the same player updates the same entries.
+    token = stub.new_token()
+    stub.users[token] = stub.users.pop(credential.access_token)
+    merchant.grant_user_product(Credential(token), 'torch')
+    assert store.get(user, None, 'torch').count == 1
+
+def check_expiry(directory):
+    """ expired entries read as absent and give up their slots """
+    filename = os.path.join(directory, 'expiring')
+    store = gloebit_snapshot.SnapshotStore(filename, capacity=64,
+                                           expire_after=0.05)
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o600
+    old = 0
+    while store.put('old-%d' % old, None, 'hat', 1):
+        old += 1
+    assert store.get('old-0', None, 'hat').count == 1
+    time.sleep(0.1)
+    assert store.get('old-0', None, 'hat') is None
+    # Bounded probing leaves a full table's last few keys without a slot.
+    new = [number for number in range(old)
+           if store.put('new-%d' % number, None, 'hat', 2)]
+    assert len(new) > old // 2 and store.reclaimed > old // 2, store.stats()
+    assert store.get('new-%d' % new[-1], None, 'hat').count == 2
+    store.close()
+    reopened = gloebit_snapshot.SnapshotStore(filename, readonly=True)
+    assert reopened.expire_after == 0.05
+    reopened.close()
+
+    # Fill a table but for three slots, then write an inventory that does
+    # not fit: the earlier count must not pass for a current one.
+    filename = os.path.join(directory, 'small')
+    store = gloebit_snapshot.SnapshotStore(filename, capacity=32,
+                                           expire_after=None)
+    store.put_inventory('player', None, {'hat': 5})
+    for number in range(29):
+        store.put('filler-%d' % number, None, 'hat', 1)
+    assert store.used() == 31
+    products = dict(('item-%d' % number, 1) for number in range(5))
+    assert not store.put_inventory('player', None, products)
+    assert store.get('player', None, 'hat') is None
+    assert store.get('player', None, 'shirt') is None
+    store.close()
+
+def main():
+    """ run the check and the timing """
+    if sys.argv[1:2] == ['--reader']:
+        reader(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+    parser = optparse.OptionParser()
+    parser.add_option('--readers', type='int', default=4)
+    parser.add_option('--lookups', type='int', default=200000)
+    options, args = parser.parse_args()
+    players = int(args[0]) if args else 2000
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'snapshot')
+    # Ten slots per player; keep the table under a third full, so that
+    # bounded probing finds every key a slot.
+    store = gloebit_snapshot.SnapshotStore(filename,
+                                           capacity=32 * players + 1024)
+    stub = gloebit_stub.StubGloebit()
+    merchant = gloebit.Gloebit(gloebit_stub.stub_secrets('http://127.0.0.1:1'),
+                               scope=SCOPE, transport=stub, snapshot=store)
+    expected = fill(stub, merchant, players)
+    check_write_through(stub, merchant, store)
+    check_expiry(directory)
+    expected_file = os.path.join(directory, 'expected.json')
+    with open(expected_file, 'w') as output:
+        json.dump(expected, output)
+    print '%d players, %d slots of %d used' % (players, store.used(),
+                                               store.capacity)
+
+    children = [subprocess.Popen([sys.executable, __file__, '--reader',
+                                  filename, expected_file,
+                                  str(options.lookups)],
+                                 stdout=subprocess.PIPE)
+                for _ in range(options.readers)]
+    user, character_id, product = HOT
+    start = int(time.time())
+    rewrites = 0
+    while any(child.poll() is None for child in children):
+        rewrites += 1
+        stamp = start + rewrites
+        store.put_inventory(user, character_id, {product: stamp},
+                            updated=float(stamp))
+    results = [json.loads(child.stdout.read()) for child in children]
+    assert all(child.returncode == 0 for child in children)
+    assert not any(result['torn'] for result in results), results
+
+    server, url = stub.serve()
+    http = gloebit.Gloebit(gloebit_stub.stub_secrets(url), scope=SCOPE,
+                           conditional_reads=False)
+    credential = new_player(stub, http)[0]
+    start = time.time()
+    for _ in range(200):
+        http.user_products(credential)
+    round_trip = (time.time() - start) / 200
+    server.shutdown()
+
+    print '%d readers, %d hot-slot rewrites meanwhile, no torn reads, ' \
+        '%d seqlock retries' % (len(results), rewrites,
+                                sum(result['retries'] for result in results))
+    print 'snapshot get(): %.0f lookups per CPU second, %.1f us each' % (
+        sum(r['lookups'] / r['elapsed'] for r in results) / len(results),
+        1e6 * sum(r['elapsed'] / r['lookups'] for r in results) /
+        len(results))
+    print 'user_products() over HTTP to the stub: %.0f us' % (
+        1e6 * round_trip)
+    store.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+if __name__ == '__main__':
+    main()
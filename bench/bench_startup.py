@@ -0,0 +1,110 @@
+"""Measure cold-process startup cost of the gloebit module.
+
+For each run, a fresh Python process imports gloebit, builds a Gloebit
+object and makes its first user_balance() call against a local stub
+server.  Reports the median import time, construction time and first-call
+latency, and which heavy dependencies the import alone pulled in.  Then
+times a fresh process importing the example app, GloebitExample, with
+its opt-in features off, and lists what that import pulled in.
+
+Modules are byte-compiled first, so the times are those of a deployed
+app rather than of compiling the source.
+
+Usage:
+  python bench/bench_startup.py [runs]
+"""
+
+import compileall
+import json
+import os
+import subprocess
+import sys
+
+import gloebit_stub
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_MODULES = ['httplib2', 'uuid', 'oauth2client.client',
+                 'oauth2client.clientsecrets', 'oauth2client.xsrfutil',
+                 '_strptime', 'sqlite3', 'mmap', 'gloebit_holds',
+                 'gloebit_outbox', 'gloebit_snapshot']
+
+CHILD = r'''
+import json, sys, time
+t0 = time.time()
+import gloebit
+t1 = time.time()
+loaded = [m for m in %(heavy)r if m in sys.modules]
+
+class Credential(object):
+    access_token = %(token)r
+
+merchant = gloebit.Gloebit(gloebit.ClientSecrets('bench', 'secret'),
+                           scope='balance')
+merchant.balance_uri = %(url)r + '/balance/'
+t2 = time.time()
+merchant.user_balance(Credential())
+t3 = time.time()
+print json.dumps({'import': t1 - t0, 'construct': t2 - t1,
+                  'first_call': t3 - t2, 'loaded': loaded})
+'''
+
+APP_CHILD = r'''
+import json, sys, time
+t0 = time.time()
+import GloebitExample
+t1 = time.time()
+loaded = [m for m in %(heavy)r if m in sys.modules]
+print json.dumps({'app_import': t1 - t0, 'loaded': loaded})
+'''
+
+def median(values):
+    """ median of a non-empty list """
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run_children(code, env, runs):
+    """ run code in runs fresh processes, returning their JSON results """
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+def main():
+    """ run the benchmark """
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    compileall.compile_dir(os.path.join(TOP, 'Lib'), quiet=True)
+    compileall.compile_file(os.path.join(TOP, 'GloebitExample.py'),
+                            quiet=True)
+
+    stub = gloebit_stub.StubGloebit()
+    server, url = stub.serve()
+
+    code = CHILD % {'heavy': HEAVY_MODULES, 'url': url,
+                    'token': stub.new_token()}
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([TOP, os.path.join(TOP, 'Lib')])
+    for name in ('GLOEBIT_HOLDS_URL', 'GLOEBIT_HEDGE_MAX_EXTRA',
+                 'GLOEBIT_SNAPSHOT', 'GLOEBIT_PROFILE_DIR', 'GLOEBIT_OUTBOX'):
+        env.pop(name, None)
+
+    results = run_children(code, env, runs)
+    server.shutdown()
+    app_results = run_children(APP_CHILD % {'heavy': HEAVY_MODULES}, env,
+                               runs)
+
+    for field in ('import', 'construct', 'first_call'):
+        print '%-12s median %7.2f ms' % \
+            (field, 1000 * median([r[field] for r in results]))
+    print 'loaded by import: %s' % (', '.join(results[0]['loaded']) or
+                                    'none')
+    print '%-12s median %7.2f ms' % \
+        ('app_import', 1000 * median([r['app_import'] for r in app_results]))
+    print 'loaded by app import: %s' % \
+        (', '.join(app_results[0]['loaded']) or 'none')
+
+if __name__ == '__main__':
+    main()
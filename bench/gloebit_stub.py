@@ -0,0 +1,522 @@
+"""In-memory stand-in for the Gloebit server, for benchmarks and load tests.
+
+StubGloebit implements the endpoints used by the gloebit module (token
+exchange, user info, balance, characters, products, transact, consume and
+grant) against in-memory state.  It can be used three ways:
+  * as a Gloebit transport:  merchant.transport = stub
+  * as a WSGI application:   stub.wsgi_app
+  * as a local HTTP server:  stub.serve() returns (server, base_url)
+  * as a local cleartext HTTP/2 server (needs the h2 package):
+                             stub.serve_h2() returns (server, base_url)
+
+To use the HTTP server, build the merchant's ClientSecrets with
+stub_secrets(base_url), which points the OAuth and API endpoints at it.
+
+Every access token the stub hands out names a fresh user with
+INITIAL_BALANCE G$ and no products or characters.  An optional latency is
+added to every request to imitate a remote server.
+
+Transactions with hold URLs are held: the stub takes the G$ and replies
+at once, then in a background thread calls the enact URL, and the
+consume URL if the merchant enacted (or the cancel URL, refunding, if
+not).
+
+Read-only replies carry an ETag (a hash of the body) and a Last-Modified
+time (of the user's last change), and conditional GETs are answered with
+304 Not Modified.  Over HTTP, bodies of at least GZIP_MIN_SIZE bytes are
+gzip-compressed for clients that accept it.
+"""
+
+import email.utils
+import gzip
+import hashlib
+import httplib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+import uuid
+
+from cStringIO import StringIO
+
+INITIAL_BALANCE = 1000.0
+DEFAULT_PRICE = 1.0
+GZIP_MIN_SIZE = 256
+READ_ENDPOINTS = ('user', 'balance', 'get-characters', 'get-user-products',
+                  'get-character-products')
+
+class StubResponse(dict):
+    """Response headers, shaped like an httplib2.Response."""
+
+    def __init__(self, status, headers=None):
+        dict.__init__(self, headers or {})
+        self.status = status
+        self['status'] = str(status)
+
+class StubGloebit(object):
+    """In-memory Gloebit server.
+
+    Attributes:
+      users: dictionary, Access token to the player's state: Gloebit
+        user id, balance, products and characters.  Benchmarks edit it
+        to set up inventories.
+    """
+
+    def __init__(self, latency=0.0, prices=None, hold_delay=0.0,
+                 hold_client=None, slow_rate=0.0, slow_latency=0.0):
+        """Create a StubGloebit.
+
+        Args:
+          latency: float, Seconds to sleep before answering each request.
+          prices: dictionary, Product name to price in G$.  Products not
+            listed cost DEFAULT_PRICE.
+          hold_delay: float, Seconds before settling a held transaction.
+          hold_client: callable, Called as hold_client(url) to call a hold
+            URL, returning the merchant's parsed JSON reply.  Defaults to
+            an HTTP POST.
+          slow_rate: float, Fraction of requests that take slow_latency
+            seconds instead of latency, for a heavy latency tail.
+          slow_latency: float, Seconds a slow request sleeps.
+        """
+        self.latency = latency
+        self.prices = prices or {}
+        self.hold_delay = hold_delay
+        self.hold_client = hold_client or _post_hold
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.settled = []
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.users = {}
+
+    def _user(self, headers):
+        """ return the state for the request's bearer token, or None """
+        authorization = _header(headers, 'authorization') or ''
+        if not authorization.startswith('Bearer '):
+            return None
+        return self.users.get(authorization[len('Bearer '):])
+
+    def handle(self, method, path, headers=None, body=None):
+        """Answer one request.
+
+        Returns:
+          Tuple of the HTTP status, a header dictionary and the body.
+        """
+        if self.slow_rate and random.random() < self.slow_rate:
+            time.sleep(self.slow_latency)
+        elif self.latency:
+            time.sleep(self.latency)
+        parts = [part for part in path.split('/') if part]
+        with self._lock:
+            self.requests += 1
+            if parts == ['oauth2', 'access-token']:
+                return self._token()
+            user = self._user(headers)
+            if user is None:
+                return self._reply({'success': False,
+                                    'reason': 'unknown token2'})
+            if method == 'POST' and body:
+                body = json.loads(body)
+            reply = self._reply(self._dispatch(user, parts, body))
+            if parts[0] not in READ_ENDPOINTS:
+                # Whole seconds, strictly increasing, so that every change
+                # gets a new Last-Modified.
+                user['modified'] = max(int(time.time()), user['modified'] + 1)
+                return reply
+            return self._validate(user, headers, reply)
+
+    def _validate(self, user, headers, reply):
+        """ add validators to a read reply; 304 if the client is current """
+        status, reply_headers, content = reply
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        last_modified = email.utils.formatdate(user['modified'], usegmt=True)
+        reply_headers.update({'etag': etag, 'last-modified': last_modified})
+        if_none_match = _header(headers, 'if-none-match')
+        if if_none_match is not None:
+            current = etag in [tag.strip() for tag in if_none_match.split(',')]
+        else:
+            current = _header(headers, 'if-modified-since') == last_modified
+        if not current:
+            return status, reply_headers, content
+        self.not_modified += 1
+        del reply_headers['content-type']
+        return 304, reply_headers, ''
+
+    def new_token(self):
+        """ add a new user and return its access token """
+        token = uuid.uuid4().hex
+        self.users[token] = {'id': uuid.uuid4().hex,
+                             'name': 'player-' + token[:8],
+                             'balance': INITIAL_BALANCE,
+                             'products': {},
+                             'characters': {},
+                             'character-products': {},
+                             'transactions': {},
+                             'modified': int(time.time())}
+        return token
+
+    def _token(self):
+        """ hand out a token for a new user """
+        return self._reply({'access_token': self.new_token(),
+                            'token_type': 'Bearer',
+                            'expires_in': 3600})
+
+    def _dispatch(self, user, parts, body):
+        """ return the JSON reply for an authorized request """
+        endpoint, args = parts[0], parts[1:]
+        if endpoint == 'user':
+            return {'success': True, 'id': user['id'],
+                    'full-name': user['name']}
+        if endpoint == 'balance':
+            return {'success': True, 'balance': user['balance']}
+        if endpoint == 'get-characters':
+            return {'success': True,
+                    'characters': user['characters'].values()}
+        if endpoint in ('create-character', 'update-character'):
+            character = dict(body)
+            character.setdefault('id', uuid.uuid4().hex)
+            user['characters'][character['id']] = character
+            return {'success': True, 'character': character}
+        if endpoint == 'delete-character':
+            user['characters'].pop(args[0], None)
+            return {'success': True}
+        if endpoint == 'transact':
+            return self._transact(user, body)
+        if endpoint.endswith('-product') or endpoint.endswith('-products'):
+            return self._products(user, endpoint, args)
+        return {'success': False, 'reason': 'unknown endpoint ' + endpoint}
+
+    def _inventory(self, user, character_id):
+        """ return the product counts of the user or one character """
+        if character_id:
+            return user['character-products'].setdefault(character_id, {})
+        return user['products']
+
+    def _products(self, user, endpoint, args):
+        """ get, consume or grant products """
+        character_id = None
+        if 'character' in endpoint:
+            character_id, args = args[0], args[1:]
+        inventory = self._inventory(user, character_id)
+        if endpoint.startswith('get-'):
+            return {'success': True, 'products': inventory}
+        product, count = urlparse.unquote(args[0]), int(args[1])
+        if endpoint.startswith('consume-'):
+            if inventory.get(product, 0) < count:
+                return {'success': False, 'reason': 'insufficient products'}
+            count = -count
+        inventory[product] = inventory.get(product, 0) + count
+        return {'success': True, 'product-count': inventory[product]}
+
+    def _transact(self, user, transaction):
+        """ purchase a product or an untracked item """
+        # Like Gloebit, answer a resent transaction id with its first reply.
+        if transaction['id'] in user['transactions']:
+            return user['transactions'][transaction['id']]
+        if 'product' in transaction:
+            quantity = transaction['product-quantity']
+            cost = self.prices.get(transaction['product'],
+                                   DEFAULT_PRICE) * quantity
+        else:
+            quantity = transaction['asset-quantity']
+            cost = transaction['gloebit-balance-change']
+        if cost > user['balance']:
+            return {'success': False, 'reason': 'insufficient balance'}
+        user['balance'] -= cost
+        reply = {'success': True, 'balance': user['balance'],
+                 'id': transaction['id']}
+        if transaction.get('asset-enact-hold-url'):
+            reply['status'] = 'queued'
+            user['transactions'][transaction['id']] = reply
+            thread = threading.Thread(target=self._settle,
+                                      args=(user, transaction, cost))
+            thread.daemon = True
+            thread.start()
+            return reply
+        if 'product' in transaction:
+            inventory = self._inventory(user, transaction.get('character-id'))
+            product = transaction['product']
+            inventory[product] = inventory.get(product, 0) + quantity
+            reply['product-count'] = inventory[product]
+        user['transactions'][transaction['id']] = reply
+        return reply
+
+    def _settle(self, user, transaction, cost):
+        """ enact a held transaction, then consume or cancel it """
+        if self.hold_delay:
+            time.sleep(self.hold_delay)
+        if self._call_hold(transaction['asset-enact-hold-url']):
+            if 'product' in transaction:
+                with self._lock:
+                    inventory = self._inventory(
+                        user, transaction.get('character-id'))
+                    product = transaction['product']
+                    inventory[product] = inventory.get(product, 0) + \
+                        transaction['product-quantity']
+            outcome, url = 'consumed', transaction['asset-consume-hold-url']
+        else:
+            with self._lock:
+                user['balance'] += cost
+            outcome, url = 'canceled', transaction['asset-cancel-hold-url']
+        self._call_hold(url)
+        with self._lock:
+            self.settled.append((transaction['id'], outcome))
+
+    def _call_hold(self, url):
+        """ call a hold URL, return True if the merchant succeeded """
+        try:
+            return bool(self.hold_client(url).get('success'))
+        except (EnvironmentError, httplib.HTTPException, ValueError):
+            # The merchant is down, or did not answer with JSON.
+            return False
+
+    @staticmethod
+    def _reply(response):
+        """ return a 200 JSON reply """
+        return 200, {'content-type': 'application/json'}, json.dumps(response)
+
+    def request(self, uri, method='GET', headers=None, body=None, **_kwargs):
+        """ Gloebit transport interface: return (response, content) """
+        path = urlparse.urlparse(uri).path
+        status, reply_headers, content = self.handle(method, path,
+                                                     headers, body)
+        return StubResponse(status, reply_headers), content
+
+    def encode(self, request_headers, reply_headers, content):
+        """ gzip content for clients that accept it; count bytes sent """
+        accept_encoding = _header(request_headers, 'accept-encoding') or ''
+        if len(content) >= GZIP_MIN_SIZE and 'gzip' in accept_encoding:
+            buf = StringIO()
+            compressed = gzip.GzipFile(fileobj=buf, mode='wb')
+            compressed.write(content)
+            compressed.close()
+            content = buf.getvalue()
+            reply_headers['content-encoding'] = 'gzip'
+        reply_headers['content-length'] = str(len(content))
+        with self._lock:
+            self.bytes_sent += len(content)
+        return content
+
+    def wsgi_app(self, environ, start_response):
+        """ WSGI interface """
+        headers = dict((name[5:].replace('_', '-').lower(), value)
+                       for name, value in environ.items()
+                       if name.startswith('HTTP_'))
+        body = None
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length:
+            body = environ['wsgi.input'].read(length)
+        status, reply_headers, content = self.handle(
+            environ['REQUEST_METHOD'], environ['PATH_INFO'], headers, body)
+        content = self.encode(headers, reply_headers, content)
+        reason = 'Not Modified' if status == 304 else 'OK'
+        start_response('%d %s' % (status, reason), reply_headers.items())
+        return [content]
+
+    def serve(self, port=0):
+        """Serve the stub over HTTP on localhost in a background thread.
+
+        Returns:
+          Tuple of the server (call shutdown() to stop it) and its base URL.
+        """
+        server = make_threaded_server('127.0.0.1', port, self.wsgi_app)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server, 'http://127.0.0.1:%d' % server.server_port
+
+    def serve_h2(self, port=0):
+        """Serve the stub over cleartext HTTP/2 on localhost.
+
+        Clients must speak HTTP/2 with prior knowledge, as
+        gloebit_http2.Http2Transport does for http URIs.  Each request is
+        answered in its own thread, so streams on one connection are
+        served concurrently.
+
+        Returns:
+          Tuple of the server (call shutdown() to stop it) and its base URL.
+        """
+        server = H2StubServer(self, port)
+        return server, 'http://127.0.0.1:%d' % server.server_port
+
+class H2StubServer(object):
+    """Minimal threaded HTTP/2 (h2c, prior knowledge) server for a stub.
+
+    Attributes:
+      connections: integer, Connections accepted so far.
+    """
+
+    def __init__(self, stub, port=0):
+        import h2.config
+        self._config = h2.config.H2Configuration(client_side=False,
+                                                 header_encoding=None)
+        self.stub = stub
+        self.connections = 0
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(128)
+        self.server_port = self._socket.getsockname()[1]
+        self._running = True
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        """ accept connections until shut down """
+        while self._running:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        """ read frames from one connection, answering each request """
+        import h2.connection
+        import h2.events
+
+        connection = h2.connection.H2Connection(config=self._config)
+        lock = threading.Lock()
+        connection.initiate_connection()
+        client.sendall(connection.data_to_send())
+        requests = {}
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    return
+                with lock:
+                    events = connection.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        requests[event.stream_id] = (dict(event.headers), [])
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].append(event.data)
+                        with lock:
+                            connection.increment_flow_control_window(
+                                len(event.data))
+                            connection.increment_flow_control_window(
+                                len(event.data), event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        thread = threading.Thread(
+                            target=self._respond,
+                            args=(client, connection, lock, event.stream_id,
+                                  requests.pop(event.stream_id)))
+                        thread.daemon = True
+                        thread.start()
+                with lock:
+                    client.sendall(connection.data_to_send())
+        except socket.error:
+            return
+        finally:
+            client.close()
+
+    def _respond(self, client, connection, lock, stream_id, request):
+        """ answer one request on its stream """
+        import h2.exceptions
+        headers, body = request
+        status, reply_headers, content = self.stub.handle(
+            headers[':method'], headers[':path'].split('?')[0], headers,
+            ''.join(body) or None)
+        content = self.stub.encode(headers, reply_headers, content)
+        reply_headers = [(':status', str(status))] + reply_headers.items()
+        with lock:
+            try:
+                connection.send_headers(stream_id, reply_headers)
+                # Stub replies fit in the default 64KB flow-control window.
+                connection.send_data(stream_id, content, end_stream=True)
+            except h2.exceptions.ProtocolError:
+                # The client reset the stream, e.g. a hedged read's loser.
+                return
+            try:
+                client.sendall(connection.data_to_send())
+            except socket.error:
+                pass
+
+    def shutdown(self):
+        """ stop accepting connections """
+        self._running = False
+        self._socket.close()
+
+def _post_hold(url):
+    """ POST to a hold URL, return the parsed JSON reply """
+    request = urllib2.Request(url, json.dumps({}),
+                              {'Content-Type': 'application/json'})
+    return json.loads(urllib2.urlopen(request, timeout=10).read())
+
+def _header(headers, name):
+    """ return the value of a request header, matched case-insensitively """
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def make_threaded_server(host, port, app):
+    """ return a multi-threaded wsgiref server for app """
+    import SocketServer
+    from wsgiref import simple_server
+
+    class Server(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+        """ one thread per connection, counting connections """
+        daemon_threads = True
+        request_queue_size = 128
+        connections = 0
+
+        def process_request(self, request, client_address):
+            self.connections += 1
+            SocketServer.ThreadingMixIn.process_request(
+                self, request, client_address)
+
+        def handle_error(self, request, client_address):
+            # Clients hang up on replies they no longer want, e.g. a
+            # hedged read's loser.
+            if not isinstance(sys.exc_info()[1], socket.error):
+                simple_server.WSGIServer.handle_error(
+                    self, request, client_address)
+
+    class ServerHandler(simple_server.ServerHandler):
+        """ WSGI handler that ignores clients hanging up mid-reply """
+        def log_exception(self, exc_info):
+            if not isinstance(exc_info[1], socket.error):
+                simple_server.ServerHandler.log_exception(self, exc_info)
+
+    class Handler(simple_server.WSGIRequestHandler):
+        """ quiet request handler """
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            # As in WSGIRequestHandler, but with the quieter ServerHandler.
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.send_error(414)
+                return
+            if not self.parse_request():
+                return
+            handler = ServerHandler(self.rfile, self.wfile,
+                                    self.get_stderr(), self.get_environ())
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+
+    return simple_server.make_server(host, port, app, server_class=Server,
+                                     handler_class=Handler)
+
+def stub_secrets(base_url, client_id='stub-merchant', client_secret='secret'):
+    """ return gloebit.ClientSecrets for a stub served at base_url """
+    import gloebit
+
+    return gloebit.ClientSecrets(client_id, client_secret,
+                                 auth_uri=base_url + '/oauth2/authorize',
+                                 token_uri=base_url + '/oauth2/access-token',
+                                 api_uri=base_url)
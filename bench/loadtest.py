@@ -0,0 +1,274 @@
+"""Load-test the Flask example app against a stub Gloebit server.
+
+Simulated players run the whole portal flow concurrently: login, Gloebit
+callback, character creation and selection, then a series of buys,
+grants and consumes, reloading /main after each.  The app runs either
+in-process (Flask test client) or behind a local threaded WSGI server
+driven over HTTP.  Gloebit is replaced by bench/gloebit_stub.py, either
+in-process as the Gloebit transport or as a local HTTP server.
+
+Reports throughput, latency percentiles per route, and count and latency
+per Gloebit endpoint.
+
+With --inline-calls, Gloebit.call_async() runs calls in the calling
+thread, so /main fetches its two inventories one after the other, as it
+used to.  --compare runs the test both ways and reports them side by
+side.
+
+Usage:
+  python bench/loadtest.py [--players N] [--concurrency N] [--rounds N]
+                           [--gloebit-latency SECONDS] [--wsgi] [--stub-http]
+                           [--inline-calls | --compare]
+"""
+
+import collections
+import cookielib
+import optparse
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[0:0] = [TOP, os.path.join(TOP, 'Lib'), os.path.dirname(__file__)]
+
+import gloebit
+import gloebit_stub
+import GloebitExample
+
+ACTIONS = ['user-buy-hat', 'character-buy-torch', 'user-grant-knife',
+           'character-grant-shoe', 'user-consume-hat',
+           'character-consume-torch']
+
+class Timings(object):
+    """Thread-safe collection of latency samples by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = collections.defaultdict(list)
+
+    def add(self, name, elapsed):
+        """ record one sample """
+        with self._lock:
+            self.samples[name].append(elapsed)
+
+    def report(self, title):
+        """ print count and latency percentiles per name """
+        print '%-26s %7s %8s %8s %8s %8s' % \
+            (title, 'count', 'mean', 'p50', 'p90', 'p99')
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            print '%-26s %7d %8.2f %8.2f %8.2f %8.2f' % \
+                (name, len(values), 1000 * sum(values) / len(values),
+                 1000 * percentile(values, 50),
+                 1000 * percentile(values, 90),
+                 1000 * percentile(values, 99))
+
+def percentile(values, pct):
+    """ pct percentile of a sorted non-empty list """
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+class TimingTransport(object):
+    """Gloebit transport wrapper timing calls per endpoint."""
+
+    def __init__(self, transport, timings):
+        self.transport = transport
+        self.timings = timings
+
+    def request(self, uri, method='GET', headers=None, body=None, **kwargs):
+        """ forward the request and record its latency """
+        endpoint = urlparse.urlparse(uri).path.strip('/').split('/')[0]
+        start = time.time()
+        try:
+            return self.transport.request(uri, method=method, headers=headers,
+                                          body=body, **kwargs)
+        finally:
+            self.timings.add(endpoint, time.time() - start)
+
+class InProcessClient(object):
+    """Player session using the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        """ GET path, return the status code """
+        return self.client.get(path).status_code
+
+    def post(self, path, form):
+        """ POST form to path, return the status code """
+        return self.client.post(path, data=form).status_code
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+    """ report redirects instead of following them """
+
+    def redirect_request(self, *args):
+        return None
+
+class HttpClient(object):
+    """Player session talking HTTP to a WSGI server, with cookies."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()), NoRedirect)
+
+    def _open(self, path, data=None):
+        """ send the request, return the status code """
+        try:
+            response = self.opener.open(self.base_url + path, data)
+        except urllib2.HTTPError as exn:
+            exn.read()
+            return exn.code
+        response.read()
+        return response.getcode()
+
+    def get(self, path):
+        """ GET path, return the status code """
+        return self._open(path)
+
+    def post(self, path, form):
+        """ POST form to path, return the status code """
+        return self._open(path, urllib.urlencode(form))
+
+def play(client, rounds, routes, errors):
+    """ run one player's session """
+    def step(route, status):
+        """ time one page request """
+        start = time.time()
+        code = status()
+        routes.add(route, time.time() - start)
+        if code >= 400:
+            errors.append((route, code))
+
+    step('/login', lambda: client.get('/login'))
+    step('/gloebit_callback',
+         lambda: client.get('/gloebit_callback?code=stub-code'))
+    step('/character-select', lambda: client.get('/character-select'))
+    step('/character-post',
+         lambda: client.post('/character-post',
+                             {'new': 'New Character', 'new-name': 'hero',
+                              'color': 'green'}))
+    step('/main', lambda: client.get('/main'))
+    for _ in range(rounds):
+        for action in ACTIONS:
+            step('/purchase', lambda: client.post('/purchase', {action: 'x'}))
+            step('/main', lambda: client.get('/main'))
+
+def call_inline(function, *args, **kwargs):
+    """ Gloebit.call_async() replacement running the call right away """
+    future = gloebit.Future()
+    try:
+        future.set_result(function(*args, **kwargs))
+    except Exception as exn:
+        # Raised again by result(), as with call_async().
+        future.set_exception(exn)
+    return future
+
+def run(options, new_client):
+    """Play every player's session.
+
+    Returns:
+      Tuple of seconds taken, route Timings and errors.
+    """
+    routes = Timings()
+    errors = []
+    players = iter(range(options.players))
+    players_lock = threading.Lock()
+
+    def worker():
+        """ play sessions until every player has played """
+        while True:
+            with players_lock:
+                if next(players, None) is None:
+                    return
+            play(new_client(), options.rounds, routes, errors)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker)
+               for _ in range(options.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, routes, errors
+
+def main():
+    """ run the load test """
+    parser = optparse.OptionParser()
+    parser.add_option('--players', type='int', default=50)
+    parser.add_option('--concurrency', type='int', default=10)
+    parser.add_option('--rounds', type='int', default=2)
+    parser.add_option('--gloebit-latency', type='float', default=0.005)
+    parser.add_option('--wsgi', action='store_true',
+                      help='serve the app with a local WSGI server')
+    parser.add_option('--stub-http', action='store_true',
+                      help='run the Gloebit stub as a local HTTP server')
+    parser.add_option('--inline-calls', action='store_true',
+                      help='run call_async() calls in the calling thread')
+    parser.add_option('--compare', action='store_true',
+                      help='compare inline and concurrent call_async()')
+    options, _ = parser.parse_args()
+
+    gloebit_calls = Timings()
+
+    stub = gloebit_stub.StubGloebit(latency=options.gloebit_latency)
+    if options.stub_http:
+        _stub_server, stub_url = stub.serve()
+        GloebitExample.GLOEBIT = gloebit.Gloebit(
+            gloebit_stub.stub_secrets(stub_url),
+            secret_key=GloebitExample.APP.secret_key)
+    merchant = GloebitExample.GLOEBIT
+    transport = stub if not options.stub_http else merchant.transport
+    merchant.transport = TimingTransport(transport, gloebit_calls)
+
+    app = GloebitExample.APP
+    if options.wsgi:
+        server = gloebit_stub.make_threaded_server('127.0.0.1', 0, app)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+        new_client = lambda: HttpClient(base_url)
+    else:
+        new_client = lambda: InProcessClient(app)
+
+    if options.compare:
+        print '%-12s %8s %8s %8s %8s %8s' % (
+            'main calls', 'pages/s', 'errors', 'main p50', 'main p90',
+            'main p99')
+        for name, inline in (('inline', True), ('concurrent', False)):
+            merchant.call_async = call_inline if inline else \
+                gloebit.Gloebit.call_async.__get__(merchant)
+            elapsed, routes, errors = run(options, new_client)
+            pages = sum(len(values) for values in routes.samples.values())
+            main_times = sorted(routes.samples['/main'])
+            print '%-12s %8.1f %8d %8.2f %8.2f %8.2f' % (
+                name, pages / elapsed, len(errors),
+                1000 * percentile(main_times, 50),
+                1000 * percentile(main_times, 90),
+                1000 * percentile(main_times, 99))
+        return
+
+    if options.inline_calls:
+        merchant.call_async = call_inline
+    elapsed, routes, errors = run(options, new_client)
+
+    pages = sum(len(values) for values in routes.samples.values())
+    print 'players %d, concurrency %d, %.2f s' % \
+        (options.players, options.concurrency, elapsed)
+    print 'throughput: %.1f pages/s, %.1f sessions/s, %d errors' % \
+        (pages / elapsed, options.players / elapsed, len(errors))
+    for route, code in sorted(set(errors)):
+        print '  %s returned %d' % (route, code)
+    print
+    routes.report('route (ms)')
+    print
+    gloebit_calls.report('gloebit endpoint (ms)')
+
+if __name__ == '__main__':
+    main()